@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Factory cho các loại FAISS index (Flat / HNSW / IVF-Flat / IVF-PQ).
+
+- choose_index_type(): chọn loại index theo số vector của corpus.
+- create_index(): tạo index theo factory string, metric inner product. IVF
+  giữ id gốc (add_with_ids); Flat/HNSW được bọc trong IndexIDMap2.
+- nprobe (IVF) / efSearch (HNSW) là tham số lúc query (search_params()),
+  không phải lúc build; tune_search_params() tìm giá trị nhỏ nhất đạt recall
+  mục tiêu so với kết quả exact.
+"""
+import math
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+# Ngưỡng số vector để chuyển loại index khi ANN_INDEX_TYPE = "auto"
+FLAT_MAX_VECTORS = 100_000
+HNSW_MAX_VECTORS = 1_000_000
+IVF_FLAT_MAX_VECTORS = 5_000_000
+
+HNSW_M = 32
+# Số điểm train mỗi centroid (FAISS khuyến nghị 39..256)
+TRAIN_POINTS_PER_CENTROID = 64
+# Trần số điểm train; luôn nâng lên đủ TRAIN_POINTS_PER_CENTROID * nlist
+TRAIN_MAX_POINTS = 200_000
+
+# set_direct_map_type() sửa index: chỉ một thread làm, search/reconstruct chạy song song
+_direct_map_lock = threading.Lock()
+
+_NPROBE_STEPS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+_EF_SEARCH_STEPS = (16, 32, 64, 128, 256, 512, 1024)
+
+
+def choose_index_type(n_vectors: int) -> str:
+    """Loại index phù hợp với kích thước corpus"""
+    if n_vectors <= FLAT_MAX_VECTORS:
+        return "flat"
+    if n_vectors <= HNSW_MAX_VECTORS:
+        return "hnsw"
+    if n_vectors <= IVF_FLAT_MAX_VECTORS:
+        return "ivf_flat"
+    return "ivf_pq"
+
+
+def _nlist_for(n_vectors: int) -> int:
+    # ~4*sqrt(n), làm tròn lên luỹ thừa của 2
+    target = max(16, int(4 * math.sqrt(max(n_vectors, 1))))
+    return min(65_536, 1 << (target - 1).bit_length())
+
+
+def _pq_m_for(dim: int) -> int:
+    # ~4 chiều mỗi sub-quantizer 8 bit (nén 16 lần so với float32), m phải chia hết dim
+    m = max(1, dim // 4)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def index_spec(index_type: str, n_vectors: int, dim: int) -> str:
+    """Factory string của FAISS cho loại index + kích thước corpus"""
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return "HNSW%d,Flat" % HNSW_M
+    if index_type == "ivf_flat":
+        return "IVF%d,Flat" % _nlist_for(n_vectors)
+    if index_type == "ivf_pq":
+        return "IVF%d,PQ%d" % (_nlist_for(n_vectors), _pq_m_for(dim))
+    raise ValueError("Unknown index type %r (expected one of %s)" % (index_type, ", ".join(INDEX_TYPES)))
+
+
+def create_index(spec: str, dim: int):
+    """Index rỗng (chưa train) theo factory string, luôn hỗ trợ add_with_ids"""
+    index = faiss.index_factory(dim, spec, faiss.METRIC_INNER_PRODUCT)
+    if faiss.try_extract_index_ivf(index) is not None:
+        return index
+    return faiss.IndexIDMap2(index)
+
+
+def _extract_ivf(index):
+    """IndexIVF bên trong (đúng lớp con, vd. IndexIVFPQ) hoặc None"""
+    ivf = faiss.try_extract_index_ivf(index)
+    return faiss.downcast_index(ivf) if ivf is not None else None
+
+
+def index_type_of(index) -> str:
+    ivf = _extract_ivf(index)
+    if ivf is not None:
+        return "ivf_pq" if isinstance(ivf, faiss.IndexIVFPQ) else "ivf_flat"
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def training_size(index) -> int:
+    """Số vector cần để train (0 nếu index không cần train)"""
+    if index.is_trained:
+        return 0
+    ivf = _extract_ivf(index)
+    n = TRAIN_POINTS_PER_CENTROID * (ivf.nlist if ivf is not None else 256)
+    if isinstance(ivf, faiss.IndexIVFPQ):
+        n = max(n, 256 * TRAIN_POINTS_PER_CENTROID)
+    # Trần cố định làm thiếu điểm cho nlist lớn (16384 centroid cần >= 39 * 16384)
+    cap = max(TRAIN_MAX_POINTS, TRAIN_POINTS_PER_CENTROID * (ivf.nlist if ivf is not None else 0))
+    return min(n, cap)
+
+
+def segment_ids(index) -> np.ndarray:
+    """Toàn bộ id (chunk_id) đang nằm trong index"""
+    if hasattr(index, "id_map"):
+        return faiss.vector_to_array(index.id_map)
+    ivf = faiss.extract_index_ivf(index)
+    invlists = ivf.invlists
+    parts = []
+    for list_no in range(ivf.nlist):
+        size = invlists.list_size(list_no)
+        if size:
+            parts.append(faiss.rev_swig_ptr(invlists.get_ids(list_no), size).copy())
+    return np.concatenate(parts) if parts else np.empty(0, dtype="int64")
+
+
+def reconstruct(index, ids: np.ndarray) -> np.ndarray:
+    """Lấy lại vector theo id (IVF-PQ trả về vector đã giải nén, có sai số)"""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type != faiss.DirectMap.Hashtable:
+        with _direct_map_lock:
+            if ivf.direct_map.type != faiss.DirectMap.Hashtable:
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index.reconstruct_batch(np.ascontiguousarray(ids, dtype="int64"))
+
+
+def search_params(index, sel=None, nprobe: Optional[int] = None,
+                  ef_search: Optional[int] = None) -> Optional[faiss.SearchParameters]:
+    """SearchParameters đúng loại cho index (None nếu không có gì để đặt)"""
+    kind = index_type_of(index)
+    if kind in ("ivf_flat", "ivf_pq") and nprobe:
+        params = faiss.SearchParametersIVF()
+        params.nprobe = int(nprobe)
+    elif kind == "hnsw" and ef_search:
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = int(ef_search)
+    elif sel is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if sel is not None:
+        params.sel = sel
+    return params
+
+
+def exact_topk(queries: np.ndarray, blocks: Iterable[Tuple[np.ndarray, np.ndarray]], k: int) -> np.ndarray:
+    """Top-k id exact cho queries trên các block (ids, vectors), duyệt từng block"""
+    heap = faiss.ResultHeap(len(queries), k, keep_max=True)
+    for ids, vecs in blocks:
+        if len(ids) == 0:
+            continue
+        D, I = faiss.knn(queries, vecs, min(k, len(ids)), metric=faiss.METRIC_INNER_PRODUCT)
+        labels = np.where(I >= 0, ids[np.maximum(I, 0)], -1)
+        if D.shape[1] < k:
+            pad = k - D.shape[1]
+            D = np.hstack([D, np.full((len(D), pad), -np.inf, dtype="float32")])
+            labels = np.hstack([labels, np.full((len(labels), pad), -1, dtype="int64")])
+        heap.add_result(np.ascontiguousarray(D, dtype="float32"), np.ascontiguousarray(labels, dtype="int64"))
+    heap.finalize()
+    return heap.I
+
+
+def recall_at_k(index, queries: np.ndarray, truth: np.ndarray, k: int,
+                params: Optional[faiss.SearchParameters] = None) -> float:
+    """Tỉ lệ trung bình các id exact top-k có trong top-k của index"""
+    _, I = index.search(queries, k, params=params)
+    hits = 0
+    total = 0
+    for found, expected in zip(I, truth[:, :k]):
+        expected = set(int(x) for x in expected if x >= 0)
+        hits += len(expected.intersection(int(x) for x in found))
+        total += len(expected)
+    return hits / total if total else 1.0
+
+
+def tune_search_params(index, queries: np.ndarray, truth: np.ndarray, k: int,
+                       target_recall: float) -> Dict[str, Any]:
+    """nprobe/efSearch nhỏ nhất đạt target_recall; trả về dict lưu vào manifest.
+
+    Dừng sớm khi tăng tham số không còn cải thiện recall (vd. IVF-PQ bị giới
+    hạn bởi sai số nén chứ không phải bởi nprobe).
+    """
+    kind = index_type_of(index)
+    if kind == "flat":
+        return {"recall": recall_at_k(index, queries, truth, k)}
+    if kind == "hnsw":
+        key, steps = "efSearch", [v for v in _EF_SEARCH_STEPS if v >= k]
+    else:
+        key, steps = "nprobe", [v for v in _NPROBE_STEPS if v <= faiss.extract_index_ivf(index).nlist]
+    best: Dict[str, Any] = {}
+    for value in steps:
+        params = search_params(index, nprobe=value if key == "nprobe" else None,
+                               ef_search=value if key == "efSearch" else None)
+        recall = recall_at_k(index, queries, truth, k, params)
+        if best and recall - best["recall"] < 0.002:
+            break
+        best = {key: value, "recall": recall}
+        if recall >= target_recall:
+            break
+    return best
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Cache câu trả lời của LLM theo bằng chứng đã truy xuất.
+
+Key = tập chunk_id được đưa vào prompt (+ variant: model, độ chi tiết...).
+Câu hỏi diễn đạt khác nhau nhưng lấy về cùng các chunk và có embedding gần
+nhau (cosine >= ngưỡng) dùng lại câu trả lời cũ cùng bảng nguồn đã lưu, nên
+số trích dẫn [n] vẫn khớp. Entry hết hạn theo TTL và bị xoá khi file chứa
+chunk được trích dẫn thay đổi (invalidate_files) hoặc index được dựng lại.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+_Key = Tuple[str, Tuple[int, ...]]
+
+
+class AnswerCache:
+    """Cache câu trả lời trong RAM, dùng chung giữa các session; an toàn khi gọi từ nhiều thread"""
+
+    def __init__(self, ttl_seconds: float = 24 * 3600, similarity: float = 0.92, max_entries: int = 512):
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[_Key, List[Dict[str, Any]]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(chunk_ids: Iterable[int], variant: str) -> _Key:
+        return variant, tuple(sorted(int(i) for i in chunk_ids))
+
+    def _drop_expired(self, key: _Key, now: float) -> List[Dict[str, Any]]:
+        entries = [e for e in self._entries.get(key, []) if now - e["created"] < self.ttl_seconds]
+        self._size -= len(self._entries.get(key, [])) - len(entries)
+        if entries:
+            self._entries[key] = entries
+        else:
+            self._entries.pop(key, None)
+        return entries
+
+    def get(self, qvec: np.ndarray, chunk_ids: Iterable[int], variant: str = "") -> Optional[Dict[str, Any]]:
+        """{"answer", "sources", "similarity", "age"} nếu có câu trả lời cho cùng bằng chứng và câu hỏi đủ gần"""
+        key = self._key(chunk_ids, variant)
+        now = time.time()
+        with self._lock:
+            best = None
+            best_sim = self.similarity
+            for entry in self._drop_expired(key, now):
+                sim = float(np.dot(entry["qvec"], qvec))
+                if sim >= best_sim:
+                    best, best_sim = entry, sim
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {"answer": best["answer"], "sources": best["sources"],
+                    "similarity": best_sim, "age": now - best["created"]}
+
+    def put(self, qvec: np.ndarray, chunk_ids: Iterable[int], answer: str,
+            sources: List[Dict[str, Any]], variant: str = "") -> None:
+        """Lưu câu trả lời; sources là các chunk theo đúng thứ tự trích dẫn [1], [2]..."""
+        key = self._key(chunk_ids, variant)
+        entry = {
+            "qvec": np.asarray(qvec, dtype="float32").copy(),
+            "answer": answer,
+            "sources": [dict(s) for s in sources],
+            "file_ids": {s.get("file_id") for s in sources},
+            "created": time.time(),
+        }
+        with self._lock:
+            self._drop_expired(key, entry["created"])
+            self._entries.setdefault(key, []).append(entry)
+            self._entries.move_to_end(key)
+            self._size += 1
+            while self._size > self.max_entries and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def invalidate_files(self, file_ids: Iterable[str]) -> int:
+        """Xoá các câu trả lời trích dẫn chunk của các file; trả về số entry bị xoá"""
+        file_ids = set(file_ids)
+        removed = 0
+        with self._lock:
+            for key in list(self._entries):
+                entries = self._entries[key]
+                kept = [e for e in entries if not (e["file_ids"] & file_ids)]
+                removed += len(entries) - len(kept)
+                if kept:
+                    self._entries[key] = kept
+                else:
+                    del self._entries[key]
+            self._size -= removed
+        return removed
+
+    def clear(self) -> None:
+        """Xoá toàn bộ (chunk_id được cấp lại từ đầu khi dựng lại index)"""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": self._size,
+            }
+
+
+_default_cache: Optional[AnswerCache] = None
+_default_lock = threading.Lock()
+
+
+def get_answer_cache(ttl_seconds: float = 24 * 3600, similarity: float = 0.92,
+                     max_entries: int = 512) -> AnswerCache:
+    """Cache câu trả lời dùng chung trong process"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = AnswerCache(ttl_seconds, similarity, max_entries)
+        return _default_cache
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Benchmark chunker theo token offset so với bản cũ (tokenize lại prefix).
+
+Chạy:  python bench_chunking.py [số ký tự của section ...]
+
+Với mỗi kích thước, sinh một section giả lập tài liệu kỹ thuật, chunk bằng
+cả hai cách, kiểm tra ranh giới chunk giống nhau và in thời gian chạy.
+"""
+import random
+import sys
+import time
+from typing import List
+
+from document_processors import (
+    _chunk_by_semantic_boundaries,
+    _detect_natural_breaks,
+    _find_best_split_point,
+    _safe_detokenize,
+    _safe_tokenize,
+)
+
+_SENTENCES = [
+    "Remove the fuel nozzle and inspect the O-ring for damage.",
+    "Torque the bolts to 45 psi in accordance with AMM 72-00-00.",
+    "CAUTION: Do not exceed 150 °C during the engine run.",
+    "Check the HPT blade tip clearance using the borescope.",
+    "Kiểm tra áp suất dầu thủy lực trước khi vận hành hệ thống.",
+    "Record all findings in the maintenance log.",
+]
+
+
+def _legacy_chunk(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """Bản cũ của _chunk_by_semantic_boundaries, giữ lại để so sánh"""
+    if not text or not text.strip():
+        return []
+    tokens = _safe_tokenize(text)
+    if len(tokens) <= chunk_size:
+        return [text.strip()] if text.strip() else []
+    natural_breaks = _detect_natural_breaks(text)
+    chunks = []
+    start_char = 0
+    while start_char < len(text):
+        start_tokens = _safe_tokenize(text[:start_char])
+        target_tokens = len(start_tokens) + chunk_size
+        if target_tokens >= len(tokens):
+            end_char = len(text)
+        else:
+            left, right = start_char, len(text)
+            while left < right:
+                mid = (left + right) // 2
+                if len(_safe_tokenize(text[:mid])) < target_tokens:
+                    left = mid + 1
+                else:
+                    right = mid
+            end_char = left
+        natural_candidates = [b for b in natural_breaks if start_char < b <= end_char + 100]
+        if natural_candidates:
+            end_char = min(natural_candidates, key=lambda x: abs(x - end_char))
+        else:
+            end_char = _find_best_split_point(text, end_char, window=150)
+        chunk_text = text[start_char:end_char].strip()
+        if chunk_text and len(chunk_text) > 10:
+            chunks.append(chunk_text)
+        if end_char >= len(text):
+            break
+        overlap_tokens = min(chunk_overlap, len(_safe_tokenize(chunk_text)) // 2)
+        if overlap_tokens > 0 and chunk_text:
+            chunk_tokens = _safe_tokenize(chunk_text)
+            overlap_text = _safe_detokenize(chunk_tokens[-overlap_tokens:])
+            overlap_pos = text.rfind(overlap_text[:50], start_char, end_char)
+            start_char = overlap_pos if overlap_pos > start_char else end_char
+        else:
+            start_char = end_char
+    return [c for c in chunks if c and c.strip() and len(c.strip()) > 10]
+
+
+def _make_section(n_chars: int, seed: int = 7) -> str:
+    rnd = random.Random(seed)
+    lines = []
+    size = 0
+    step = 1
+    while size < n_chars:
+        if rnd.random() < 0.08:
+            line = "%d.%d %s" % (step, rnd.randint(1, 9), "ENGINE REMOVAL PROCEDURE")
+            step += 1
+        elif rnd.random() < 0.1:
+            line = ""
+        else:
+            line = " ".join(rnd.choice(_SENTENCES) for _ in range(rnd.randint(1, 6)))
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def main(argv: List[str]) -> None:
+    sizes = [int(a) for a in argv] or [20_000, 50_000, 100_000]
+    for n_chars in sizes:
+        text = _make_section(n_chars)
+
+        t0 = time.perf_counter()
+        legacy = _legacy_chunk(text, 1000, 200)
+        t_legacy = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        fast = _chunk_by_semantic_boundaries(text, 1000, 200)
+        t_fast = time.perf_counter() - t0
+
+        same = legacy == [c for c, _ in fast]
+        print("%8d chars | %4d chunks | legacy %8.3fs | offsets %7.4fs | x%7.1f | same boundaries: %s"
+              % (len(text), len(fast), t_legacy, t_fast, t_legacy / max(t_fast, 1e-9), same))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Đóng gói các chunk đã truy xuất thành context cho LLM theo ngân sách token.
+
+Các chunk liên tiếp (chunk_index kề nhau) của cùng file + section được gộp
+thành một nguồn và bỏ phần overlap trùng lặp giữa chúng. Nguồn được thêm
+theo thứ hạng cho tới khi hết ngân sách; mỗi nguồn trong kết quả ứng với
+đúng một số trích dẫn [n] (theo thứ tự trả về).
+"""
+from typing import Any, Callable, Dict, List
+
+# Số ký tự cuối chunk trước dùng để dò vị trí overlap trong chunk sau
+_OVERLAP_PROBE = 50
+# Overlap ngắn hơn mức này coi như trùng ngẫu nhiên, không gộp
+_MIN_OVERLAP = 8
+
+
+def merge_overlap(first: str, second: str) -> str:
+    """Nối hai chunk kề nhau, bỏ phần đầu của second trùng với đuôi của first"""
+    tail = first[-_OVERLAP_PROBE:]
+    pos = second.find(tail) if tail else -1
+    while pos >= 0:
+        k = pos + len(tail)
+        if first.endswith(second[:k]):
+            return first + second[k:]
+        pos = second.find(tail, pos + 1)
+    # Overlap ngắn hơn probe (chunk trước kết thúc ngay sau điểm bắt đầu overlap)
+    for k in range(min(len(first), len(second), _OVERLAP_PROBE), _MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:k]):
+            return first + second[k:]
+    return first + "\n" + second
+
+
+def _section_key(chunk: Dict[str, Any]):
+    return chunk.get("file_id"), chunk.get("section_type"), chunk.get("section_number")
+
+
+def merge_adjacent(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Gộp các chunk liên tiếp cùng section; giữ thứ tự theo chunk xếp hạng cao nhất.
+
+    Mỗi nguồn gộp mang metadata của chunk xếp hạng cao nhất trong nhóm, text
+    đã bỏ overlap, chunk_ids theo thứ tự trong tài liệu và điểm cao nhất.
+    """
+    groups: Dict[Any, List[int]] = {}
+    for pos, c in enumerate(chunks):
+        groups.setdefault(_section_key(c), []).append(pos)
+
+    blocks = []
+    for positions in groups.values():
+        positions.sort(key=lambda p: (chunks[p].get("chunk_index", 0), p))
+        run = [positions[0]]
+        for p in positions[1:]:
+            prev = chunks[run[-1]].get("chunk_index")
+            cur = chunks[p].get("chunk_index")
+            if prev is not None and cur is not None and cur == prev + 1:
+                run.append(p)
+            else:
+                blocks.append(run)
+                run = [p]
+        blocks.append(run)
+
+    merged = []
+    for run in sorted(blocks, key=min):
+        best = chunks[min(run)]
+        block = dict(best)
+        text = chunks[run[0]]["text"]
+        for p in run[1:]:
+            text = merge_overlap(text, chunks[p]["text"])
+        block["text"] = text
+        block["chunk_ids"] = [chunks[p].get("chunk_id") for p in run]
+        for field in ("rerank_score", "similarity", "keyword_score", "bm25_score"):
+            if field in best:
+                block[field] = max(chunks[p].get(field, 0.0) for p in run)
+        block["has_tables"] = any(chunks[p].get("has_tables") for p in run)
+        block["has_lists"] = any(chunks[p].get("has_lists") for p in run)
+        merged.append(block)
+    return merged
+
+
+def pack_context(chunks: List[Dict[str, Any]], budget_tokens: int,
+                 count_fn: Callable[[str], int], overhead_tokens: int = 40) -> List[Dict[str, Any]]:
+    """Các nguồn (đã gộp) vừa ngân sách budget_tokens, theo thứ hạng.
+
+    overhead_tokens ước lượng header + dấu phân cách của mỗi nguồn. Nguồn
+    không vừa phần còn lại bị bỏ qua (nguồn nhỏ hơn phía sau vẫn có thể
+    vào); nguồn đầu tiên luôn được giữ, cắt bớt nếu vượt ngân sách.
+    """
+    packed = []
+    remaining = budget_tokens
+    for block in merge_adjacent(chunks):
+        cost = count_fn(block["text"]) + overhead_tokens
+        if cost <= remaining:
+            block["token_count"] = cost - overhead_tokens
+            packed.append(block)
+            remaining -= cost
+        elif not packed:
+            keep = max(remaining - overhead_tokens, 0)
+            block["text"] = block["text"][:len(block["text"]) * keep // max(cost - overhead_tokens, 1)]
+            block["token_count"] = count_fn(block["text"])
+            packed.append(block)
+            remaining = 0
+    return packed
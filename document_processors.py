@@ -1,14 +1,24 @@
 import streamlit as st
-from io import BytesIO
-import time
+import os
 import re
-from typing import List, Dict, Any, Tuple
+from bisect import bisect_left, bisect_right
+from typing import BinaryIO, List, Dict, Any, Optional, Tuple
 from collections import Counter
 
+def get_setting(name: str, default: Any = None) -> Any:
+    """Cấu hình từ st.secrets, nếu không có thì từ biến môi trường (CLI, cron)"""
+    try:
+        if name in st.secrets:
+            return st.secrets[name]
+    except FileNotFoundError:
+        # Chạy ngoài Streamlit, không có secrets.toml
+        pass
+    return os.environ.get(name, default)
+
 # OpenAI (cho embeddings)
 try:
     from openai import OpenAI
-    client = OpenAI(api_key=st.secrets.get("OPENAI_API_KEY", ""))
+    client = OpenAI(api_key=get_setting("OPENAI_API_KEY", ""))
 except ImportError:
     st.error("OpenAI library not installed")
     client = None
@@ -26,6 +36,10 @@ except ImportError:
     st.error("python-pptx not installed")
     Presentation = None
 
+from embedding_cache import EMBEDDING_CACHE_FILE, cache_key, get_default_cache, get_query_cache, normalize_text
+from embedding_scheduler import EmbeddingScheduler, get_scheduler
+from progress_events import NULL_SINK, EventSink
+
 # Tokenizer
 try:
     import tiktoken
@@ -73,30 +87,81 @@ def preprocess_text(text: str) -> str:
         return text
 
 # ---------- Advanced Metadata Extraction ----------
-def _extract_key_terms(text: str, top_n: int = 20) -> List[str]:
-    """Trích xuất các thuật ngữ quan trọng (technical terms, acronyms, etc.)"""
-    # Tìm acronyms (2-6 chữ in hoa)
-    acronyms = re.findall(r'\b[A-Z]{2,6}\b', text)
-    
-    # Tìm technical patterns: XX-XX-XX, ATA codes, etc.
-    tech_codes = re.findall(r'\b[A-Z0-9]+-[A-Z0-9]+(?:-[A-Z0-9]+)*\b', text)
-    
-    # Tìm numbers with units
-    measurements = re.findall(r'\b\d+(?:\.\d+)?(?:\s*(?:mm|cm|m|kg|lb|psi|bar|°C|°F|V|A|Hz|kW|hp))\b', text)
-    
-    # Combine và đếm frequency
-    all_terms = acronyms + tech_codes + measurements
-    if not all_terms:
-        return []
-    
-    # Lấy top N terms by frequency
-    term_counts = Counter(all_terms)
+# Từ khoá -> loại nội dung, theo thứ tự ưu tiên khi phân loại
+_CONTENT_KEYWORDS = (
+    ("procedure", ("procedure", "steps", "installation", "removal", "inspection")),
+    ("specification", ("specification", "technical data", "parameters", "limits")),
+    ("safety_note", ("caution", "warning", "note", "important")),
+)
+# Token khớp được (cụm nhiều từ chỉ tiêu thụ từ đầu) -> loại nội dung
+_KEYWORD_TYPES = {w.split(" ")[0]: ctype for ctype, words in _CONTENT_KEYWORDS for w in words}
+# Chữ cái đầu của các từ khoá, hoa + thường
+_KEYWORD_FIRST = "".join(sorted({c for _, words in _CONTENT_KEYWORDS for w in words for c in (w[0], w[0].upper())}))
+
+def _keyword_pattern(word: str) -> str:
+    # Phần sau từ đầu là lookahead để các từ sau vẫn được quét (DATA là acronym)
+    head, _, tail = word.partition(" ")
+    return head + ("(?= %s)" % tail if tail else "")
+
+def _keyword_alternatives() -> str:
+    """Nhánh từ khoá gom theo chữ cái đầu: [Pp](?ai:rocedure|arameters)|..."""
+    by_first: Dict[str, List[str]] = {}
+    for _, words in _CONTENT_KEYWORDS:
+        for w in words:
+            by_first.setdefault(w[0], []).append(_keyword_pattern(w)[1:])
+    return "|".join("[%s%s](?ai:%s)" % (c, c.upper(), "|".join(rests)) for c, rests in by_first.items())
+
+# Một regex duy nhất cho cả chunk, quét một lượt bằng finditer trên "\n" + text:
+# - "\n" mở đầu mỗi dòng; các lookahead sau nó nhận header / list / code mà
+#   không tiêu thụ ký tự, nên token trên dòng đó vẫn được quét tiếp;
+# - các nhánh còn lại tiêu thụ token: tech code (XX-XX-XX, ATA codes...),
+#   number with unit, acronym, từ khoá phân loại (nhánh không có group) và ký
+#   tự kẻ bảng.
+# Lookahead đầu pattern + mọi nhánh bắt đầu bằng một ký tự / lớp ký tự để sre
+# loại nhanh các vị trí không khớp; "\b" trước token viết thành lookbehind sau
+# ký tự đầu. Khoảng trắng là [^\S\n] để token không nuốt sang dòng sau.
+_CHUNK_SCAN_RE = re.compile(
+    r"(?=[\n0-9A-Z" + _KEYWORD_FIRST + r"─│┼┌┐└┘├┤┬┴-])(?:"
+    r"\n(?P<line>)"
+    r"(?=[^\S\n]*(?P<header>(?:\d+\.)*\d+[^\S\n]+[A-Z]|[A-Z](?:[A-Z]|[^\S\n])+:[^\S\n]*$|#+[^\S\n]+\S))?"
+    r"(?=[^\S\n]*(?P<numbered>\d+[.)][^\S\n]+))?"
+    r"(?=[^\S\n]*(?P<bullet>[-•*][^\S\n]+))?"
+    r"(?=[^\S\n]*(?P<code>(?:def|class|function|if|for|while|return)[^\S\n]+))?"
+    r"|[A-Z0-9](?<!\w[A-Z0-9])(?:(?P<tech_code>[A-Z0-9]*-[A-Z0-9]+(?:-[A-Z0-9]+)*\b)"
+    r"|(?<=\d)(?P<measurement>\d*(?:\.\d+)?[^\S\n]*(?:mm|cm|m|kg|lb|psi|bar|°C|°F|V|A|Hz|kW|hp)\b)"
+    r"|(?<=[A-Z])(?P<acronym>[A-Z]{1,5}\b))"
+    r"|" + _keyword_alternatives() +
+    r"|[─│┼┌┐└┘├┤┬┴-]+(?P<table>))",
+    re.MULTILINE,
+)
+# Dùng lại cho token đã bị tiêu thụ bởi nhánh tech code / acronym
+_ACRONYM_RE = re.compile(r"[A-Z]{2,6}")
+_MEASUREMENT_PART_RE = re.compile(r"\d+(?:V|A)")
+_KEYWORD_RE = re.compile("(?ai:%s)" % "|".join(_keyword_pattern(w) for _, words in _CONTENT_KEYWORDS for w in words))
+# Phần lookahead dài nhất của cụm từ khoá (" data")
+_KEYWORD_TAIL = max(len(w) - w.index(" ") for _, words in _CONTENT_KEYWORDS for w in words if " " in w)
+
+def _top_key_terms(acronyms: Counter, tech_codes: Counter, measurements: Counter, top_n: int) -> List[str]:
+    """Lấy top N terms by frequency (thứ tự ưu tiên: acronyms, codes, measurements)"""
+    term_counts = Counter()
+    term_counts.update(acronyms)
+    term_counts.update(tech_codes)
+    term_counts.update(measurements)
     return [term for term, _ in term_counts.most_common(top_n)]
 
-def _detect_structure_elements(text: str) -> Dict[str, Any]:
-    """Phát hiện các elements cấu trúc trong text"""
-    lines = text.split('\n')
-    
+def _classify_content_type(keyword_types: set, structure: Dict[str, Any]) -> str:
+    """Phân loại loại nội dung của section từ từ khoá đã gặp + structure"""
+    for ctype, _ in _CONTENT_KEYWORDS:
+        if ctype in keyword_types:
+            return ctype
+    if structure["has_tables"]:
+        return "table_data"
+    if structure["has_numbered_lists"] or structure["has_bullet_lists"]:
+        return "list_content"
+    return "general"
+
+def _analyze_chunk(text: str, top_n: int = 10) -> Dict[str, Any]:
+    """Phân tích một chunk: structure, content type và key terms trong một lượt quét"""
     structure = {
         "has_headers": False,
         "has_numbered_lists": False,
@@ -106,59 +171,65 @@ def _detect_structure_elements(text: str) -> Dict[str, Any]:
         "header_count": 0,
         "list_count": 0,
     }
-    
-    header_pattern = r'^(?:\d+\.)*\d+\s+[A-Z]|^[A-Z][A-Z\s]+:$|^#+\s'
-    numbered_list = r'^\s*\d+[\.\)]\s+'
-    bullet_list = r'^\s*[-•*]\s+'
-    table_separator = r'[-─│┼┌┐└┘├┤┬┴]'
-    code_indicator = r'^\s*(?:def|class|function|if|for|while|return)\s+'
-    
-    for line in lines:
-        if re.match(header_pattern, line.strip()):
-            structure["has_headers"] = True
-            structure["header_count"] += 1
-        
-        if re.match(numbered_list, line):
-            structure["has_numbered_lists"] = True
-            structure["list_count"] += 1
-        
-        if re.match(bullet_list, line):
-            structure["has_bullet_lists"] = True
-            structure["list_count"] += 1
-        
-        if re.search(table_separator, line):
+    # Danh sách theo thứ tự gặp, đếm bằng Counter() một lần ở cuối
+    acronyms, tech_codes, measurements = [], [], []
+    keyword_types = set()
+
+    # "\n" đầu để dòng đầu tiên cũng đi qua nhánh đầu dòng
+    text = "\n" + text
+    for m in _CHUNK_SCAN_RE.finditer(text):
+        kind = m.lastgroup
+        if kind == "acronym":
+            acronyms.append(m.group())
+        elif kind is None:
+            # Nhánh từ khoá
+            keyword_types.add(_KEYWORD_TYPES[m.group().lower()])
+        elif kind == "measurement":
+            measurements.append(m.group())
+        elif kind == "table":
             structure["has_tables"] = True
-        
-        if re.match(code_indicator, line):
-            structure["has_code_blocks"] = True
-    
-    return structure
+        elif kind == "tech_code":
+            token = m.group()
+            tech_codes.append(token)
+            # Acronym / number with unit giữa các dấu "-"; "-" cũng là ký tự kẻ bảng
+            for part in token.split("-"):
+                if _ACRONYM_RE.fullmatch(part):
+                    acronyms.append(part)
+                elif _MEASUREMENT_PART_RE.fullmatch(part):
+                    measurements.append(part)
+            structure["has_tables"] = True
+            # Từ khoá bắt đầu trong token, có thể kéo qua cuối token (TECHNICAL DATA)
+            for kw in _KEYWORD_RE.finditer(text, m.start(), min(len(text), m.end() + _KEYWORD_TAIL)):
+                keyword_types.add(_KEYWORD_TYPES[kw.group().lower()])
+        else:
+            # Đầu dòng: nhiều lookahead có thể cùng khớp
+            header, numbered, bullet, code = m.group("header", "numbered", "bullet", "code")
+            if header is not None:
+                structure["has_headers"] = True
+                structure["header_count"] += 1
+            if numbered is not None:
+                structure["has_numbered_lists"] = True
+                structure["list_count"] += 1
+            if bullet is not None:
+                structure["has_bullet_lists"] = True
+                structure["list_count"] += 1
+            if code is not None:
+                structure["has_code_blocks"] = True
 
-def _classify_content_type(text: str, metadata: Dict[str, Any]) -> str:
-    """Phân loại loại nội dung của section"""
-    text_lower = text.lower()
-    
-    # Technical documentation patterns
-    if any(word in text_lower for word in ["procedure", "steps", "installation", "removal", "inspection"]):
-        return "procedure"
-    
-    if any(word in text_lower for word in ["specification", "technical data", "parameters", "limits"]):
-        return "specification"
-    
-    if any(word in text_lower for word in ["caution", "warning", "note", "important"]):
-        return "safety_note"
-    
-    if metadata.get("has_tables"):
-        return "table_data"
-    
-    if metadata.get("has_numbered_lists") or metadata.get("has_bullet_lists"):
-        return "list_content"
-    
-    return "general"
+    # Từ khoá viết hoa nằm trong acronym (NOTE, LIMITS...): một lần trên các acronym khác nhau
+    for kw in _KEYWORD_RE.findall(" ".join(set(acronyms))):
+        keyword_types.add(_KEYWORD_TYPES[kw.lower()])
+
+    return {
+        "structure": structure,
+        "content_type": _classify_content_type(keyword_types, structure),
+        "key_terms": _top_key_terms(Counter(acronyms), Counter(tech_codes), Counter(measurements), top_n=top_n),
+    }
 
 # ---------- Enhanced PDF Processing ----------
-def process_pdf(file_content: BytesIO) -> Tuple[str, Dict[str, Any]]:
-    """Extract text + rich metadata from PDF"""
+def process_pdf(file_content: BinaryIO, events: Optional[EventSink] = None) -> Tuple[str, Dict[str, Any]]:
+    """Extract text + rich metadata from PDF; cảnh báo từng trang gửi vào events"""
+    events = events or NULL_SINK
     if PyPDF2 is None:
         raise Exception("PyPDF2 not installed")
     
@@ -171,7 +242,7 @@ def process_pdf(file_content: BytesIO) -> Tuple[str, Dict[str, Any]]:
             try:
                 t = page.extract_text() or ""
             except Exception as e:
-                st.warning(f"Failed to extract text from page {i}: {e}")
+                events.warning(f"Failed to extract text from page {i}: {e}", stage="parse", page=i)
                 t = ""
             
             if t.strip():
@@ -188,27 +259,19 @@ def process_pdf(file_content: BytesIO) -> Tuple[str, Dict[str, Any]]:
         if not full_text:
             raise Exception("No text could be extracted from the PDF")
         
-        # Extract key terms from full document
-        key_terms = _extract_key_terms(full_text, top_n=30)
-        
-        # Detect structure
-        structure = _detect_structure_elements(full_text)
-        
         # Build comprehensive metadata
+        # (key terms + structure chỉ tính cho từng chunk trong chunk_text_smart)
         meta = {
             "total_pages": len(reader.pages),
             "extracted_pages": len(pages),
             "has_sections": True,
             "sections": [{"type": "page", "number": p["number"], 
                          "word_count": p["word_count"]} for p in pages],
-            "key_terms": key_terms,
-            "structure": structure,
             "avg_words_per_page": sum(p["word_count"] for p in pages) / max(len(pages), 1),
             "total_words": sum(p["word_count"] for p in pages),
         }
         
-        # Debug info
-        st.caption(f"✓ PDF: {len(pages)} pages, {meta['total_words']} words, {len(key_terms)} key terms")
+        events.info(f"✓ PDF: {len(pages)} pages, {meta['total_words']} words", stage="parse")
         
         return full_text, meta
         
@@ -216,8 +279,9 @@ def process_pdf(file_content: BytesIO) -> Tuple[str, Dict[str, Any]]:
         raise Exception(f"Failed to process PDF: {str(e)}")
 
 # ---------- Enhanced PPTX Processing ----------
-def process_pptx(file_content: BytesIO) -> Tuple[str, Dict[str, Any]]:
-    """Extract text + rich metadata from PPTX"""
+def process_pptx(file_content: BinaryIO, events: Optional[EventSink] = None) -> Tuple[str, Dict[str, Any]]:
+    """Extract text + rich metadata from PPTX; cảnh báo từng shape gửi vào events"""
+    events = events or NULL_SINK
     if Presentation is None:
         raise Exception("python-pptx not installed")
     
@@ -275,7 +339,7 @@ def process_pptx(file_content: BytesIO) -> Tuple[str, Dict[str, Any]]:
                         slide_images += 1
                         
                 except Exception as e:
-                    st.warning(f"Skipped shape in slide {s_idx}: {str(e)}")
+                    events.warning(f"Skipped shape in slide {s_idx}: {str(e)}", stage="parse", slide=s_idx)
                     continue
             
             slide_full_text = "\n".join(slide_text_parts)
@@ -297,14 +361,8 @@ def process_pptx(file_content: BytesIO) -> Tuple[str, Dict[str, Any]]:
         if not full_text:
             raise Exception("No text could be extracted from the PowerPoint")
         
-        # Extract key terms
-        key_terms = _extract_key_terms(full_text, top_n=30)
-        
-        # Detect structure
-        structure = _detect_structure_elements(full_text)
-        structure["has_tables"] = has_tables
-        
         # Build metadata
+        # (key terms + structure chỉ tính cho từng chunk trong chunk_text_smart)
         meta = {
             "total_slides": len(list(prs.slides)),
             "extracted_slides": len(slides_data),
@@ -312,8 +370,6 @@ def process_pptx(file_content: BytesIO) -> Tuple[str, Dict[str, Any]]:
             "sections": [{"type": "slide", "number": s["number"], 
                          "title": s["title"], "word_count": s["word_count"],
                          "has_table": s["has_table"]} for s in slides_data],
-            "key_terms": key_terms,
-            "structure": structure,
             "has_tables": has_tables,
             "has_images": has_images,
             "avg_words_per_slide": sum(s["word_count"] for s in slides_data) / max(len(slides_data), 1),
@@ -391,82 +447,100 @@ def _find_best_split_point(text: str, target_pos: int, window: int = 200) -> int
     
     return target_pos
 
-def _chunk_by_semantic_boundaries(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
-    """Chunk text theo semantic boundaries"""
+def _token_offsets(text: str) -> List[int]:
+    """Vị trí ký tự bắt đầu của từng token (tokenize một lần cho cả section)"""
+    if tokenizer:
+        _, offsets = tokenizer.decode_with_offsets(tokenizer.encode(text))
+        return offsets
+    return list(range(len(text)))
+
+def _closest_break(breaks: List[int], lo_char: int, hi_char: int, target: int) -> int:
+    """Natural break gần target nhất trong (lo_char, hi_char], -1 nếu không có"""
+    lo = bisect_right(breaks, lo_char)
+    hi = bisect_right(breaks, hi_char)
+    if lo >= hi:
+        return -1
+    pos = bisect_left(breaks, target, lo, hi)
+    if pos == lo:
+        return breaks[lo]
+    if pos == hi:
+        return breaks[hi - 1]
+    before, after = breaks[pos - 1], breaks[pos]
+    # Bằng nhau thì lấy điểm trước (giống min() trên list đã sort)
+    return before if target - before <= after - target else after
+
+def _chunk_by_semantic_boundaries(text: str, chunk_size: int, chunk_overlap: int) -> List[Tuple[str, int]]:
+    """Chunk text theo semantic boundaries, trả về (chunk, số token).
+
+    Section chỉ được tokenize một lần; vị trí cắt được tính từ bảng offset
+    token -> ký tự bằng bisect thay vì tokenize lại prefix ở mỗi bước.
+    """
     if not text or not text.strip():
         return []
     
-    tokens = _safe_tokenize(text)
+    offsets = _token_offsets(text)
+    n_tokens = len(offsets)
     
-    if len(tokens) <= chunk_size:
-        return [text.strip()] if text.strip() else []
+    if n_tokens <= chunk_size:
+        return [(text.strip(), n_tokens)] if text.strip() else []
     
     natural_breaks = _detect_natural_breaks(text)
+    text_len = len(text)
     chunks = []
     start_char = 0
     
-    while start_char < len(text):
-        start_tokens = _safe_tokenize(text[:start_char])
-        target_tokens = len(start_tokens) + chunk_size
+    while start_char < text_len:
+        target_tokens = bisect_left(offsets, start_char) + chunk_size
         
-        if target_tokens >= len(tokens):
-            end_char = len(text)
+        if target_tokens >= n_tokens:
+            end_char = text_len
         else:
-            # Binary search for character position
-            left, right = start_char, len(text)
-            while left < right:
-                mid = (left + right) // 2
-                mid_tokens = len(_safe_tokenize(text[:mid]))
-                if mid_tokens < target_tokens:
-                    left = mid + 1
-                else:
-                    right = mid
-            end_char = left
+            # Prefix text[:end_char] vừa đủ target_tokens token
+            end_char = offsets[target_tokens - 1] + 1
         
         # Find nearest natural break
-        natural_candidates = [b for b in natural_breaks if start_char < b <= end_char + 100]
-        if natural_candidates:
-            end_char = min(natural_candidates, key=lambda x: abs(x - end_char))
+        natural_end = _closest_break(natural_breaks, start_char, end_char + 100, end_char)
+        if natural_end >= 0:
+            end_char = natural_end
         else:
             end_char = _find_best_split_point(text, end_char, window=150)
         
         chunk_text = text[start_char:end_char].strip()
+        # Tokenize riêng chunk (một lần) để overlap và token_count khớp count_tokens(chunk)
+        chunk_tokens = _safe_tokenize(chunk_text)
         
         # Only add non-empty chunks
         if chunk_text and len(chunk_text) > 10:  # At least 10 chars
-            chunks.append(chunk_text)
+            chunks.append((chunk_text, len(chunk_tokens)))
         
-        if end_char >= len(text):
+        if end_char >= text_len:
             break
         
         # Calculate overlap
-        overlap_tokens = min(chunk_overlap, len(_safe_tokenize(chunk_text)) // 2)
+        overlap_tokens = min(chunk_overlap, len(chunk_tokens) // 2)
         if overlap_tokens > 0 and chunk_text:
-            chunk_tokens = _safe_tokenize(chunk_text)
-            if len(chunk_tokens) >= overlap_tokens:
-                overlap_text = _safe_detokenize(chunk_tokens[-overlap_tokens:])
-                overlap_pos = text.rfind(overlap_text[:50], start_char, end_char)
-                if overlap_pos > start_char:
-                    start_char = overlap_pos
-                else:
-                    start_char = end_char
+            overlap_text = _safe_detokenize(chunk_tokens[-overlap_tokens:])
+            overlap_pos = text.rfind(overlap_text[:50], start_char, end_char)
+            if overlap_pos > start_char:
+                start_char = overlap_pos
             else:
                 start_char = end_char
         else:
             start_char = end_char
     
-    # Final filter for empty chunks
-    return [c for c in chunks if c and c.strip() and len(c.strip()) > 10]
+    return chunks
 
 def chunk_text_smart(text: str,
                      doc_metadata: Dict[str, Any],
                      chunk_size: int = 1000,
-                     chunk_overlap: int = 200) -> List[Dict[str, Any]]:
+                     chunk_overlap: int = 200,
+                     events: Optional[EventSink] = None) -> List[Dict[str, Any]]:
     """Tách text thông minh theo sections và semantic boundaries"""
+    events = events or NULL_SINK
     text = preprocess_text(text)
     
     if not text or not text.strip():
-        st.warning("Empty document after preprocessing")
+        events.warning("Empty document after preprocessing", stage="chunk")
         return []
     
     sections = []
@@ -508,7 +582,7 @@ def chunk_text_smart(text: str,
             sections.append(("document", 0, text, ""))
 
     if not sections:
-        st.warning("No sections found in document")
+        events.warning("No sections found in document", stage="chunk")
         return []
 
     out: List[Dict[str, Any]] = []
@@ -530,30 +604,27 @@ def chunk_text_smart(text: str,
         smalls = _chunk_by_semantic_boundaries(scontent, chunk_size, chunk_overlap)
         
         # Filter out empty chunks
-        smalls = [s for s in smalls if s and s.strip()]
+        smalls = [(s, n) for s, n in smalls if s and s.strip()]
         
         if smalls:
             temp_chunks_per_section.append((stype, snum, stitle, smalls))
             total_chunks_counter += len(smalls)
 
     if total_chunks_counter == 0:
-        st.warning("No valid chunks created")
+        events.warning("No valid chunks created", stage="chunk")
         return []
 
     # Gán metadata chi tiết cho từng chunk
     running_idx = 0
     for (stype, snum, stitle, smalls) in temp_chunks_per_section:
-        for i, txt in enumerate(smalls):
+        for i, (txt, n_tokens) in enumerate(smalls):
             # Skip if somehow empty (safety check)
             if not txt or not txt.strip():
                 continue
                 
-            # Phân loại content type
-            chunk_structure = _detect_structure_elements(txt)
-            content_type = _classify_content_type(txt, chunk_structure)
-            
-            # Extract local key terms
-            local_terms = _extract_key_terms(txt, top_n=10)
+            # Structure, content type và local key terms trong một lượt phân tích
+            analysis = _analyze_chunk(txt, top_n=10)
+            chunk_structure = analysis["structure"]
             
             chunk_meta = {
                 "text": txt.strip(),  # Ensure trimmed
@@ -563,14 +634,14 @@ def chunk_text_smart(text: str,
                 "section_number": snum,
                 "section_title": stitle,
                 "is_complete_section": (len(smalls) == 1),
-                "token_count": count_tokens(txt),
+                "token_count": n_tokens,
                 "word_count": len(txt.split()),
                 "char_count": len(txt),
-                "content_type": content_type,
+                "content_type": analysis["content_type"],
                 "has_headers": chunk_structure.get("has_headers", False),
                 "has_lists": chunk_structure.get("has_numbered_lists", False) or chunk_structure.get("has_bullet_lists", False),
                 "has_tables": chunk_structure.get("has_tables", False),
-                "local_key_terms": local_terms,
+                "local_key_terms": analysis["key_terms"],
             }
             out.append(chunk_meta)
             running_idx += 1
@@ -578,8 +649,64 @@ def chunk_text_smart(text: str,
     return out
 
 # ---------- Embeddings ----------
-def get_embeddings(texts: List[str], batch_size: int = 100) -> List[List[float]]:
-    """Generate embeddings with progress tracking"""
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+
+def _embedding_cache(events: Optional[EventSink] = None):
+    """Cache embeddings trên đĩa dùng chung trong process (None nếu không mở được)"""
+    try:
+        max_mb = int(get_setting("EMBEDDING_CACHE_MAX_MB", 512))
+        return get_default_cache(EMBEDDING_CACHE_FILE, max_bytes=max_mb * 1024 * 1024)
+    except Exception as e:
+        (events or NULL_SINK).warning(f"Embedding cache unavailable: {e}", stage="embed")
+        return None
+
+def _embedding_scheduler() -> EmbeddingScheduler:
+    """Scheduler dùng chung (RPM/TPM/concurrency cấu hình qua secrets)"""
+    return get_scheduler(
+        client, EMBEDDING_MODEL,
+        requests_per_minute=float(get_setting("EMBEDDING_RPM", 3000)),
+        tokens_per_minute=float(get_setting("EMBEDDING_TPM", 1_000_000)),
+        concurrency=int(get_setting("EMBEDDING_CONCURRENCY", 4)),
+        max_batch_tokens=int(get_setting("EMBEDDING_BATCH_TOKENS", 50_000)),
+    )
+
+def embedding_cache_stats() -> Dict[str, int]:
+    """Hit/miss và dung lượng của cache embeddings"""
+    cache = _embedding_cache()
+    return cache.stats() if cache is not None else {}
+
+def _query_embedding_cache():
+    """LRU trong RAM cho embedding câu hỏi, phía sau là cache trên đĩa"""
+    return get_query_cache(_embedding_cache(), max_entries=int(get_setting("QUERY_CACHE_ENTRIES", 1024)))
+
+def embed_query(query: str, embed_client=None) -> List[float]:
+    """Embedding của câu hỏi; câu hỏi lặp lại (sau chuẩn hoá) không gọi API"""
+    embed_client = embed_client or client
+    if embed_client is None:
+        raise Exception("OpenAI client is not initialized")
+
+    def _call(text: str) -> List[float]:
+        resp = embed_client.embeddings.create(model=EMBEDDING_MODEL, input=[text])
+        return resp.data[0].embedding
+
+    return _query_embedding_cache().get_or_embed(query, EMBEDDING_MODEL, EMBEDDING_DIM, _call)
+
+def query_cache_stats() -> Dict[str, float]:
+    """Hit rate và thời gian tiết kiệm của cache embedding câu hỏi"""
+    return _query_embedding_cache().stats()
+
+def get_embeddings(texts: List[str], batch_size: int = 100, use_cache: bool = True,
+                   events: Optional[EventSink] = None) -> List[List[float]]:
+    """Generate embeddings with progress tracking.
+
+    Text đã có trong cache (cùng nội dung, model, dimensions) không gửi lại
+    lên API; chỉ các cache miss mới được embed. batch_size là số input tối đa
+    mỗi request (batch còn bị giới hạn theo tổng số token). Tiến độ theo
+    batch và lỗi từng text gửi vào events (index theo ``texts``). Vẫn bị rate
+    limit sau khi đã chờ + thử lại thì ném lỗi thay vì trả vector 0.
+    """
+    events = events or NULL_SINK
     if client is None:
         raise Exception("OpenAI client is not initialized")
     
@@ -591,56 +718,55 @@ def get_embeddings(texts: List[str], batch_size: int = 100) -> List[List[float]]
             # Truncate very long texts (OpenAI limit ~8191 tokens)
             if len(text) > 30000:  # ~8000 tokens roughly
                 text = text[:30000]
-            valid_texts.append(text.strip())
+            valid_texts.append(normalize_text(text))
             text_indices.append(idx)
     
     if not valid_texts:
-        st.warning("No valid texts to embed. All texts are empty or invalid.")
+        events.warning("No valid texts to embed. All texts are empty or invalid.", stage="embed")
         # Return zero vectors for all
-        return [[0.0] * 1536 for _ in texts]
+        return [[0.0] * EMBEDDING_DIM for _ in texts]
     
     # Create result array with zero vectors
-    all_embeddings = [[0.0] * 1536 for _ in texts]
+    all_embeddings = [[0.0] * EMBEDDING_DIM for _ in texts]
+    
+    # Lấy sẵn từ cache, chỉ giữ lại các cache miss
+    cache = _embedding_cache(events) if use_cache else None
+    keys = [cache_key(t, EMBEDDING_MODEL, EMBEDDING_DIM) for t in valid_texts]
+    if cache is not None:
+        cached = cache.get_many(keys)
+        miss_texts, miss_indices, miss_keys = [], [], []
+        for text, idx, key in zip(valid_texts, text_indices, keys):
+            if key in cached:
+                all_embeddings[idx] = cached[key]
+            else:
+                miss_texts.append(text)
+                miss_indices.append(idx)
+                miss_keys.append(key)
+        valid_texts, text_indices, keys = miss_texts, miss_indices, miss_keys
+    
+    fresh: Dict[str, List[float]] = {}
     total = len(valid_texts)
     
-    for i in range(0, total, batch_size):
-        batch = valid_texts[i:i+batch_size]
-        batch_indices = text_indices[i:i+batch_size]
-        
-        if total > batch_size:
-            progress = min(1.0, (i + len(batch)) / total)
-            st.progress(progress, text=f"Generating embeddings... {i + len(batch)}/{total}")
-        
-        try:
-            resp = client.embeddings.create(
-                model="text-embedding-3-small",
-                input=batch
-            )
-            # Place embeddings at correct indices
-            for j, emb_data in enumerate(resp.data):
-                original_idx = batch_indices[j]
-                all_embeddings[original_idx] = emb_data.embedding
-                
-        except Exception as e:
-            st.error(f"Embedding batch {i//batch_size + 1} failed: {e}")
-            # Retry individual items in batch
-            for j, text in enumerate(batch):
-                original_idx = batch_indices[j]
-                try:
-                    # Double check text is valid before retry
-                    if not text or not text.strip():
-                        continue
-                    resp = client.embeddings.create(
-                        model="text-embedding-3-small",
-                        input=[text]
-                    )
-                    all_embeddings[original_idx] = resp.data[0].embedding
-                except Exception as retry_e:
-                    st.warning(f"Failed to embed text at index {original_idx}: {retry_e}")
-                    # Keep zero vector as fallback
-                    pass
-        
-        if i + batch_size < total:
-            time.sleep(0.1)
+    if total:
+        # Batch gói theo token, nhiều request song song, rate limit dùng chung
+        def _on_progress(done: int, n_batches: int) -> None:
+            events.progress(done, n_batches, f"Generating embeddings... batch {done}/{n_batches}")
+        
+        token_counts = [count_tokens(t) for t in valid_texts]
+        vectors, errors = _embedding_scheduler().embed(
+            valid_texts, token_counts, max_items=batch_size, on_progress=_on_progress
+        )
+        for original_idx, key, vec in zip(text_indices, keys, vectors):
+            if vec is not None:
+                all_embeddings[original_idx] = vec
+                fresh[key] = vec
+        # Keep zero vector as fallback cho các text lỗi; vị trí lỗi là trong danh sách miss
+        for pos, err in errors:
+            events.warning("Failed to embed text at index %d: %s" % (text_indices[pos], err),
+                           stage="embed", index=text_indices[pos])
+    
+    # Zero vector (lỗi) không được ghi vào cache
+    if cache is not None and fresh:
+        cache.put_many(fresh, EMBEDDING_MODEL, EMBEDDING_DIM)
     
     return all_embeddings
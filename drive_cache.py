@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Đồng bộ cache index (generation hiện tại) lên / xuống một folder Drive.
+
+Cache gồm đúng các file app load: segment + sidecar và manifest.json trong
+thư mục index của generation, file SQLite meta, và index_current.json. Tên
+trên Drive là đường dẫn tương đối (vd. ``faiss_index.g3/manifest.json``).
+
+- upload_index_cache(): chỉ upload file có md5 khác Drive (manifest upload
+  của drive_utils), pointer upload sau cùng, rồi xoá trên Drive các file của
+  generation cũ mà lần upload trước đã ghi.
+- download_index_cache(): pointer -> manifest + meta -> segment, file local
+  đã đúng md5 thì bỏ qua; pointer local chỉ được ghi khi đã đủ file.
+"""
+import json
+import os
+from typing import Any, Dict, List
+
+from drive_utils import delete_from_drive, download_files_from_drive, sync_files_to_drive, synced_names
+from index_store import MANIFEST_FILE, SIDECAR_IDS, SIDECAR_VECS
+from shared_index import (
+    INDEX_POINTER_FILE,
+    SharedIndex,
+    current_generation,
+    generation_paths,
+    publish_generation,
+)
+
+
+def _drive_name(path: str) -> str:
+    return os.path.normpath(path).replace(os.sep, "/")
+
+
+def _is_cache_name(name: str, index_dir: str, meta_path: str) -> bool:
+    """Tên Drive thuộc cache index (mọi generation)"""
+    index_dir = _drive_name(index_dir)
+    root, ext = os.path.splitext(_drive_name(meta_path))
+    return (name.startswith(index_dir + "/") or name.startswith(index_dir + ".g")
+            or name == root + ext or (name.startswith(root + ".g") and name.endswith(ext)))
+
+
+def index_cache_files(index_dir: str, meta_path: str, pointer_path: str = INDEX_POINTER_FILE) -> List[str]:
+    """File của generation hiện tại theo thứ tự upload (pointer cuối cùng)"""
+    gen = current_generation(index_dir, meta_path, pointer_path)
+    with open(os.path.join(gen["index_dir"], MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    paths = []
+    for seg in manifest["segments"]:
+        path = os.path.join(gen["index_dir"], seg["file"])
+        paths.append(path)
+        if seg.get("exact"):
+            paths.extend([path + SIDECAR_IDS, path + SIDECAR_VECS])
+    paths.extend([os.path.join(gen["index_dir"], MANIFEST_FILE), gen["meta_path"]])
+    if os.path.exists(pointer_path):
+        paths.append(pointer_path)
+    return paths
+
+
+def upload_index_cache(shared: SharedIndex, service: Any, folder_id: str, index_dir: str, meta_path: str,
+                       pointer_path: str = INDEX_POINTER_FILE) -> Dict[str, int]:
+    """Upload generation đang phục vụ; trả về {"uploaded", "skipped", "deleted"}.
+
+    Giữ writer() trong lúc upload để không có cập nhật / compaction nào sửa
+    file giữa chừng (reader vẫn truy vấn bình thường).
+    """
+    with shared.writer():
+        if shared.store is None:
+            return {"uploaded": 0, "skipped": 0, "deleted": 0}
+        # File .sqlite phải tự đủ, không phụ thuộc -wal
+        shared.store.store.checkpoint()
+        paths = index_cache_files(index_dir, meta_path, pointer_path)
+        names = [_drive_name(p) for p in paths]
+        synced = sync_files_to_drive(service, folder_id, paths, names=names)
+    stale = [n for n in synced_names(folder_id)
+             if n not in set(names) and _is_cache_name(n, index_dir, meta_path)]
+    deleted = delete_from_drive(service, folder_id, stale) if stale else 0
+    uploaded = sum(1 for r in synced.values() if r["uploaded"])
+    return {"uploaded": uploaded, "skipped": len(synced) - uploaded, "deleted": deleted}
+
+
+def download_index_cache(service: Any, folder_id: str, index_dir: str, meta_path: str,
+                         pointer_path: str = INDEX_POINTER_FILE) -> bool:
+    """Tải generation mà pointer trên Drive trỏ tới; False nếu Drive chưa có đủ cache"""
+    pointer_name = _drive_name(pointer_path)
+    remote_pointer = pointer_path + ".remote"
+    if download_files_from_drive(service, folder_id, {pointer_name: remote_pointer})[pointer_name] is None:
+        return False
+    try:
+        with open(remote_pointer, "r", encoding="utf-8") as f:
+            gen = generation_paths(int(json.load(f)["generation"]), index_dir, meta_path)
+    except (OSError, ValueError, KeyError):
+        return False
+    finally:
+        try:
+            os.remove(remote_pointer)
+        except OSError:
+            pass
+
+    manifest_path = os.path.join(gen["index_dir"], MANIFEST_FILE)
+    for suffix in ("-wal", "-shm"):
+        # WAL cũ của file meta sắp bị thay không còn khớp với nó
+        try:
+            os.remove(gen["meta_path"] + suffix)
+        except OSError:
+            pass
+    targets = {_drive_name(manifest_path): manifest_path, _drive_name(gen["meta_path"]): gen["meta_path"]}
+    if None in download_files_from_drive(service, folder_id, targets).values():
+        return False
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    targets = {}
+    for seg in manifest["segments"]:
+        path = os.path.join(gen["index_dir"], seg["file"])
+        for p in [path] + ([path + SIDECAR_IDS, path + SIDECAR_VECS] if seg.get("exact") else []):
+            targets[_drive_name(p)] = p
+    if targets and None in download_files_from_drive(service, folder_id, targets).values():
+        return False
+    publish_generation(gen, pointer_path)
+    return True
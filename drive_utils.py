@@ -3,32 +3,73 @@
 Includes upload/download for RAG cache files.
 ASCII-safe, Python 3.8+ compatible.
 """
-import io
+import hashlib
+import json
 import os
+import random
+import socket
+import ssl
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 
+import httplib2
+from google.auth.exceptions import TransportError
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from googleapiclient.http import MediaFileUpload
 
 SCOPES = [
     "https://www.googleapis.com/auth/drive",
 ]
 
+_thread_local = threading.local()
+
+# Explicit service account (ingest CLI --credentials); wins over secrets and env
+_credentials_override = None
+
+
+def _setting(name, default=None):
+    """Read a value from Streamlit secrets, falling back to the environment
+    (for the ingest CLI and cron jobs, which run without secrets.toml).
+    """
+    try:
+        if name in st.secrets:
+            return st.secrets[name]
+    except FileNotFoundError:
+        pass
+    return os.environ.get(name, default)
+
+
+def use_service_account(sa_json):
+    """Use these credentials (JSON string, dict, or key file path) instead of
+    GOOGLE_SERVICE_ACCOUNT_JSON from secrets or the environment.
+    Call before the first Drive request.
+    """
+    global _credentials_override
+    _credentials_override = sa_json
+    _service_account_credentials.clear()
+
+
 @st.cache_resource(show_spinner=False)
-def authenticate_drive():
-    """Authenticate using a service account JSON from Streamlit secrets.
-    Expect secrets.GOOGLE_SERVICE_ACCOUNT_JSON (string or dict-like).
+def _service_account_credentials():
+    """Load service account credentials from Streamlit secrets or the environment.
+    Expect GOOGLE_SERVICE_ACCOUNT_JSON (JSON string, dict-like, or a path to
+    the key file), unless use_service_account() was called.
     """
-    sa_json = st.secrets.get("GOOGLE_SERVICE_ACCOUNT_JSON", None)
+    sa_json = _credentials_override or _setting("GOOGLE_SERVICE_ACCOUNT_JSON", None)
     if not sa_json:
         raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is missing in secrets.")
 
+    if isinstance(sa_json, str) and not sa_json.lstrip().startswith("{") and os.path.isfile(sa_json):
+        with open(sa_json, "r", encoding="utf-8") as f:
+            sa_json = f.read()
+
     if isinstance(sa_json, str):
-        import json
         try:
             sa_info = json.loads(sa_json)
         except Exception as e:
@@ -46,21 +87,105 @@ def authenticate_drive():
         pk = pk.encode("utf-8").decode("unicode_escape")
         sa_info["private_key"] = pk
 
-    creds = service_account.Credentials.from_service_account_info(sa_info, scopes=SCOPES)
+    return service_account.Credentials.from_service_account_info(sa_info, scopes=SCOPES)
+
+
+@st.cache_resource(show_spinner=False)
+def authenticate_drive():
+    """Authenticate using a service account JSON from secrets or the environment."""
+    creds = _service_account_credentials()
     service = build("drive", "v3", credentials=creds, cache_discovery=False)
     return service
 
 
+def thread_local_service():
+    """Drive service owned by the calling thread.
+    The httplib2 transport behind a service object is not thread-safe, so
+    worker threads must not share the cached service from authenticate_drive.
+    """
+    service = getattr(_thread_local, "service", None)
+    if service is None:
+        creds = _service_account_credentials()
+        service = build("drive", "v3", credentials=creds, cache_discovery=False)
+        _thread_local.service = service
+    return service
+
+
+# Drive answers rate limiting with 429 or 403 + one of these reasons
+_QUOTA_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_MAX_BACKOFF = 64.0
+
+
+class _QuotaGate(object):
+    """Process-wide pause shared by every thread talking to Drive.
+
+    When one request is rate limited, all threads hold off until the
+    backoff expires instead of each one hammering the quota on its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self):
+        with self._lock:
+            delay = self._resume_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.time() + seconds)
+
+
+_quota_gate = _QuotaGate()
+
+
+def _error_reasons(err):
+    try:
+        details = json.loads(err.content.decode("utf-8"))["error"]
+        return [e.get("reason") for e in details.get("errors", [])]
+    except Exception:
+        return []
+
+
+def _retry_info(err):
+    """(retryable, is_quota, Retry-After seconds or None) for an exception."""
+    if isinstance(err, HttpError):
+        status = err.resp.status
+        is_quota = status == 429 or (status == 403 and any(r in _QUOTA_REASONS for r in _error_reasons(err)))
+        retry_after = None
+        try:
+            retry_after = float(err.resp.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+        return is_quota or status in _RETRY_STATUSES, is_quota, retry_after
+    # Transport errors (dropped connection, timeout, TLS reset)
+    if isinstance(err, (ConnectionError, socket.timeout, ssl.SSLError, httplib2.HttpLib2Error, TransportError)):
+        return True, False, None
+    return False, False, None
+
+
 def _retry(callable_fn, max_tries=3, base_delay=0.8):
-    last_err = None
+    """Call callable_fn, retrying transient Drive errors with jittered
+    exponential backoff. Rate-limit errors also pause every other Drive call
+    in the process (honouring Retry-After). Other errors (404, 401, bad
+    request) are raised at once.
+    """
     for i in range(max_tries):
+        _quota_gate.wait()
         try:
             return callable_fn()
         except Exception as e:
-            last_err = e
-            time.sleep(base_delay * (2 ** i))
-    if last_err:
-        raise last_err
+            retryable, is_quota, retry_after = _retry_info(e)
+            if not retryable or i == max_tries - 1:
+                raise
+            delay = retry_after or min(_MAX_BACKOFF, base_delay * (2 ** i)) * (0.5 + random.random())
+            if is_quota:
+                _quota_gate.pause(delay)
+            else:
+                time.sleep(delay)
 
 
 def format_file_size(size_str):
@@ -97,35 +222,230 @@ def list_files_in_folder(service, folder_id):
     return files
 
 
-def _find_file_by_name(service, folder_id, filename):
-    safe_name = filename.replace("'", "\'")
-    q = "'%s' in parents and name = '%s' and trashed = false" % (folder_id, safe_name)
-    fields = "files(id,name)"
+# ====== Incremental sync via the Drive changes feed ======
+
+SYNC_STATE_FILE = "drive_sync_state.json"
+_sync_lock = threading.Lock()
+_SYNC_FILE_FIELDS = "id,name,size,mimeType,modifiedTime,md5Checksum,parents,trashed"
+
+
+def get_start_page_token(service):
     def _call():
-        return service.files().list(q=q, fields=fields, pageSize=1).execute()
-    resp = _retry(_call)
-    files = resp.get("files", [])
-    if files:
-        return files[0]["id"]
-    return None
+        return service.changes().getStartPageToken().execute()
+    return _retry(_call)["startPageToken"]
+
+
+def list_changes(service, page_token):
+    """Return (changes, new_start_page_token) for everything after page_token."""
+    changes = []
+    fields = "nextPageToken, newStartPageToken, changes(fileId, removed, file(%s))" % _SYNC_FILE_FIELDS
+    while True:
+        def _call():
+            return service.changes().list(
+                pageToken=page_token, fields=fields, spaces="drive",
+                includeRemoved=True, pageSize=1000,
+            ).execute()
+        resp = _retry(_call)
+        changes.extend(resp.get("changes", []))
+        if resp.get("newStartPageToken"):
+            return changes, resp["newStartPageToken"]
+        page_token = resp.get("nextPageToken")
+        if not page_token:
+            # Should not happen; keep the last token so the next sync re-reads
+            return changes, None
+
+
+def load_sync_state(path=SYNC_STATE_FILE):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def save_sync_state(state, path=SYNC_STATE_FILE):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def _snapshot_entry(f):
+    return {k: f.get(k) for k in ("id", "name", "size", "mimeType", "modifiedTime", "md5Checksum")}
+
+
+def _is_content_change(old, new):
+    return (old.get("modifiedTime") != new.get("modifiedTime")
+            or old.get("md5Checksum") != new.get("md5Checksum"))
+
+
+def sync_folder(service, folder_id, state_path=SYNC_STATE_FILE):
+    """Bring the local snapshot of a folder up to date.
+
+    The first call (or a call for another folder) lists the folder once and
+    stores a changes.getStartPageToken cursor; later calls only read
+    changes.list since that cursor. Returns a dict with:
+      files    - current files in the folder, ordered by name
+      added    - files that appeared since the last sync
+      modified - files whose content changed in place (same id)
+      removed  - ids of files deleted, trashed or moved out of the folder
+    Calls are serialized within the process (the UI and the background
+    indexer both sync), so each change is reported exactly once.
+    """
+    with _sync_lock:
+        return _sync_folder(service, folder_id, state_path)
+
+
+def _sync_folder(service, folder_id, state_path):
+    state = load_sync_state(state_path)
+
+    if not state or state.get("folder_id") != folder_id or not state.get("cursor"):
+        # Take the cursor before listing so no change can fall in between
+        cursor = get_start_page_token(service)
+        listed = list_files_in_folder(service, folder_id)
+        known = {f["id"]: _snapshot_entry(f) for f in listed}
+        save_sync_state({"folder_id": folder_id, "cursor": cursor, "files": known}, state_path)
+        files = sorted(known.values(), key=lambda f: f.get("name") or "")
+        return {"files": files, "added": files, "modified": [], "removed": []}
+
+    old = state.get("files", {})
+    known = dict(old)
+    changes, new_cursor = list_changes(service, state["cursor"])
+    for ch in changes:
+        fid = ch.get("fileId")
+        f = ch.get("file") or {}
+        in_folder = (not ch.get("removed") and not f.get("trashed")
+                     and folder_id in (f.get("parents") or []))
+        if in_folder:
+            known[fid] = _snapshot_entry(f)
+        else:
+            known.pop(fid, None)
+
+    added = [known[i] for i in known if i not in old]
+    modified = [known[i] for i in known if i in old and _is_content_change(old[i], known[i])]
+    removed = [i for i in old if i not in known]
+
+    state["files"] = known
+    if new_cursor:
+        state["cursor"] = new_cursor
+    save_sync_state(state, state_path)
+
+    files = sorted(known.values(), key=lambda f: f.get("name") or "")
+    return {"files": files, "added": added, "modified": modified, "removed": removed}
+
 
+def _download_chunk_size():
+    return int(float(_setting("DRIVE_DOWNLOAD_CHUNK_MB", 8)) * 1024 * 1024)
 
-def download_file(service, file_id):
+
+def _md5_of_file(path, block_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5
+
+
+def _fetch_range(http, uri, headers, start, end):
+    """GET bytes [start, end] of a media URI; returns (status, content, total size or None)."""
+    headers = dict(headers)
+    headers["range"] = "bytes=%d-%d" % (start, end)
+    resp, content = http.request(uri, "GET", headers=headers)
+    if resp.status in (200, 206):
+        total = None
+        if "content-range" in resp:
+            total = int(resp["content-range"].rsplit("/", 1)[1])
+        elif "content-length" in resp:
+            total = int(resp["content-length"])
+        return resp.status, content, total
+    if resp.status == 416 and "content-range" in resp:
+        # Range not satisfiable: offset is already at (or past) the end
+        return resp.status, b"", int(resp["content-range"].rsplit("/", 1)[1])
+    raise HttpError(resp, content, uri=uri)
+
+
+def download_to_file(service, file_id, dest_path=None, chunk_size=None, expected_md5=None):
+    """Stream a Drive file to disk chunk by chunk; returns the local path.
+
+    Chunks are fetched with HTTP Range requests and appended to
+    "<dest>.part", so memory use is one chunk regardless of file size. A
+    failed chunk is retried from the same offset. When expected_md5 (Drive
+    md5Checksum) is given, a ".part" left behind by an earlier interrupted
+    call is resumed rather than restarted, the finished file is verified, and
+    a mismatch discards the partial data and downloads once more from
+    scratch. Without dest_path the file goes to a new temp file, which the
+    caller must delete.
+
+    chunk_size defaults to DRIVE_DOWNLOAD_CHUNK_MB (8 MB).
+    """
+    chunk_size = chunk_size or _download_chunk_size()
+    is_temp = dest_path is None
+    if is_temp:
+        fd, dest_path = tempfile.mkstemp(prefix="drive-", suffix=".download")
+        os.close(fd)
+    try:
+        return _download_to_file(service, file_id, dest_path, chunk_size, expected_md5)
+    except Exception:
+        if is_temp:
+            for path in (dest_path, dest_path + ".part"):
+                if os.path.exists(path):
+                    os.remove(path)
+        raise
+
+
+def _download_to_file(service, file_id, dest_path, chunk_size, expected_md5):
+    part_path = dest_path + ".part"
+    if not expected_md5 and os.path.exists(part_path):
+        # Cannot tell whether an old .part matches the current file version
+        os.remove(part_path)
     request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        def _step():
-            return downloader.next_chunk()
-        status, done = _retry(_step)
-    fh.seek(0)
-    return fh
-
-
-def upload_file(service, folder_id, local_path, mime_type="application/octet-stream"):
-    filename = os.path.basename(local_path)
-    file_id = _find_file_by_name(service, folder_id, filename)
+
+    for attempt in range(2):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        md5 = _md5_of_file(part_path) if offset and expected_md5 else hashlib.md5()
+        total = None
+        with open(part_path, "ab") as out:
+            while total is None or offset < total:
+                def _step():
+                    return _fetch_range(request.http, request.uri, request.headers,
+                                        offset, offset + chunk_size - 1)
+                status, content, total = _retry(_step, max_tries=6)
+                if status == 200 and offset:
+                    # Server ignored the range and sent the whole file: start over
+                    out.seek(0)
+                    out.truncate()
+                    md5 = hashlib.md5()
+                    offset = 0
+                if status == 416:
+                    break
+                out.write(content)
+                md5.update(content)
+                offset += len(content)
+                if total is None or not content:
+                    break
+
+        if total is not None and offset > total:
+            # Stale .part from an older version of the file
+            os.remove(part_path)
+            continue
+        if expected_md5 and md5.hexdigest() != expected_md5:
+            os.remove(part_path)
+            if attempt == 0:
+                continue
+            raise RuntimeError("Checksum mismatch for Drive file %s" % file_id)
+        os.replace(part_path, dest_path)
+        return dest_path
+    raise RuntimeError("Could not download Drive file %s" % file_id)
+
+
+def _upload(service, folder_id, local_path, mime_type, file_id, name=None):
+    """Update file_id in place, or create a new file when it is None (or gone).
+    Only a 404 on update falls back to create; any other error (quota,
+    permissions) is raised so a second copy is never created next to it.
+    """
+    filename = name or os.path.basename(local_path)
     media = MediaFileUpload(local_path, mimetype=mime_type, resumable=True)
 
     if file_id:
@@ -134,8 +454,9 @@ def upload_file(service, folder_id, local_path, mime_type="application/octet-str
                 return service.files().update(fileId=file_id, media_body=media, fields="id").execute()
             _retry(_upd)
             return file_id
-        except HttpError:
-            pass
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
 
     file_metadata = {"name": filename, "parents": [folder_id]}
     def _create():
@@ -144,37 +465,256 @@ def upload_file(service, folder_id, local_path, mime_type="application/octet-str
     return created["id"]
 
 
-# ====== Convenience helpers for RAG caches ======
+# ====== Upload manifest (Drive ids + md5 of synced cache files) ======
 
-def download_embeddings_from_drive(service, folder_id, embeddings_name="embeddings_meta.pkl", faiss_name="faiss_index.bin"):
-    """Try to download cache files from Drive into current working dir.
-    Returns a dict with local paths if found.
+UPLOAD_MANIFEST_FILE = "drive_upload_manifest.json"
+_LOOKUP_FIELDS = "id,name,md5Checksum,size,parents,trashed"
+_manifest_lock = threading.Lock()
+
+
+def load_upload_manifest(path=UPLOAD_MANIFEST_FILE):
+    """{"folders": {folder_id: {name: {"id", "md5"}}}, "local": {path: {"size", "mtime", "md5"}}}"""
+    manifest = load_sync_state(path) or {}
+    manifest.setdefault("folders", {})
+    manifest.setdefault("local", {})
+    return manifest
+
+
+def save_upload_manifest(manifest, path=UPLOAD_MANIFEST_FILE):
+    save_sync_state(manifest, path)
+
+
+def local_md5(path, manifest=None):
+    """md5 hex of a local file, reusing the value cached in the manifest
+    while the file's size and mtime are unchanged.
+    """
+    info = os.stat(path)
+    key = os.path.abspath(path)
+    cached = (manifest or {}).get("local", {}).get(key)
+    if cached and cached.get("size") == info.st_size and cached.get("mtime") == info.st_mtime:
+        return cached["md5"]
+    digest = _md5_of_file(path).hexdigest()
+    if manifest is not None:
+        _remember_local(manifest, path, digest)
+    return digest
+
+
+def _remember_local(manifest, path, md5):
+    info = os.stat(path)
+    manifest["local"][os.path.abspath(path)] = {"size": info.st_size, "mtime": info.st_mtime, "md5": md5}
+
+
+def _quote(value):
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def lookup_files(service, folder_id, names, manifest=None):
+    """Find files by name in a folder: {name: Drive metadata or None}.
+
+    Names whose id is in the manifest are fetched with one batch request
+    (files.get per id); the rest, plus ids that turn out to be deleted,
+    trashed or moved, with one files.list query. An all-known lookup is a
+    single HTTP round-trip.
     """
-    out = {"embeddings_path": None, "faiss_path": None}
+    known = (manifest or {}).get("folders", {}).get(folder_id, {})
+    found = {}
+    ids = dict((name, known[name]["id"]) for name in names if known.get(name, {}).get("id"))
+
+    if ids:
+        def _batch():
+            results, errors = {}, []
+
+            def _callback(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = response
+                elif not (isinstance(exception, HttpError) and exception.resp.status == 404):
+                    errors.append(exception)
 
-    emb_id = _find_file_by_name(service, folder_id, embeddings_name)
-    if emb_id:
-        buf = download_file(service, emb_id)
-        with open(embeddings_name, "wb") as f:
-            f.write(buf.getvalue())
-        out["embeddings_path"] = os.path.abspath(embeddings_name)
+            batch = service.new_batch_http_request(callback=_callback)
+            for name, file_id in ids.items():
+                batch.add(service.files().get(fileId=file_id, fields=_LOOKUP_FIELDS), request_id=name)
+            batch.execute()
+            if errors:
+                raise errors[0]
+            return results
 
-    faiss_id = _find_file_by_name(service, folder_id, faiss_name)
-    if faiss_id:
-        buf = download_file(service, faiss_id)
-        with open(faiss_name, "wb") as f:
-            f.write(buf.getvalue())
-        out["faiss_path"] = os.path.abspath(faiss_name)
+        for name, meta in _retry(_batch).items():
+            if not meta.get("trashed") and folder_id in (meta.get("parents") or []) and meta.get("name") == name:
+                found[name] = meta
 
+    missing = [name for name in names if name not in found]
+    if missing:
+        q = "'%s' in parents and trashed = false and (%s)" % (
+            _quote(folder_id), " or ".join("name = '%s'" % _quote(n) for n in missing))
+        fields = "files(%s)" % _LOOKUP_FIELDS
+
+        def _list():
+            return service.files().list(q=q, fields=fields, pageSize=100).execute()
+
+        for meta in _retry(_list).get("files", []):
+            found.setdefault(meta["name"], meta)
+    return dict((name, found.get(name)) for name in names)
+
+
+def _remember(manifest, folder_id, name, file_id, md5):
+    manifest["folders"].setdefault(folder_id, {})[name] = {"id": file_id, "md5": md5}
+
+
+def sync_files_to_drive(service, folder_id, paths, mime_type="application/octet-stream",
+                        manifest_path=UPLOAD_MANIFEST_FILE, names=None):
+    """Upload local files to the folder, skipping those whose md5 already
+    matches Drive's md5Checksum. Returns {path: {"id", "uploaded"}}.
+
+    Files are named after their basename unless names (one per path, e.g.
+    "faiss_index/manifest.json") is given. Paths are uploaded in order, so
+    a file that points at the others (an index pointer) should come last.
+    Drive ids and md5s are kept in a local manifest, so a sync where nothing
+    changed costs one batch lookup and no uploads.
+    """
+    if names is None:
+        names = [os.path.basename(p) for p in paths]
+    pairs = [(p, n) for p, n in zip(paths, names) if os.path.exists(p)]
+    out = {}
+    if not pairs:
+        return out
+    with _manifest_lock:
+        manifest = load_upload_manifest(manifest_path)
+        remote = lookup_files(service, folder_id, [n for _, n in pairs], manifest)
+        for path, name in pairs:
+            digest = local_md5(path, manifest)
+            meta = remote.get(name)
+            if meta is not None and meta.get("md5Checksum") == digest:
+                out[path] = {"id": meta["id"], "uploaded": False}
+            else:
+                file_id = _upload(service, folder_id, path, mime_type, meta["id"] if meta else None, name)
+                out[path] = {"id": file_id, "uploaded": True}
+            _remember(manifest, folder_id, name, out[path]["id"], digest)
+        save_upload_manifest(manifest, manifest_path)
     return out
 
 
-def upload_embeddings_to_drive(service, folder_id, embeddings_path="embeddings_meta.pkl", faiss_path="faiss_index.bin"):
-    """Upload (or update) cache files to Drive folder. Returns dict of file ids."
+def synced_names(folder_id, manifest_path=UPLOAD_MANIFEST_FILE):
+    """Names recorded in the manifest for the folder (uploaded or downloaded)."""
+    with _manifest_lock:
+        return sorted(load_upload_manifest(manifest_path)["folders"].get(folder_id, {}))
+
+
+def delete_from_drive(service, folder_id, names, manifest_path=UPLOAD_MANIFEST_FILE):
+    """Delete files this manifest knows by id (one batch request); files
+    already gone are ignored. Returns the number of names removed.
+    """
+    with _manifest_lock:
+        manifest = load_upload_manifest(manifest_path)
+        known = manifest["folders"].get(folder_id, {})
+        ids = dict((name, known[name]["id"]) for name in names if known.get(name, {}).get("id"))
+        if ids:
+            def _batch():
+                errors = []
+
+                def _callback(request_id, response, exception):
+                    if exception is not None and not (isinstance(exception, HttpError)
+                                                      and exception.resp.status == 404):
+                        errors.append(exception)
+
+                batch = service.new_batch_http_request(callback=_callback)
+                for name, file_id in ids.items():
+                    batch.add(service.files().delete(fileId=file_id), request_id=name)
+                batch.execute()
+                if errors:
+                    raise errors[0]
+
+            _retry(_batch)
+        for name in names:
+            known.pop(name, None)
+        save_upload_manifest(manifest, manifest_path)
+    return len(ids)
+
+
+class DownloadPool(object):
+    """Download many Drive files in parallel.
+
+    A fixed set of worker threads each owns its own Drive client (the
+    httplib2 transport is not thread-safe), so N transfers are in flight and
+    every worker keeps its connection alive from one file to the next.
+    Rate-limit responses pause all workers together (see _retry).
+
+        with DownloadPool(workers=8) as pool:
+            path = pool.download(f)          # blocking, from any thread
+            future = pool.submit(f)          # or asynchronous
+
+    Files are dicts with "id" and optionally "md5Checksum" (verified after
+    download). Downloads go to temp files unless dest_path is given; the
+    caller deletes them.
+    """
+
+    def __init__(self, workers=4, chunk_size=None, service_factory=None):
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self._service_factory = service_factory or thread_local_service
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="drive-download")
+
+    def _download(self, f, dest_path):
+        # Called on a pool thread: the factory hands out that thread's client
+        return download_to_file(self._service_factory(), f["id"], dest_path,
+                                chunk_size=self.chunk_size, expected_md5=f.get("md5Checksum"))
+
+    def submit(self, f, dest_path=None):
+        return self._executor.submit(self._download, f, dest_path)
+
+    def download(self, f, dest_path=None):
+        return self.submit(f, dest_path).result()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
+
+
+# ====== Convenience helpers for RAG caches ======
+
+def download_files_from_drive(service, folder_id, targets, manifest_path=UPLOAD_MANIFEST_FILE):
+    """Download files by name: targets is {Drive name: local path}.
+    Returns {Drive name: local path, or None when the file is not on Drive}.
+
+    All names are looked up together (see lookup_files); a local copy whose
+    md5 already matches Drive is kept without downloading.
     """
-    out = {"embeddings_id": None, "faiss_id": None}
-    if os.path.exists(embeddings_path):
-        out["embeddings_id"] = upload_file(service, folder_id, embeddings_path, mime_type="application/octet-stream")
-    if os.path.exists(faiss_path):
-        out["faiss_id"] = upload_file(service, folder_id, faiss_path, mime_type="application/octet-stream")
+    out = {}
+    with _manifest_lock:
+        manifest = load_upload_manifest(manifest_path)
+        remote = lookup_files(service, folder_id, list(targets), manifest)
+        for name, path in targets.items():
+            meta = remote.get(name)
+            out[name] = None
+            if meta is None:
+                continue
+            md5 = meta.get("md5Checksum")
+            if not (md5 and os.path.exists(path) and local_md5(path, manifest) == md5):
+                parent = os.path.dirname(path)
+                if parent:
+                    os.makedirs(parent, exist_ok=True)
+                # Streamed to disk (no in-memory copy); an interrupted download resumes
+                download_to_file(service, meta["id"], path, expected_md5=md5)
+                if md5:
+                    # Verified by download_to_file; no need to hash again
+                    _remember_local(manifest, path, md5)
+            _remember(manifest, folder_id, name, meta["id"], md5)
+            out[name] = os.path.abspath(path)
+        save_upload_manifest(manifest, manifest_path)
     return out
+
+
+def download_embeddings_from_drive(service, folder_id, embeddings_name="embeddings_meta.pkl", faiss_name="faiss_index.bin",
+                                   manifest_path=UPLOAD_MANIFEST_FILE):
+    """Download the legacy single-file cache (pickle + FAISS index) into the
+    current working dir, for migrating deployments that still have it.
+    Returns a dict with local paths if found.
+    """
+    paths = download_files_from_drive(service, folder_id, {embeddings_name: embeddings_name, faiss_name: faiss_name},
+                                      manifest_path=manifest_path)
+    return {"embeddings_path": paths.get(embeddings_name), "faiss_path": paths.get(faiss_name)}
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Cache embeddings trên đĩa (SQLite), địa chỉ hoá theo nội dung.
+
+Key = sha256(text đã chuẩn hoá + model + dimensions), nên text không đổi thì
+không phải gọi lại API, kể cả khi file được upload lại với Drive id mới.
+Cache có giới hạn dung lượng (xoá bớt các entry lâu không dùng nhất) và bộ
+đếm hit/miss.
+
+QueryEmbeddingCache thêm một tầng LRU trong RAM phía trước cache trên đĩa
+cho embedding của câu hỏi, để câu hỏi lặp lại không phải gọi API.
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+EMBEDDING_CACHE_FILE = "embedding_cache.sqlite"
+
+
+def normalize_text(text: str) -> str:
+    """Chuẩn hoá text trước khi hash và gửi lên API"""
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def normalize_query(text: str) -> str:
+    """Chuẩn hoá câu hỏi: NFC, chữ thường, gộp khoảng trắng"""
+    return re.sub(r"\s+", " ", normalize_text(text)).lower()
+
+
+def cache_key(text: str, model: str, dimensions: int) -> str:
+    """Key của một embedding: hash của text đã chuẩn hoá + model + dimensions"""
+    h = hashlib.sha256()
+    h.update(("%s\x00%d\x00" % (model, dimensions)).encode("utf-8"))
+    h.update(text.encode("utf-8"))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """Cache embeddings trong một file SQLite, an toàn khi gọi từ nhiều thread"""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_FILE, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT NOT NULL,"
+            " dims INTEGER NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " nbytes INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, keys: Iterable[str], count: bool = True) -> Dict[str, List[float]]:
+        """Lấy các embedding có trong cache; count=True thì cập nhật bộ đếm hit/miss"""
+        keys = list(keys)
+        found: Dict[str, List[float]] = {}
+        with self._lock:
+            # Giới hạn số tham số của một câu SQL
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._conn.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN (%s)" % ",".join("?" * len(part)),
+                    part,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype="float32").tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, k) for k in found],
+                )
+                self._conn.commit()
+            if count:
+                self.hits += sum(1 for k in keys if k in found)
+                self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def put_many(self, items: Dict[str, List[float]], model: str, dimensions: int) -> None:
+        """Ghi embeddings mới vào cache rồi xoá bớt nếu vượt dung lượng"""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vec in items.items():
+            blob = np.asarray(vec, dtype="float32").tobytes()
+            rows.append((key, model, dimensions, blob, len(blob), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dims, vector, nbytes, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+            self._total_bytes += sum(r[4] for r in rows)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Xoá các entry ít được dùng gần đây nhất cho tới khi còn ~90% max_bytes"""
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        if self._total_bytes <= target:
+            return
+        to_free = self._total_bytes - target
+        freed = 0
+        victims = []
+        for key, nbytes in self._conn.execute("SELECT key, nbytes FROM embeddings ORDER BY last_used"):
+            victims.append((key,))
+            freed += nbytes
+            if freed >= to_free:
+                break
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+        self._conn.commit()
+        self._total_bytes -= freed
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "size_bytes": self._total_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache: Optional[EmbeddingCache] = None
+_default_lock = threading.Lock()
+
+
+def get_default_cache(path: str = EMBEDDING_CACHE_FILE, max_bytes: int = 512 * 1024 * 1024) -> EmbeddingCache:
+    """Cache dùng chung trong process"""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache(path, max_bytes=max_bytes)
+        return _default_cache
+
+
+class QueryEmbeddingCache:
+    """Embedding câu hỏi: LRU trong process -> cache SQLite dùng chung -> API"""
+
+    def __init__(self, disk: Optional[EmbeddingCache], max_entries: int = 1024):
+        self.disk = disk
+        self.max_entries = max_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._avg_latency: Optional[float] = None
+        self._lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _record_hit(self) -> None:
+        # Thời gian tiết kiệm ước lượng bằng độ trễ trung bình của các lần gọi API
+        if self._avg_latency is not None:
+            self.saved_seconds += self._avg_latency
+
+    def get_or_embed(self, text: str, model: str, dimensions: int,
+                     embed_fn: Callable[[str], List[float]]) -> List[float]:
+        """Embedding của câu hỏi; embed_fn(text) chỉ được gọi khi cả hai tầng đều miss.
+
+        normalize_query() chỉ dùng cho key (câu hỏi khác hoa/thường, khoảng
+        trắng dùng chung một entry); API nhận text gốc (chỉ NFC + strip). Tra
+        cache trên đĩa không tính vào hit/miss của cache embeddings tài liệu.
+        """
+        key = cache_key(normalize_query(text), model, dimensions)
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                self.memory_hits += 1
+                self._record_hit()
+                return vector
+
+        found = self.disk.get_many([key], count=False) if self.disk is not None else {}
+        if key in found:
+            with self._lock:
+                self._remember(key, found[key])
+                self.disk_hits += 1
+                self._record_hit()
+            return found[key]
+
+        start = time.perf_counter()
+        vector = list(embed_fn(normalize_text(text)))
+        latency = time.perf_counter() - start
+        if self.disk is not None:
+            self.disk.put_many({key: vector}, model, dimensions)
+        with self._lock:
+            self._remember(key, vector)
+            self.misses += 1
+            self._avg_latency = latency if self._avg_latency is None else 0.8 * self._avg_latency + 0.2 * latency
+        return vector
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+                "saved_seconds": self.saved_seconds,
+                "entries": len(self._lru),
+            }
+
+
+_query_cache: Optional[QueryEmbeddingCache] = None
+
+
+def get_query_cache(disk: Optional[EmbeddingCache], max_entries: int = 1024) -> QueryEmbeddingCache:
+    """Cache embedding câu hỏi dùng chung trong process (mọi session)"""
+    global _query_cache
+    with _default_lock:
+        if _query_cache is None:
+            _query_cache = QueryEmbeddingCache(disk, max_entries=max_entries)
+        return _query_cache
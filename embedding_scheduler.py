@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Lập lịch gọi Embeddings API: gói batch theo số token, nhiều request song
+song, giới hạn requests/tokens mỗi phút dùng chung toàn process.
+
+- Batch được gói theo tổng số token (và số input tối đa), không cố định 100 item.
+- Token bucket cho RPM và TPM; khi gặp 429 thì tất cả worker cùng tạm dừng
+  (theo Retry-After nếu có, nếu không thì exponential backoff).
+- Batch lỗi được chia đôi và thử lại từng nửa thay vì gửi lại từng item.
+  Riêng 429 đã hết số lần thử thì không chia (chia chỉ nhân số request lên
+  một quota đang cạn): lỗi được ném ra cho bên gọi sau khi các batch khác xong.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class TokenBucket:
+    """Token bucket nạp lại đều theo phút; acquire() chặn tới khi đủ"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float) -> None:
+        # Request lớn hơn cả bucket thì chờ bucket đầy rồi cho qua
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait = (amount - self.available) / self.rate
+            time.sleep(min(wait, 1.0))
+
+
+class RateLimiter:
+    """Giới hạn requests/phút + tokens/phút, kèm tạm dừng chung khi bị 429"""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._pause_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, n_tokens: int) -> None:
+        while True:
+            with self._lock:
+                wait = self._pause_until - time.monotonic()
+            if wait <= 0:
+                break
+            time.sleep(wait)
+        self.requests.acquire(1)
+        self.tokens.acquire(n_tokens)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._pause_until = max(self._pause_until, time.monotonic() + seconds)
+
+
+def pack_batches(token_counts: List[int], max_tokens: int, max_items: int) -> List[List[int]]:
+    """Gói index các input thành batch liên tiếp, mỗi batch <= max_tokens và <= max_items"""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, n in enumerate(token_counts):
+        if current and (current_tokens + n > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += n
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _retry_after_seconds(err: Exception) -> Optional[float]:
+    """Đọc Retry-After từ response của lỗi 429 (nếu có)"""
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def _is_rate_limit(err: Exception) -> bool:
+    return getattr(err, "status_code", None) == 429 or type(err).__name__ == "RateLimitError"
+
+
+class EmbeddingScheduler:
+    """Chạy các batch embedding qua một thread pool dùng chung + RateLimiter"""
+
+    def __init__(self, client: Any, model: str, limiter: RateLimiter,
+                 concurrency: int = 4,
+                 max_batch_tokens: int = 50_000,
+                 max_retries: int = 6):
+        # Backoff do scheduler quản lý, tắt retry nội bộ của SDK
+        self.client = client.with_options(max_retries=0) if hasattr(client, "with_options") else client
+        self.model = model
+        self.limiter = limiter
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="embed")
+
+    def _request(self, texts: List[str], n_tokens: int) -> List[List[float]]:
+        """Một request; chờ + thử lại khi bị 429"""
+        attempt = 0
+        while True:
+            self.limiter.acquire(n_tokens)
+            try:
+                resp = self.client.embeddings.create(model=self.model, input=texts)
+                return [d.embedding for d in resp.data]
+            except Exception as e:
+                if not _is_rate_limit(e) or attempt >= self.max_retries:
+                    raise
+                delay = _retry_after_seconds(e)
+                if delay is None:
+                    delay = min(60.0, 2 ** attempt) * (0.5 + random.random())
+                self.limiter.pause(delay)
+                attempt += 1
+
+    def _run_batch(self, texts: List[str], token_counts: List[int], indices: List[int],
+                   out: Dict[int, List[float]], errors: List[Tuple[int, str]]) -> None:
+        """Embed một batch; lỗi thì chia đôi batch và thử lại từng nửa (trừ 429)"""
+        try:
+            vectors = self._request([texts[i] for i in indices], sum(token_counts[i] for i in indices))
+            if len(vectors) != len(indices):
+                raise RuntimeError("expected %d embeddings, got %d" % (len(indices), len(vectors)))
+            for i, v in zip(indices, vectors):
+                out[i] = v
+        except Exception as e:
+            if _is_rate_limit(e):
+                raise
+            if len(indices) == 1:
+                errors.append((indices[0], str(e)))
+                return
+            mid = len(indices) // 2
+            self._run_batch(texts, token_counts, indices[:mid], out, errors)
+            self._run_batch(texts, token_counts, indices[mid:], out, errors)
+
+    def embed(self, texts: List[str], token_counts: List[int], max_items: int = 2048,
+              on_progress: Optional[Callable[[int, int], None]] = None
+              ) -> Tuple[List[Optional[List[float]]], List[Tuple[int, str]]]:
+        """Embed toàn bộ texts; trả về (vectors theo đúng thứ tự, None nếu lỗi) và
+        danh sách lỗi (vị trí trong texts, thông báo).
+
+        Vẫn bị 429 sau max_retries thì ném lỗi đó (sau khi mọi batch đã dừng).
+        on_progress(done, total) được gọi trong thread của người gọi.
+        """
+        batches = pack_batches(token_counts, self.max_batch_tokens, max_items)
+        out: Dict[int, List[float]] = {}
+        errors: List[Tuple[int, str]] = []
+        futures = [self._pool.submit(self._run_batch, texts, token_counts, b, out, errors) for b in batches]
+        done = 0
+        failure: Optional[BaseException] = None
+        for fut in as_completed(futures):
+            if fut.exception() is not None:
+                failure = failure or fut.exception()
+                continue
+            done += 1
+            if on_progress:
+                on_progress(done, len(batches))
+        if failure is not None:
+            raise failure
+        return [out.get(i) for i in range(len(texts))], errors
+
+
+_default_scheduler: Optional[EmbeddingScheduler] = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler(client: Any, model: str,
+                  requests_per_minute: float = 3000,
+                  tokens_per_minute: float = 1_000_000,
+                  concurrency: int = 4,
+                  max_batch_tokens: int = 50_000) -> EmbeddingScheduler:
+    """Scheduler dùng chung trong process để mọi lời gọi chia sẻ cùng rate limit"""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            _default_scheduler = EmbeddingScheduler(
+                client, model, limiter,
+                concurrency=concurrency,
+                max_batch_tokens=max_batch_tokens,
+            )
+        return _default_scheduler
@@ -0,0 +1,616 @@
+# -*- coding: utf-8 -*-
+"""FAISS index chia segment + metadata gắn với chunk_id 64-bit ổn định.
+
+Trên đĩa index là một thư mục gồm các file segment ``seg-*.faiss`` (id của
+vector = chunk_id) và ``manifest.json`` liệt kê các segment đang dùng cùng
+loại index + tham số query của từng segment; metadata nằm trong MetaStore
+(SQLite).
+
+- Segment đã ghi là bất biến và được mở bằng mmap (IO_FLAG_MMAP_IFC), nên
+  thời gian khởi động gần như không phụ thuộc kích thước corpus và các process
+  dùng chung dữ liệu qua page cache.
+- Vector mới vào segment "active" trong RAM; save() ghi nó thành segment mới.
+- search() chạy trên từng segment rồi gộp top-k.
+- remove_files(): xoá meta của file, đánh dấu tombstone cho chunk_id;
+  search() bỏ qua các id tombstone.
+- compact(): gộp các segment thành một, bỏ hẳn vector tombstone (chạy nền
+  khi tombstone hoặc số segment đủ lớn). Segment gộp dùng loại index do
+  ann_index chọn theo kích thước corpus (Flat/HNSW/IVF), được train trên
+  một mẫu và tune nprobe/efSearch theo recall@k so với kết quả exact.
+- Segment IVF-PQ chỉ giữ vector đã nén, nên có thêm sidecar ``<segment>.ids.npy``
+  + ``<segment>.vecs.npy`` (float32 gốc, mở bằng mmap): compaction sau và
+  vectors() đọc vector exact từ đây thay vì giải nén.
+- save(): ghi segment + manifest rồi mới commit MetaStore, để meta không bao
+  giờ trỏ tới vector chưa được lưu.
+"""
+import json
+import os
+import threading
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from ann_index import (
+    choose_index_type,
+    create_index,
+    exact_topk,
+    index_spec,
+    index_type_of,
+    reconstruct,
+    search_params,
+    segment_ids,
+    training_size,
+    tune_search_params,
+)
+from meta_store import MetaStore, finish_migration, migrate_pickle
+
+META_FORMAT_VERSION = 3
+MANIFEST_FILE = "manifest.json"
+# Compact khi tombstone chiếm >= 10% số vector (hoặc quá nhiều về số lượng)
+COMPACT_MIN_RATIO = 0.1
+COMPACT_MAX_TOMBSTONES = 50_000
+# ... hoặc khi có quá nhiều segment nhỏ
+COMPACT_MAX_SEGMENTS = 8
+# Số vector đọc mỗi lần khi gộp segment
+_COMPACT_BLOCK = 65_536
+# Số query mẫu + k cho phép đo recall
+RECALL_QUERIES = 200
+RECALL_K = 10
+# Sidecar vector exact của segment nén có sai số (IVF-PQ)
+SIDECAR_IDS = ".ids.npy"
+SIDECAR_VECS = ".vecs.npy"
+
+
+def _open_segment(path: str):
+    """Mở segment bằng mmap; segment mở kiểu này chỉ được đọc, không được add"""
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if flag is not None:
+        try:
+            return faiss.read_index(path, flag)
+        except RuntimeError:
+            pass
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+def _max_vector_id(index) -> int:
+    if index is None or index.ntotal == 0:
+        return -1
+    return int(segment_ids(index).max())
+
+
+def _open_sidecar(index_dir: str, name: str) -> Tuple[np.ndarray, np.ndarray]:
+    """(ids, vectors float32) exact của segment, mở bằng mmap"""
+    path = os.path.join(index_dir, name)
+    return np.load(path + SIDECAR_IDS, mmap_mode="r"), np.load(path + SIDECAR_VECS, mmap_mode="r")
+
+
+def _remove_segment_files(index_dir: str, name: str) -> None:
+    for suffix in ("", SIDECAR_IDS, SIDECAR_VECS):
+        try:
+            os.remove(os.path.join(index_dir, name + suffix))
+        except OSError:
+            pass
+
+
+class _SidecarWriter:
+    """Ghi sidecar (ids, vectors) theo từng block vào file tạm; close() mới đổi tên"""
+
+    def __init__(self, index_dir: str, name: str, n: int, dim: int):
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, name)
+        self.ids = np.lib.format.open_memmap(self.path + SIDECAR_IDS + ".tmp", mode="w+",
+                                             dtype="int64", shape=(n,))
+        self.vecs = np.lib.format.open_memmap(self.path + SIDECAR_VECS + ".tmp", mode="w+",
+                                              dtype="float32", shape=(n, dim))
+        self.n = 0
+
+    def write(self, ids: np.ndarray, vecs: np.ndarray) -> None:
+        self.ids[self.n:self.n + len(ids)] = ids
+        self.vecs[self.n:self.n + len(ids)] = vecs
+        self.n += len(ids)
+
+    def close(self) -> None:
+        self.ids.flush()
+        self.vecs.flush()
+        self.ids = self.vecs = None
+        for suffix in (SIDECAR_IDS, SIDECAR_VECS):
+            os.replace(self.path + suffix + ".tmp", self.path + suffix)
+
+    def discard(self) -> None:
+        self.ids = self.vecs = None
+        for suffix in (SIDECAR_IDS, SIDECAR_VECS):
+            for path in (self.path + suffix + ".tmp", self.path + suffix):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class _Segment:
+    __slots__ = ("name", "index", "max_id", "spec", "params", "exact", "_ids", "_rows")
+
+    def __init__(self, name: str, index, max_id: int, spec: str = "Flat",
+                 params: Optional[Dict[str, Any]] = None,
+                 exact: Optional[Tuple[np.ndarray, np.ndarray]] = None):
+        self.name = name
+        self.index = index
+        self.max_id = max_id
+        self.spec = spec
+        # nprobe/efSearch đã tune lúc build + recall đo được
+        self.params = params or {}
+        # (ids, vectors) từ sidecar; None = vector trong index đã exact
+        self.exact = exact
+        self._ids = None
+        self._rows = None
+
+    def sorted_ids(self) -> np.ndarray:
+        """chunk_id trong segment (đã sort), tính một lần vì segment bất biến"""
+        if self._ids is None:
+            if self.exact is not None:
+                self._rows = np.argsort(self.exact[0], kind="stable")
+                self._ids = np.asarray(self.exact[0])[self._rows]
+            else:
+                self._ids = np.sort(segment_ids(self.index))
+        return self._ids
+
+    def vectors(self, ids: np.ndarray) -> np.ndarray:
+        """Vector exact của các id (phải có trong segment)"""
+        if self.exact is None:
+            return reconstruct(self.index, ids)
+        rows = self._rows_of(ids)
+        return np.ascontiguousarray(self.exact[1][rows], dtype="float32")
+
+    def _rows_of(self, ids: np.ndarray) -> np.ndarray:
+        sorted_ids = self.sorted_ids()
+        return self._rows[np.searchsorted(sorted_ids, ids)]
+
+
+class ChunkIndex:
+    """Index vector nhiều segment + meta theo chunk_id, có tombstone và compaction nền"""
+
+    def __init__(self, index_dir: str, store: MetaStore, dim: int,
+                 segments: Optional[List[_Segment]] = None, active=None):
+        self.index_dir = index_dir
+        self.store = store
+        self.dim = dim
+        self.segments: List[_Segment] = list(segments or [])
+        self.active = active if active is not None else self._empty_index()
+        # Vector đã ghi nhưng meta chưa commit (crash giữa chừng) vẫn giữ id của nó
+        self.next_id = max([int(store.get_state("next_id", 0)), store.max_chunk_id() + 1,
+                            _max_vector_id(self.active) + 1] + [s.max_id + 1 for s in self.segments])
+        # Mọi id < _active_min_id nằm trong các segment đã ghi
+        self._active_min_id = self.next_id if self.active.ntotal == 0 else 0
+        self.tombstones = set(store.tombstones())
+        self._obsolete: List[str] = []
+        self._selector = None
+        self._lock = threading.RLock()
+        self._compacting = False
+        self.configure_ann()
+
+    def configure_ann(self, index_type: str = "auto", nprobe: Optional[int] = None,
+                      ef_search: Optional[int] = None, recall_target: float = 0.95) -> None:
+        """Loại index cho segment gộp ("auto" = theo kích thước corpus) và tham số query.
+
+        nprobe/efSearch = None thì dùng giá trị đã tune của từng segment.
+        """
+        self.index_type = index_type
+        self.nprobe = nprobe or None
+        self.ef_search = ef_search or None
+        self.recall_target = recall_target
+
+    def _empty_index(self):
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+
+    # ---------- Construction / persistence ----------
+    @classmethod
+    def new(cls, dim: int, index_dir: str, meta_path: str) -> "ChunkIndex":
+        store = MetaStore(meta_path)
+        store.reset()
+        out = cls(index_dir, store, dim)
+        # Segment của index cũ bị xoá ở lần save() đầu tiên
+        manifest = cls._read_manifest(index_dir)
+        if manifest:
+            out._obsolete = [s["file"] for s in manifest["segments"]]
+        return out
+
+    @staticmethod
+    def _read_manifest(index_dir: str) -> Optional[Dict[str, Any]]:
+        path = os.path.join(index_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    @classmethod
+    def load(cls, index_dir: str, meta_path: str,
+             legacy_index_path: Optional[str] = None,
+             legacy_meta_path: Optional[str] = None) -> "ChunkIndex":
+        """Mở index đã lưu (mmap từng segment).
+
+        Lần đầu gặp định dạng cũ (một file FAISS + pickle meta) thì chuyển sang
+        thư mục segment + SQLite rồi đổi tên file cũ thành ``*.migrated``.
+        """
+        manifest = cls._read_manifest(index_dir)
+        if manifest is not None:
+            segments = [
+                _Segment(s["file"], _open_segment(os.path.join(index_dir, s["file"])), s["max_id"],
+                         s.get("spec", "Flat"), s.get("params"),
+                         _open_sidecar(index_dir, s["file"]) if s.get("exact") else None)
+                for s in manifest["segments"]
+            ]
+            store = MetaStore(meta_path)
+            store.backfill_derived()
+            return cls(index_dir, store, manifest["dim"], segments)
+
+        if not (legacy_index_path and os.path.exists(legacy_index_path)):
+            raise FileNotFoundError("No FAISS index in %s" % index_dir)
+        index = faiss.read_index(legacy_index_path)
+        store = MetaStore(meta_path)
+        migrate_meta = (store.get_state("version") is None and legacy_meta_path is not None
+                        and os.path.exists(legacy_meta_path))
+        try:
+            if migrate_meta:
+                payload = migrate_pickle(legacy_meta_path, store)
+                if payload.get("legacy_list"):
+                    # Định dạng cũ: vị trí dòng trong IndexFlatIP là liên kết duy nhất tới meta
+                    n = index.ntotal
+                    if n != len(payload["rows"]):
+                        raise ValueError("Index has %d vectors but meta has %d rows" % (n, len(payload["rows"])))
+                    wrapped = faiss.IndexIDMap2(faiss.IndexFlatIP(index.d))
+                    if n:
+                        wrapped.add_with_ids(index.reconstruct_n(0, n), np.arange(n, dtype="int64"))
+                    index = wrapped
+        except Exception:
+            store.rollback()
+            store.close()
+            raise
+        out = cls(index_dir, store, index.d, active=index)
+        out.save()
+        if migrate_meta:
+            finish_migration(legacy_meta_path)
+        finish_migration(legacy_index_path)
+        return out
+
+    @staticmethod
+    def _segment_name() -> str:
+        return "seg-%s.faiss" % uuid.uuid4().hex[:16]
+
+    def _write_segment(self, index, spec: str = "Flat",
+                       params: Optional[Dict[str, Any]] = None,
+                       name: Optional[str] = None, exact: bool = False) -> _Segment:
+        """Ghi một index thành file segment mới rồi mở lại bằng mmap.
+
+        exact=True: sidecar của ``name`` đã được ghi (xem _SidecarWriter).
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        name = name or self._segment_name()
+        path = os.path.join(self.index_dir, name)
+        faiss.write_index(index, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return _Segment(name, _open_segment(path), _max_vector_id(index), spec, params,
+                        _open_sidecar(self.index_dir, name) if exact else None)
+
+    def save(self) -> None:
+        """Ghi segment active (nếu có) + manifest, rồi commit meta"""
+        with self._lock:
+            if self.active.ntotal:
+                self.segments.append(self._write_segment(self.active))
+                self.active = self._empty_index()
+                self._active_min_id = self.next_id
+            os.makedirs(self.index_dir, exist_ok=True)
+            manifest = {
+                "version": 1,
+                "dim": self.dim,
+                "segments": [{"file": s.name, "count": int(s.index.ntotal), "max_id": s.max_id,
+                              "spec": s.spec, "params": s.params, "exact": s.exact is not None}
+                             for s in self.segments],
+            }
+            path = os.path.join(self.index_dir, MANIFEST_FILE)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            os.replace(path + ".tmp", path)
+            self.store.set_state("next_id", self.next_id)
+            self.store.set_state("version", META_FORMAT_VERSION)
+            self.store.commit()
+
+            # Segment cũ chỉ bị xoá sau khi manifest mới đã thay thế manifest cũ
+            for name in self._obsolete:
+                _remove_segment_files(self.index_dir, name)
+            self._obsolete = []
+
+    # ---------- Read ----------
+    def __len__(self) -> int:
+        return self.store.count()
+
+    @property
+    def ntotal(self) -> int:
+        """Tổng số vector (kể cả tombstone) trong mọi segment"""
+        return sum(s.index.ntotal for s in self.segments) + self.active.ntotal
+
+    def file_ids(self) -> set:
+        return set(self.store.file_modified_times())
+
+    def file_modified_times(self) -> Dict[str, Any]:
+        """file_id -> modified_time của bản đã index"""
+        return self.store.file_modified_times()
+
+    def content_type_counts(self) -> Dict[str, int]:
+        return self.store.content_type_counts()
+
+    def texts(self, chunk_ids: List[int]) -> Dict[int, str]:
+        return self.store.texts(chunk_ids)
+
+    def _search_ids(self, q: np.ndarray, k: int) -> List[Tuple[float, int]]:
+        """Top-k (score, chunk_id) gộp từ mọi segment; gọi khi đang giữ lock"""
+        sel = None
+        if self.tombstones:
+            if self._selector is None:
+                dead = np.fromiter(self.tombstones, dtype="int64", count=len(self.tombstones))
+                batch = faiss.IDSelectorBatch(dead)
+                # Giữ tham chiếu tới batch để selector không trỏ tới object đã bị giải phóng
+                self._selector = (batch, faiss.IDSelectorNot(batch))
+            sel = self._selector[1]
+        parts = []
+        for seg in self.segments:
+            if seg.index.ntotal:
+                params = search_params(seg.index, sel,
+                                       nprobe=self.nprobe or seg.params.get("nprobe"),
+                                       ef_search=self.ef_search or seg.params.get("efSearch"))
+                parts.append(seg.index.search(q, k, params=params))
+        if self.active.ntotal:
+            parts.append(self.active.search(q, k, params=search_params(self.active, sel)))
+        if not parts:
+            return []
+        D = np.concatenate([p[0][0] for p in parts])
+        I = np.concatenate([p[1][0] for p in parts])
+        order = np.argsort(-D, kind="stable")[:k]
+        return [(float(D[j]), int(I[j])) for j in order if I[j] >= 0]
+
+    def search_ids(self, qvec: np.ndarray, k: int) -> List[Tuple[float, int]]:
+        """Top-k (similarity, chunk_id) theo vector, không đọc meta"""
+        with self._lock:
+            return self._search_ids(qvec.reshape(1, -1).astype("float32"), k)
+
+    def search(self, qvec: np.ndarray, k: int, with_text: bool = True) -> List[Tuple[float, Dict[str, Any]]]:
+        """Top-k (similarity, meta) trên mọi segment, bỏ qua chunk đã tombstone"""
+        with self._lock:
+            hits = self._search_ids(qvec.reshape(1, -1).astype("float32"), k)
+            rows = self.store.get([c for _, c in hits], with_text=with_text)
+            return [(score, rows[cid]) for score, cid in hits if cid in rows]
+
+    def lexical_search(self, query: str, k: int) -> List[Tuple[float, int]]:
+        """Top-k (điểm BM25, chunk_id) theo từ khoá"""
+        return self.store.lexical.search(query, k)
+
+    def rows(self, chunk_ids: List[int], with_text: bool = True) -> Dict[int, Dict[str, Any]]:
+        return self.store.get(chunk_ids, with_text=with_text)
+
+    def features(self, chunk_ids: List[int]) -> Dict[str, Any]:
+        return self.store.features(chunk_ids)
+
+    def vectors(self, chunk_ids: List[int]) -> np.ndarray:
+        """Vector (float32, theo thứ tự chunk_ids) lấy lại từ segment chứa từng id"""
+        ids = np.asarray(chunk_ids, dtype="int64")
+        out = np.zeros((len(ids), self.dim), dtype="float32")
+        found = np.zeros(len(ids), dtype=bool)
+        with self._lock:
+            for seg in self.segments:
+                seg_ids = seg.sorted_ids()
+                pos = np.searchsorted(seg_ids, ids)
+                mask = ~found & (pos < len(seg_ids))
+                mask[mask] = seg_ids[pos[mask]] == ids[mask]
+                if mask.any():
+                    out[mask] = seg.vectors(ids[mask])
+                    found |= mask
+            if not found.all() and self.active.ntotal:
+                active_ids = segment_ids(self.active)
+                mask = ~found & np.isin(ids, active_ids)
+                if mask.any():
+                    out[mask] = reconstruct(self.active, ids[mask])
+        return out
+
+    def recall_check(self, k: int = RECALL_K, n_queries: int = 100) -> float:
+        """recall@k của search() hiện tại so với tìm kiếm exact trên toàn bộ vector còn sống.
+
+        Chỉ chụp danh sách segment + segment active dưới lock; phép quét exact
+        (toàn corpus) chạy ngoài lock nên search() của session khác không bị
+        chặn. Segment IVF-PQ có sidecar nên phép đo gồm cả sai số nén.
+        """
+        with self._lock:
+            sources = list(self.segments)
+            dead_arr = np.fromiter(self.tombstones, dtype="int64", count=len(self.tombstones))
+            if self.active.ntotal:
+                active_ids = segment_ids(self.active)
+                sources.append(_Segment("", None, -1, exact=(active_ids, reconstruct(self.active, active_ids))))
+        live = self._live_ids(sources, dead_arr)
+        queries = self._sample_vectors(live, n_queries)
+        if not len(queries):
+            return 1.0
+        truth = exact_topk(queries, ((ids, vecs) for _, ids, vecs in self._live_blocks(live)), k)
+        hits = total = 0
+        for q, expected in zip(queries, truth):
+            expected = set(int(x) for x in expected if x >= 0)
+            found = {cid for _, cid in self.search_ids(q, k)}
+            hits += len(expected & found)
+            total += len(expected)
+        return hits / total if total else 1.0
+
+    # ---------- Write ----------
+    def add(self, vectors: np.ndarray, rows: List[Dict[str, Any]]) -> List[int]:
+        """Thêm vectors (đã normalize) + meta vào segment active; trả về chunk_id được cấp"""
+        if len(rows) == 0:
+            return []
+        with self._lock:
+            ids = np.arange(self.next_id, self.next_id + len(rows), dtype="int64")
+            self.active.add_with_ids(np.ascontiguousarray(vectors, dtype="float32"), ids)
+            self.next_id += len(rows)
+            self.store.insert([dict(row, chunk_id=cid) for cid, row in zip(ids.tolist(), rows)])
+            return ids.tolist()
+
+    def remove_files(self, file_ids: Iterable[str]) -> int:
+        """Tombstone toàn bộ chunks của các file; trả về số chunk bị xoá"""
+        with self._lock:
+            removed = self.store.delete_files(file_ids)
+            if removed:
+                self.tombstones.update(removed)
+                self.store.add_tombstones(removed)
+                self._selector = None
+        return len(removed)
+
+    def _desired_spec(self, n_live: int) -> str:
+        index_type = choose_index_type(n_live) if self.index_type == "auto" else self.index_type
+        return index_spec(index_type, n_live, self.dim)
+
+    def needs_compaction(self) -> bool:
+        n = len(self.tombstones)
+        if len(self.segments) > COMPACT_MAX_SEGMENTS:
+            return True
+        if n > 0 and (n >= COMPACT_MAX_TOMBSTONES or n >= COMPACT_MIN_RATIO * max(self.ntotal, 1)):
+            return True
+        # Corpus đã lớn tới mức segment chính nên đổi loại index (vd. Flat -> HNSW)
+        if self.segments:
+            base = max(self.segments, key=lambda seg: seg.index.ntotal)
+            return base.spec != self._desired_spec(self.ntotal - n)
+        return False
+
+    @staticmethod
+    def _live_ids(sources: List[_Segment], dead_arr: np.ndarray) -> List[Tuple[_Segment, np.ndarray]]:
+        """(segment, id còn sống) của từng segment; id theo thứ tự sidecar nếu có"""
+        live = []
+        for seg in sources:
+            if seg.exact is None and seg.index.ntotal == 0:
+                continue
+            ids = np.asarray(seg.exact[0]) if seg.exact is not None else segment_ids(seg.index)
+            live.append((seg, ids[~np.isin(ids, dead_arr)]))
+        return live
+
+    @staticmethod
+    def _live_blocks(live: List[Tuple[_Segment, np.ndarray]]):
+        """Duyệt (segment, ids, vectors exact) theo block"""
+        for seg, ids in live:
+            for start in range(0, len(ids), _COMPACT_BLOCK):
+                block = ids[start:start + _COMPACT_BLOCK]
+                yield seg, block, seg.vectors(block)
+
+    @staticmethod
+    def _sample_vectors(live: List[Tuple[_Segment, np.ndarray]], n: int) -> np.ndarray:
+        """Mẫu ngẫu nhiên (cố định seed) n vector còn sống"""
+        total = sum(len(ids) for _, ids in live)
+        if total == 0 or n <= 0:
+            return np.empty((0, 0), dtype="float32")
+        picks = np.sort(np.random.default_rng(0).choice(total, size=min(n, total), replace=False))
+        parts = []
+        offset = 0
+        for seg, ids in live:
+            local = picks[(picks >= offset) & (picks < offset + len(ids))] - offset
+            if len(local):
+                parts.append(seg.vectors(ids[local]))
+            offset += len(ids)
+        return np.ascontiguousarray(np.vstack(parts), dtype="float32")
+
+    @staticmethod
+    def _fill(target, base: Optional[_Segment], live: List[Tuple[_Segment, np.ndarray]],
+              sidecar: Optional[_SidecarWriter]):
+        """Thêm vector vào index gộp (trừ segment base dùng lại) + ghi sidecar;
+        trả lại từng block (ids, vectors) để tính top-k exact cho recall"""
+        for seg, ids, vecs in ChunkIndex._live_blocks(live):
+            if base is None or seg is not base:
+                target.add_with_ids(vecs, ids)
+            if sidecar is not None:
+                sidecar.write(ids, vecs)
+            yield ids, vecs
+
+    def compact(self) -> int:
+        """Gộp các segment đã ghi thành một, bỏ vector tombstone; trả về số vector đã xoá.
+
+        Segment gộp dùng loại index theo kích thước corpus. Nếu segment lớn
+        nhất đã đúng loại thì dùng lại nó (không train lại), chỉ xoá tombstone
+        và thêm vector của các segment khác. Vector luôn lấy bản exact (sidecar
+        với IVF-PQ) nên gộp nhiều lần không cộng dồn sai số nén. Phần nặng chạy
+        ngoài lock nên search/add vẫn tiếp tục; segment mới chỉ vào manifest ở
+        lần save() kế tiếp.
+        """
+        with self._lock:
+            snapshot = list(self.segments)
+            boundary = self._active_min_id
+            dead = {t for t in self.tombstones if t < boundary}
+        if not snapshot:
+            return 0
+        total = sum(seg.index.ntotal for seg in snapshot)
+        spec = self._desired_spec(total - len(dead))
+        if len(snapshot) == 1 and not dead and snapshot[0].spec == spec:
+            return 0
+
+        dead_arr = np.fromiter(dead, dtype="int64", count=len(dead))
+        live = self._live_ids(snapshot, dead_arr)
+        n_live = sum(len(ids) for _, ids in live)
+        base = None
+        candidates = [seg for seg in snapshot if seg.spec == spec]
+        if candidates:
+            base = max(candidates, key=lambda seg: seg.index.ntotal)
+            # HNSW không hỗ trợ remove_ids
+            if spec.startswith("HNSW") and np.isin(segment_ids(base.index), dead_arr).any():
+                base = None
+        if base is not None:
+            target = faiss.read_index(os.path.join(self.index_dir, base.name))
+            if len(dead_arr):
+                target.remove_ids(faiss.IDSelectorBatch(dead_arr))
+        else:
+            target = create_index(spec, self.dim)
+            n_train = training_size(target)
+            if n_train:
+                target.train(self._sample_vectors(live, n_train))
+
+        queries = self._sample_vectors(live, RECALL_QUERIES)
+        name = self._segment_name()
+        # Index nén có sai số: giữ vector gốc cho lần gộp sau và cho vectors()
+        lossy = n_live > 0 and index_type_of(target) == "ivf_pq"
+        sidecar = _SidecarWriter(self.index_dir, name, n_live, self.dim) if lossy else None
+        try:
+            blocks = self._fill(target, base, live, sidecar)
+            if len(queries):
+                truth = exact_topk(queries, blocks, RECALL_K)
+                params = tune_search_params(target, queries, truth, RECALL_K, self.recall_target)
+            else:
+                for _ in blocks:
+                    pass
+                params = {}
+            if sidecar is not None:
+                sidecar.close()
+            removed = total - target.ntotal
+            new_seg = self._write_segment(target, spec, params, name, exact=lossy) if target.ntotal else None
+        except BaseException:
+            if sidecar is not None:
+                sidecar.discard()
+            raise
+        # Giải phóng index gộp trong RAM (đã ghi ra đĩa + mở lại bằng mmap)
+        del target
+
+        with self._lock:
+            names = {s.name for s in snapshot}
+            self.segments = ([new_seg] if new_seg else []) + [s for s in self.segments if s.name not in names]
+            self._obsolete.extend(names)
+            self.tombstones -= dead
+            self.store.clear_tombstones(dead)
+            self._selector = None
+        return int(removed)
+
+    def compact_in_background(self, on_done: Optional[Any] = None) -> bool:
+        """Chạy compact() trên thread nền nếu cần; on_done(self) gọi sau khi xong"""
+        with self._lock:
+            if self._compacting or not self.needs_compaction():
+                return False
+            self._compacting = True
+
+        def _run():
+            try:
+                self.compact()
+                if on_done is not None:
+                    on_done(self)
+            finally:
+                self._compacting = False
+
+        threading.Thread(target=_run, name="faiss-compaction", daemon=True).start()
+        return True
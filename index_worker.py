@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Worker nền cập nhật index theo hàng đợi job, tách khỏi lượt chạy script
+của từng session Streamlit.
+
+- submit() đưa job vào hàng đợi (mỗi loại job chỉ chờ một bản), thread nền
+  chạy lần lượt từng job; session đóng hay chuyển trang không làm job dừng.
+- Khi hàng đợi rỗng quá poll_interval giây, worker tự tạo job poll_kind
+  (vd. đồng bộ Drive) nên vẫn cập nhật khi không có ai mở app (sau khi
+  worker đã được tạo).
+- JobProgress giữ tiến độ, ETA và các thông báo của job để UI hiển thị.
+"""
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Số thông báo giữ lại cho mỗi job
+MAX_MESSAGES = 50
+
+
+class JobProgress:
+    """Tiến độ + thông báo của một job; an toàn khi gọi từ nhiều thread"""
+
+    def __init__(self, job: Dict[str, Any]):
+        self.job = job
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.done = 0
+        self.total = 0
+        self.text = ""
+        self.error: Optional[str] = None
+        self.messages: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def set_total(self, total: int, text: str = "") -> None:
+        with self._lock:
+            self.total, self.done, self.text = total, 0, text
+
+    def update(self, done: int, text: str = "") -> None:
+        with self._lock:
+            self.done = done
+            if text:
+                self.text = text
+
+    def _log(self, level: str, message: str) -> None:
+        with self._lock:
+            self.messages.append({"level": level, "message": message, "time": time.time()})
+            del self.messages[:-MAX_MESSAGES]
+
+    def info(self, message: str) -> None:
+        self._log("info", message)
+
+    def success(self, message: str) -> None:
+        self._log("success", message)
+
+    def warning(self, message: str) -> None:
+        self._log("warning", message)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Trạng thái hiện tại; eta (giây) ước lượng theo tốc độ trung bình từ lúc bắt đầu"""
+        with self._lock:
+            end = self.finished or time.time()
+            elapsed = end - self.started
+            eta = None
+            if self.finished is None and 0 < self.done < self.total:
+                eta = elapsed / self.done * (self.total - self.done)
+            return {
+                "kind": self.job["kind"],
+                "scheduled": self.job.get("scheduled", False),
+                "done": self.done,
+                "total": self.total,
+                "text": self.text,
+                "elapsed": elapsed,
+                "eta": eta,
+                "finished": self.finished,
+                "error": self.error,
+                "messages": list(self.messages),
+            }
+
+
+class IndexWorker:
+    """Một thread nền chạy run_job(job, progress) cho từng job trong hàng đợi"""
+
+    def __init__(self, run_job: Callable[[Dict[str, Any], JobProgress], None],
+                 poll_interval: float = 0.0, poll_kind: str = "update"):
+        self.run_job = run_job
+        self.poll_interval = poll_interval
+        self.poll_kind = poll_kind
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._current: Optional[JobProgress] = None
+        self._last: Optional[JobProgress] = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, name="index-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, kind: str, **params: Any) -> bool:
+        """Thêm job; False nếu đã có job cùng loại đang chờ"""
+        with self._lock:
+            if kind in self._pending:
+                return False
+            job = {"kind": kind, "params": params, "submitted": time.time()}
+            self._pending[kind] = job
+        self._queue.put(job)
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        """{"running": snapshot | None, "pending": [loại job], "last": snapshot | None}"""
+        with self._lock:
+            current, last = self._current, self._last
+            pending = list(self._pending)
+        return {
+            "running": current.snapshot() if current is not None else None,
+            "pending": pending,
+            "last": last.snapshot() if last is not None else None,
+        }
+
+    def _next_job(self) -> JobProgress:
+        """Lấy job kế tiếp và đánh dấu đang chạy.
+
+        Bỏ khỏi _pending và gán _current trong cùng một lần giữ lock, nên
+        status() không bao giờ thấy job ở ngoài cả hai.
+        """
+        try:
+            job = self._queue.get(timeout=self.poll_interval or None)
+        except queue.Empty:
+            job = {"kind": self.poll_kind, "params": {}, "submitted": time.time(), "scheduled": True}
+        progress = JobProgress(job)
+        with self._lock:
+            if not job.get("scheduled"):
+                self._pending.pop(job["kind"], None)
+            self._current = progress
+        return progress
+
+    def _loop(self) -> None:
+        while True:
+            progress = self._next_job()
+            job = progress.job
+            try:
+                self.run_job(job, progress)
+            except Exception as e:  # job lỗi không được làm chết worker
+                progress.error = str(e) or e.__class__.__name__
+            finally:
+                progress.finished = time.time()
+                with self._lock:
+                    self._current = None
+                    self._last = progress
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Cập nhật index từ một danh sách file, không phụ thuộc UI.
+
+Dùng chung cho worker nền của app Streamlit và CLI ingest (ingest_cli.py):
+download -> parse + chunk -> embed (ingest_pipeline), rồi áp dụng vào
+SharedIndex: cập nhật tại chỗ trong một lần khoá ghi, hoặc dựng generation
+mới rồi hot-swap. Với copy_on_write (CLI ghi index cho app ở process khác),
+generation đã publish không bao giờ bị sửa. ``progress`` là đối tượng có set_total / update / info /
+success / warning (vd. index_worker.JobProgress).
+
+Mỗi file là dict kiểu Drive: ``id``, ``name``, ``modifiedTime``; download_fn(file)
+trả về đường dẫn file local, release_fn(path) (tuỳ chọn) dọn file tạm sau khi parse.
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from document_processors import get_embeddings
+from index_store import ChunkIndex
+from ingest_pipeline import run_ingest_pipeline
+from progress_events import EventSink
+from shared_index import (
+    SharedIndex,
+    copy_generation,
+    current_generation,
+    next_generation,
+    publish_generation,
+    remove_generation,
+    remove_generations_before,
+)
+
+# File cache local (app Streamlit chỉ load những file này)
+META_DB_FILE = "embeddings_meta.sqlite"
+FAISS_INDEX_DIR = "faiss_index"
+EMBEDDINGS_FILE = "embeddings_meta.pkl"  # định dạng cũ, chỉ dùng để migrate
+FAISS_INDEX_FILE = "faiss_index.bin"  # định dạng cũ (một file), chỉ dùng để migrate
+
+SUPPORTED_EXTENSIONS = (".pdf", ".pptx")
+
+
+def is_supported(f: Dict[str, Any]) -> bool:
+    return f.get("name", "").lower().endswith(SUPPORTED_EXTENSIONS)
+
+
+def load_index(index_dir: str = FAISS_INDEX_DIR, meta_path: str = META_DB_FILE) -> Optional[ChunkIndex]:
+    """Index của generation hiện tại trên đĩa (migrate định dạng cũ nếu cần); None nếu chưa có"""
+    gen = current_generation(index_dir, meta_path)
+    has_meta = os.path.exists(gen["meta_path"]) or os.path.exists(EMBEDDINGS_FILE)
+    has_index = os.path.isdir(gen["index_dir"]) or os.path.exists(FAISS_INDEX_FILE)
+    if not (has_meta and has_index):
+        return None
+    try:
+        return ChunkIndex.load(gen["index_dir"], gen["meta_path"],
+                               legacy_index_path=FAISS_INDEX_FILE, legacy_meta_path=EMBEDDINGS_FILE)
+    except Exception:
+        return None
+
+
+def stale_file_ids(store: ChunkIndex, files: List[Dict[str, Any]]) -> set:
+    """file_id trong index đã bị sửa tại chỗ (modifiedTime khác) hoặc không còn trong nguồn"""
+    current = {f["id"]: f.get("modifiedTime") for f in files}
+    return {
+        fid for fid, mtime in store.file_modified_times().items()
+        if fid not in current or current[fid] != mtime
+    }
+
+
+def embed_files(files: List[Dict[str, Any]], download_fn: Callable[[Dict[str, Any]], str],
+                progress: Any, download_workers: int = 4, parse_workers: int = 2, embed_workers: int = 4,
+                chunk_size: int = 1000, chunk_overlap: int = 200,
+                release_fn: Optional[Callable[[str], None]] = None
+                ) -> Tuple[Optional[np.ndarray], List[Dict[str, Any]], Dict[str, int]]:
+    """Download / parse / chunk / embed các file.
+
+    Trả về (vectors đã normalize hoặc None, meta rows, {"failed", "bytes",
+    "failed_ids"}).
+    """
+    new_vectors = []
+    new_meta: List[Dict[str, Any]] = []
+    stats: Dict[str, Any] = {"failed": 0, "bytes": 0, "failed_ids": set()}
+    stats_lock = threading.Lock()
+
+    def _download(f: Dict[str, Any]) -> str:
+        path = download_fn(f)
+        with stats_lock:
+            stats["bytes"] += os.path.getsize(path)
+        return path
+
+    # Lỗi từng batch embedding (vector 0) vẫn hiện trong nhật ký của job
+    embed_events = EventSink(on_record=lambda r: progress.warning("Embedding: %s" % r["message"]))
+    progress.set_total(len(files), "Processing new documents...")
+
+    # Download / parse + chunk / embed chạy song song, kết quả về theo thứ tự files
+    results = run_ingest_pipeline(
+        files,
+        download_fn=_download,
+        embed_fn=lambda texts: get_embeddings(texts, batch_size=100, events=embed_events),
+        download_workers=download_workers,
+        parse_workers=parse_workers,
+        embed_workers=embed_workers,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        release_fn=release_fn,
+    )
+
+    for i, res in enumerate(results, start=1):
+        f = res["file"]
+        file_id = f["id"]
+        file_name = f["name"]
+        file_mtime = f.get("modifiedTime")
+        progress.update(i, "Processed %s (%d/%d)" % (file_name, i, len(files)))
+        for w in res["warnings"]:
+            progress.warning("%s: %s" % (file_name, w["message"]))
+
+        if res["stage"] is not None:
+            stats["failed"] += 1
+            stats["failed_ids"].add(file_id)
+        if res["stage"] == "download":
+            progress.warning("Failed to download '%s': %s" % (file_name, res["error"]))
+            continue
+        if res["stage"] == "parse":
+            progress.warning("Failed to parse '%s': %s" % (file_name, res["error"]))
+            continue
+        if res["stage"] == "embed":
+            progress.warning("Embedding failed for %s: %s" % (file_name, res["error"]))
+            continue
+        if res["chunks"] is None:
+            continue
+
+        chunks = res["chunks"]
+        vecs = res["vectors"]
+        for j, c in enumerate(chunks):
+            new_vectors.append(vecs[j])
+            row = {"file_id": file_id, "file_name": file_name, "modified_time": file_mtime}
+            row.update(c)
+            new_meta.append(row)
+
+    progress.update(len(files), "Hoàn thành xử lý file mới")
+    if not new_vectors:
+        return None, [], stats
+    new_mat = np.array(new_vectors, dtype="float32")
+    faiss.normalize_L2(new_mat)
+    return new_mat, new_meta, stats
+
+
+def update_index(shared: SharedIndex, files: List[Dict[str, Any]],
+                 download_fn: Callable[[Dict[str, Any]], str], progress: Any,
+                 index_dir: str, meta_path: str, process_all: bool = False,
+                 load_fn: Optional[Callable[[], Optional[ChunkIndex]]] = None,
+                 configure: Optional[Callable[[ChunkIndex], ChunkIndex]] = None,
+                 on_removed: Optional[Callable[[set], None]] = None,
+                 on_rebuilt: Optional[Callable[[], None]] = None,
+                 copy_on_write: bool = False,
+                 **pipeline_options: Any) -> Dict[str, Any]:
+    """Load index (nếu chưa có) và đưa các thay đổi của ``files`` vào index dùng chung.
+
+    Chỉ một writer tại một thời điểm; trong lúc download/embed, reader vẫn
+    truy vấn index hiện tại. Thay đổi được áp dụng trong một lần khoá ghi
+    ngắn (cập nhật tại chỗ) hoặc bằng swap sang generation mới (rebuild /
+    chưa có index). load_fn() mở index có sẵn; on_removed(file_ids) và
+    on_rebuilt() để bên gọi làm mất hiệu lực các cache phụ thuộc chunk_id.
+
+    copy_on_write=True khi process khác có thể đang mở index (ingest_cli.py
+    + app với INDEX_SOURCE = "cli"): thay đổi được ghi vào bản chép ở
+    generation mới (compact luôn nếu cần) rồi mới publish; generation vừa
+    được thay giữ lại cho process kia, các generation cũ hơn bị xoá.
+
+    Trả về thống kê: files, failed, chunks, removed, bytes, seconds, rebuilt,
+    total_chunks.
+    """
+    start = time.perf_counter()
+    configure = configure or (lambda store: store)
+    stats: Dict[str, Any] = {"files": 0, "failed": 0, "chunks": 0, "removed": 0, "bytes": 0,
+                             "seconds": 0.0, "rebuilt": False, "total_chunks": 0}
+    with shared.writer():
+        store = None if process_all else shared.store
+        if store is None and not process_all and load_fn is not None:
+            store = load_fn()
+            if store is not None:
+                # Phục vụ ngay index vừa load trong khi xử lý file mới
+                shared.swap(store)
+                progress.info(f"📦 Đã load {len(store)} chunks từ {len(store.file_ids())} files có sẵn")
+
+        processed_ids = set()
+        stale_ids = set()
+        if store is not None:
+            # File sửa tại chỗ (cùng id, modifiedTime mới) hoặc đã xoá: thay chunks cũ
+            stale_ids = stale_file_ids(store, files)
+            processed_ids = store.file_ids() - stale_ids
+
+        new_files = [f for f in files if f["id"] not in processed_ids]
+        stats["files"] = len(new_files)
+        if not new_files and store is not None and not stale_ids:
+            progress.success("✅ Không có file mới. Sử dụng index hiện tại.")
+            stats.update(seconds=time.perf_counter() - start, total_chunks=len(store))
+            return stats
+
+        if stale_ids:
+            progress.info(f"♻️ {len(stale_ids)} file đã bị sửa hoặc xoá")
+        if new_files:
+            progress.info(f"📄 Phát hiện {len(new_files)} file mới cần xử lý")
+
+        new_mat, new_meta, embed_stats = embed_files(new_files, download_fn, progress, **pipeline_options)
+        failed_ids = embed_stats.pop("failed_ids")
+        stats.update(embed_stats, chunks=len(new_meta))
+        # Bản mới lỗi: giữ chunks cũ (vẫn mang modifiedTime cũ nên lần sau được thử lại)
+        kept = stale_ids & failed_ids
+        if kept:
+            stale_ids = stale_ids - kept
+            progress.warning(f"Giữ bản đã index của {len(kept)} file sửa nhưng xử lý lỗi")
+
+        if store is not None and copy_on_write:
+            # Không sửa generation đang publish: cập nhật bản chép rồi mới chuyển pointer
+            current = current_generation(index_dir, meta_path)
+            gen = next_generation(current, index_dir, meta_path)
+            copy_generation(current, gen)
+            target = configure(ChunkIndex.load(gen["index_dir"], gen["meta_path"]))
+            removed = target.remove_files(stale_ids) if stale_ids else 0
+            if new_mat is not None:
+                target.add(new_mat, new_meta)
+            _publish(shared, target, gen, current, index_dir, meta_path, progress, copy_on_write)
+            if on_removed is not None and stale_ids:
+                on_removed(stale_ids)
+            store = target
+            stats["removed"] = removed
+            if removed:
+                progress.info(f"♻️ Đã gỡ {removed} chunks cũ khỏi index")
+            if new_mat is not None:
+                progress.success(f"✅ Đã thêm {len(new_meta)} chunks mới vào index (tổng: {len(store)} chunks)")
+        elif store is not None:
+            # Gỡ bản cũ + thêm bản mới + lưu trong cùng một lần khoá ghi
+            with shared.write():
+                removed = store.remove_files(stale_ids) if stale_ids else 0
+                if new_mat is not None:
+                    store.add(new_mat, new_meta)
+                store.save()
+            if on_removed is not None and stale_ids:
+                on_removed(stale_ids)
+            stats["removed"] = removed
+            if removed:
+                progress.info(f"♻️ Đã gỡ {removed} chunks cũ khỏi index")
+            if new_mat is not None:
+                progress.success(f"✅ Đã thêm {len(new_meta)} chunks mới vào index (tổng: {len(store)} chunks)")
+        else:
+            if new_mat is None:
+                raise RuntimeError("No embeddings were created. Please check the source folder and parsers.")
+            # Dựng index mới ở generation khác rồi mới chuyển pointer + swap
+            current = current_generation(index_dir, meta_path)
+            gen = next_generation(current, index_dir, meta_path)
+            store = configure(ChunkIndex.new(new_mat.shape[1], gen["index_dir"], gen["meta_path"]))
+            store.add(new_mat, new_meta)
+            _publish(shared, store, gen, current, index_dir, meta_path, progress, copy_on_write)
+            # chunk_id được cấp lại từ 0, mọi cache theo chunk_id cũ không còn đúng
+            if on_rebuilt is not None:
+                on_rebuilt()
+            stats["rebuilt"] = True
+            progress.success(f"✅ Đã tạo index mới với {len(new_meta)} chunks")
+
+    stats.update(seconds=time.perf_counter() - start, total_chunks=len(store))
+    return stats
+
+
+def _publish(shared: SharedIndex, store: ChunkIndex, gen: Dict[str, Any], current: Dict[str, Any],
+             index_dir: str, meta_path: str, progress: Any, copy_on_write: bool) -> None:
+    """Lưu generation mới, chuyển pointer, swap; dọn generation không còn ai dùng"""
+    if copy_on_write and store.needs_compaction():
+        # Sau khi publish, process khác có thể đã mở generation này: không compact tại chỗ nữa
+        store.compact()
+        progress.info("🗜️ Đã compact index")
+    store.save()
+    publish_generation(gen)
+    old = shared.swap(store)
+    if old is not None:
+        old.store.close()
+    if copy_on_write:
+        remove_generations_before(current, index_dir, meta_path)
+    else:
+        remove_generation(current)
+
+
+def compact(shared: SharedIndex) -> bool:
+    """Gộp segment / xoá hẳn vector tombstone nếu cần; True nếu đã compact"""
+    with shared.writer():
+        store = shared.store
+        if store is None or not store.needs_compaction():
+            return False
+        store.compact()
+        store.save()
+        return True
+
+
+def compact_in_background(shared: SharedIndex) -> None:
+    """compact() trên thread nền"""
+    threading.Thread(target=compact, args=(shared,), name="faiss-compaction", daemon=True).start()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""Ingest tài liệu từ dòng lệnh, không cần Streamlit UI.
+
+Chạy cùng pipeline với app (process_pdf / process_pptx -> chunk_text_smart ->
+get_embeddings -> FAISS) trên một folder Drive hoặc một thư mục local, ghi ra
+đúng các file cache mà app load (faiss_index/, embeddings_meta.sqlite,
+index_current.json, embedding cache), rồi in thống kê throughput.
+
+    python ingest_cli.py --local-dir ./docs
+    python ingest_cli.py --drive-folder <FOLDER_ID> --credentials sa.json
+    python ingest_cli.py --local-dir ./docs --rebuild --workdir /srv/vna-app
+    python ingest_cli.py --drive-folder <FOLDER_ID> --upload-to <FOLDER_ID>
+
+Cấu hình (OPENAI_API_KEY, EMBEDDING_*, ANN_*, INGEST_*...) đọc từ
+.streamlit/secrets.toml nếu có, nếu không thì từ biến môi trường. Đặt
+INDEX_SOURCE = "cli" trong secrets của app để app chỉ load index này. Mỗi lần
+có thay đổi, CLI ghi một generation mới rồi mới chuyển index_current.json, nên
+không bao giờ sửa index app đang mở; app thấy pointer đổi thì load lại.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+
+def _format_rate(count: float, seconds: float) -> str:
+    return "%.2f/s" % (count / seconds) if seconds > 0 else "-"
+
+
+class ConsoleProgress:
+    """Cùng giao diện với index_worker.JobProgress, in ra terminal"""
+
+    def __init__(self, stream=sys.stderr, interval: float = 1.0):
+        self.stream = stream
+        self.interval = interval
+        self.total = 0
+        self.warnings = 0
+        self._last_print = 0.0
+
+    def set_total(self, total: int, text: str = "") -> None:
+        self.total = total
+        if text:
+            self._print(text)
+
+    def update(self, done: int, text: str = "") -> None:
+        # Thưa bớt: tối đa một dòng mỗi interval giây, luôn in dòng cuối
+        now = time.time()
+        if done < self.total and now - self._last_print < self.interval:
+            return
+        self._last_print = now
+        self._print("[%d/%d] %s" % (done, self.total, text))
+
+    def info(self, message: str) -> None:
+        self._print(message)
+
+    def success(self, message: str) -> None:
+        self._print(message)
+
+    def warning(self, message: str) -> None:
+        self.warnings += 1
+        self._print("WARNING: %s" % message)
+
+    def _print(self, message: str) -> None:
+        print(message, file=self.stream, flush=True)
+
+
+def list_local_files(root: str) -> List[Dict[str, Any]]:
+    """File PDF/PPTX trong thư mục (đệ quy), cùng dạng dict với file Drive"""
+    from indexer import is_supported
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if not is_supported({"name": name}) or not os.path.isfile(path):
+                continue
+            info = os.stat(path)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            files.append({
+                # id ổn định theo đường dẫn tương đối: sửa file = cùng id, modifiedTime mới
+                "id": "local:%s" % rel,
+                "name": rel,
+                "modifiedTime": datetime.fromtimestamp(info.st_mtime, timezone.utc)
+                .strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                "size": str(info.st_size),
+                "path": os.path.abspath(path),
+            })
+    return files
+
+
+def _list_drive_files(folder_id: str) -> List[Dict[str, Any]]:
+    """File PDF/PPTX của folder Drive, qua changes feed như app"""
+    from drive_utils import sync_folder, thread_local_service
+    from indexer import is_supported
+
+    sync = sync_folder(thread_local_service(), folder_id)
+    return [f for f in sync["files"] if is_supported(f)]
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Ingest PDF/PPTX vào index FAISS dùng cho app Streamlit.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--local-dir", help="thư mục chứa PDF/PPTX (quét đệ quy)")
+    source.add_argument("--drive-folder", help="ID folder Google Drive")
+    parser.add_argument("--credentials", help="file JSON service account (thay cho GOOGLE_SERVICE_ACCOUNT_JSON trong secrets / env)")
+    parser.add_argument("--workdir", help="thư mục chứa các file cache (mặc định thư mục hiện tại)")
+    parser.add_argument("--rebuild", action="store_true", help="dựng lại toàn bộ thay vì chỉ cập nhật thay đổi")
+    parser.add_argument("--upload-to", metavar="FOLDER_ID",
+                        help="upload cache index lên folder Drive này sau khi cập nhật (chỉ file đã đổi)")
+    parser.add_argument("--download-workers", type=int)
+    parser.add_argument("--parse-workers", type=int)
+    parser.add_argument("--embed-workers", type=int)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    local_dir = os.path.abspath(args.local_dir) if args.local_dir else None
+    credentials = os.path.abspath(args.credentials) if args.credentials else None
+    if args.workdir:
+        # Mọi file cache dùng đường dẫn tương đối, giống app chạy trong thư mục này
+        os.chdir(args.workdir)
+
+    from document_processors import embedding_cache_stats, get_setting
+    from drive_utils import DownloadPool, use_service_account
+    from indexer import FAISS_INDEX_DIR, META_DB_FILE, load_index, update_index
+    from shared_index import SharedIndex
+
+    def _configure(store):
+        store.configure_ann(
+            index_type=get_setting("ANN_INDEX_TYPE", "auto"),
+            nprobe=int(get_setting("ANN_NPROBE", 0)),
+            ef_search=int(get_setting("ANN_EF_SEARCH", 0)),
+            recall_target=float(get_setting("ANN_RECALL_TARGET", 0.95)),
+        )
+        return store
+
+    def _load():
+        store = load_index(FAISS_INDEX_DIR, META_DB_FILE)
+        return _configure(store) if store is not None else None
+
+    if credentials is not None:
+        # --credentials thắng GOOGLE_SERVICE_ACCOUNT_JSON trong secrets.toml / env
+        use_service_account(credentials)
+    download_workers = args.download_workers or int(get_setting("INGEST_DOWNLOAD_WORKERS", 4))
+    progress = ConsoleProgress()
+    list_start = time.perf_counter()
+    pool = None
+    if local_dir is not None:
+        if not os.path.isdir(local_dir):
+            print("Không tìm thấy thư mục: %s" % local_dir, file=sys.stderr)
+            return 2
+        # File local được parse tại chỗ, không copy
+        files, download_fn, release_fn = list_local_files(local_dir), (lambda f: f["path"]), None
+    else:
+        files = _list_drive_files(args.drive_folder)
+        # Mỗi thread download giữ client + kết nối riêng; file tạm (đã kiểm tra md5) xoá sau khi parse
+        pool = DownloadPool(download_workers)
+        download_fn, release_fn = pool.download, os.remove
+    list_seconds = time.perf_counter() - list_start
+    progress.info("Nguồn: %d file PDF/PPTX (liệt kê %.1fs)" % (len(files), list_seconds))
+
+    cache_before = embedding_cache_stats()
+    shared = SharedIndex()
+    try:
+        stats = update_index(
+            shared, files,
+            download_fn=download_fn,
+            release_fn=release_fn,
+            progress=progress,
+            index_dir=FAISS_INDEX_DIR,
+            meta_path=META_DB_FILE,
+            process_all=args.rebuild,
+            load_fn=_load,
+            configure=_configure,
+            # App (INDEX_SOURCE = "cli") có thể đang mở index: luôn ghi sang generation mới
+            copy_on_write=True,
+            download_workers=download_workers,
+            parse_workers=args.parse_workers or int(get_setting("INGEST_PARSE_WORKERS", 2)),
+            embed_workers=args.embed_workers or int(get_setting("INGEST_EMBED_WORKERS", 4)),
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+        )
+    except RuntimeError as e:
+        print("Lỗi: %s" % e, file=sys.stderr)
+        return 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if args.upload_to:
+        from drive_cache import upload_index_cache
+        from drive_utils import thread_local_service
+
+        result = upload_index_cache(shared, thread_local_service(), args.upload_to, FAISS_INDEX_DIR, META_DB_FILE)
+        progress.info("Drive: %d file upload, %d không đổi, %d file cũ đã xoá" % (
+            result["uploaded"], result["skipped"], result["deleted"]))
+    if shared.store is not None:
+        shared.store.store.close()
+
+    cache_after = embedding_cache_stats()
+    seconds = stats["seconds"]
+    mb = stats["bytes"] / (1024 * 1024)
+    print("Files:      %d xử lý, %d lỗi, %d bỏ qua (không đổi)" % (
+        stats["files"], stats["failed"], len(files) - stats["files"]))
+    print("Chunks:     %d mới, %d cũ đã gỡ, tổng %d" % (stats["chunks"], stats["removed"], stats["total_chunks"]))
+    print("Thời gian:  %.1fs%s" % (seconds, " (dựng lại toàn bộ)" if stats["rebuilt"] else ""))
+    print("Throughput: %s files, %s chunks, %.2f MB/s (%.1f MB)" % (
+        _format_rate(stats["files"], seconds), _format_rate(stats["chunks"], seconds),
+        mb / seconds if seconds > 0 else 0.0, mb))
+    if cache_before and cache_after:
+        print("Embedding cache: %d hit / %d miss" % (
+            cache_after["hits"] - cache_before["hits"], cache_after["misses"] - cache_before["misses"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
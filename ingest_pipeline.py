@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Pipeline ingest nhiều file song song: download -> parse + chunk -> embed.
+
+Mỗi stage có mức song song riêng:
+- download: thread (I/O tới Drive)
+- parse + chunk: process pool (CPU, tránh GIL)
+- embed: thread (I/O tới OpenAI)
+
+Số file đang nằm trong pipeline bị giới hạn bởi ``max_in_flight`` (hàng đợi
+có giới hạn giữa các stage), và kết quả được trả về đúng thứ tự file đầu vào
+để chunks vào index theo thứ tự cố định.
+
+File được chuyển giữa các stage bằng đường dẫn trên đĩa (download ghi thẳng ra
+file tạm), không copy nội dung file qua RAM hay qua process pool.
+"""
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from document_processors import process_pdf, process_pptx, chunk_text_smart
+from progress_events import EventSink
+
+
+def parse_and_chunk(file_name: str, path: str,
+                    chunk_size: int = 1000,
+                    chunk_overlap: int = 200) -> Tuple[Optional[List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """Parse PDF/PPTX (đọc từ file path) rồi chunk; chạy được trong worker process.
+
+    Trả về (chunks, cảnh báo dạng record); chunks là None nếu định dạng
+    file không được hỗ trợ.
+    """
+    events = EventSink()
+    name = file_name.lower()
+    if name.endswith(".pdf"):
+        parse = process_pdf
+    elif name.endswith(".pptx"):
+        parse = process_pptx
+    else:
+        return None, []
+    # Parser đọc theo seek trên file, không nạp cả file vào RAM
+    with open(path, "rb") as content:
+        text, meta = parse(content, events=events)
+    chunks = chunk_text_smart(text, meta, chunk_size=chunk_size, chunk_overlap=chunk_overlap, events=events)
+    return chunks, events.warnings()
+
+
+def run_ingest_pipeline(files: Iterable[Dict[str, Any]],
+                        download_fn: Callable[[Dict[str, Any]], str],
+                        embed_fn: Callable[[List[str]], List[List[float]]],
+                        download_workers: int = 4,
+                        parse_workers: int = 2,
+                        embed_workers: int = 4,
+                        max_in_flight: Optional[int] = None,
+                        chunk_size: int = 1000,
+                        chunk_overlap: int = 200,
+                        release_fn: Optional[Callable[[str], None]] = None) -> Iterator[Dict[str, Any]]:
+    """Chạy pipeline cho danh sách file, yield kết quả theo đúng thứ tự đầu vào.
+
+    Mỗi kết quả là dict: ``file``, ``chunks``, ``vectors``, ``error``,
+    ``stage`` (stage bị lỗi: "download" / "parse" / "embed") và ``warnings``
+    (record cảnh báo khi parse / chunk, xem progress_events). File bị bỏ qua
+    (định dạng không hỗ trợ) có ``chunks`` = None và ``error`` = None.
+
+    download_fn(file) trả về đường dẫn file local; release_fn(path) (vd.
+    os.remove cho file tạm) được gọi sau khi parse xong hoặc lỗi.
+
+    ``parse_workers <= 0`` thì parse ngay trong thread (không dùng process pool).
+    """
+    download_workers = max(1, download_workers)
+    embed_workers = max(1, embed_workers)
+    if max_in_flight is None:
+        max_in_flight = download_workers + max(parse_workers, 1) + embed_workers
+    max_in_flight = max(1, max_in_flight)
+
+    download_slots = threading.BoundedSemaphore(download_workers)
+    embed_slots = threading.BoundedSemaphore(embed_workers)
+    # spawn: process gọi pipeline đã có nhiều thread (Streamlit, worker, pool
+    # download); fork giữa chừng có thể copy lock đang bị giữ vào process con
+    parse_pool = (ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context("spawn"))
+                  if parse_workers > 0 else None)
+
+    def _process_one(f: Dict[str, Any]) -> Dict[str, Any]:
+        result = {"file": f, "chunks": None, "vectors": None, "error": None, "stage": None, "warnings": []}
+
+        try:
+            with download_slots:
+                path = download_fn(f)
+        except Exception as e:
+            result.update(error=str(e), stage="download")
+            return result
+
+        try:
+            if parse_pool is not None:
+                chunks, warnings = parse_pool.submit(
+                    parse_and_chunk, f["name"], path, chunk_size, chunk_overlap).result()
+            else:
+                chunks, warnings = parse_and_chunk(f["name"], path, chunk_size, chunk_overlap)
+        except Exception as e:
+            result.update(error=str(e), stage="parse")
+            return result
+        finally:
+            if release_fn is not None:
+                release_fn(path)
+        result["warnings"] = warnings
+        if chunks is None:
+            return result
+
+        try:
+            with embed_slots:
+                vectors = embed_fn([c["text"] for c in chunks]) if chunks else []
+        except Exception as e:
+            result.update(chunks=chunks, error=str(e), stage="embed")
+            return result
+
+        result.update(chunks=chunks, vectors=vectors)
+        return result
+
+    pending = deque()
+    files_iter = iter(files)
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as coordinators:
+            for f in files_iter:
+                pending.append(coordinators.submit(_process_one, f))
+                if len(pending) >= max_in_flight:
+                    break
+
+            # Trả kết quả theo thứ tự; mỗi file xong lại nạp thêm một file mới
+            while pending:
+                result = pending.popleft().result()
+                nxt = next(files_iter, None)
+                if nxt is not None:
+                    pending.append(coordinators.submit(_process_one, nxt))
+                yield result
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown(wait=True)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Inverted index BM25 (unigram + bigram) cho tìm kiếm theo từ khoá.
+
+Postings nằm trong cùng file SQLite với metadata chunks (MetaStore truyền
+connection + lock vào), nên được ghi/commit cùng transaction với meta và
+luôn khớp với FAISS index. Độ dài từng chunk được giữ trong RAM (mảng NumPy
+theo chunk_id) để chấm điểm không phải đọc lại bảng.
+"""
+import math
+import re
+import sqlite3
+import threading
+import zlib
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lex_terms (
+    code INTEGER PRIMARY KEY,
+    term TEXT UNIQUE NOT NULL,
+    df INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS lex_postings (
+    term INTEGER NOT NULL,
+    chunk_id INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, chunk_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_lex_postings_chunk ON lex_postings(chunk_id);
+CREATE TABLE IF NOT EXISTS lex_docs (
+    chunk_id INTEGER PRIMARY KEY,
+    length INTEGER NOT NULL
+);
+"""
+
+
+def tokenize(text: str) -> List[str]:
+    """Từ (chữ thường, bỏ dấu câu) của text"""
+    return _WORD_RE.findall(text.lower())
+
+
+def terms_of(text: str) -> List[str]:
+    """Unigram + bigram ("a b") của text, theo thứ tự xuất hiện"""
+    words = tokenize(text)
+    return words + ["%s %s" % pair for pair in zip(words, words[1:])]
+
+
+def _hash_array(items: Iterable[str]) -> np.ndarray:
+    return np.unique(np.fromiter((zlib.crc32(x.encode("utf-8")) for x in items), dtype="uint32"))
+
+
+def word_hashes(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """crc32 (đã sort, không trùng) của từ và bigram, tách theo khoảng trắng như
+    keyword score cũ của reranker; dùng để so khớp từ khoá bằng mảng NumPy"""
+    words = text.lower().split()
+    return _hash_array(words), _hash_array("%s %s" % pair for pair in zip(words, words[1:]))
+
+
+class LexicalIndex:
+    """BM25 trên bảng postings trong SQLite; không tự commit"""
+
+    def __init__(self, conn: sqlite3.Connection, lock: threading.RLock):
+        self._conn = conn
+        self._lock = lock
+        self._conn.executescript(_SCHEMA)
+        self._load()
+
+    def _load(self) -> None:
+        self._codes: Dict[str, int] = {}
+        for code, term in self._conn.execute("SELECT code, term FROM lex_terms"):
+            self._codes[term] = code
+        rows = self._conn.execute("SELECT chunk_id, length FROM lex_docs").fetchall()
+        size = max([cid for cid, _ in rows] + [-1]) + 1
+        self._lengths = np.zeros(max(size, 1024), dtype="int32")
+        for cid, length in rows:
+            self._lengths[cid] = length
+        self.n_docs = len(rows)
+        self.total_length = int(sum(length for _, length in rows))
+
+    def _term_code(self, term: str) -> int:
+        code = self._codes.get(term)
+        if code is None:
+            code = self._conn.execute("INSERT INTO lex_terms (term, df) VALUES (?, 0)", (term,)).lastrowid
+            self._codes[term] = code
+        return code
+
+    def _set_length(self, chunk_id: int, length: int) -> None:
+        if chunk_id >= len(self._lengths):
+            grown = np.zeros(max(chunk_id + 1, 2 * len(self._lengths)), dtype="int32")
+            grown[:len(self._lengths)] = self._lengths
+            self._lengths = grown
+        self._lengths[chunk_id] = length
+
+    def add(self, docs: Iterable[Tuple[int, str]]) -> None:
+        """Index các (chunk_id, text)"""
+        with self._lock:
+            postings = []
+            df_delta: Counter = Counter()
+            lengths = []
+            for chunk_id, text in docs:
+                counts = Counter(terms_of(text))
+                length = sum(counts.values())
+                for term, tf in counts.items():
+                    code = self._term_code(term)
+                    postings.append((code, chunk_id, tf))
+                    df_delta[code] += 1
+                lengths.append((chunk_id, length))
+                self._set_length(chunk_id, length)
+                self.n_docs += 1
+                self.total_length += length
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO lex_postings (term, chunk_id, tf) VALUES (?, ?, ?)", postings)
+            self._conn.executemany("UPDATE lex_terms SET df = df + ? WHERE code = ?",
+                                   [(n, code) for code, n in df_delta.items()])
+            self._conn.executemany("INSERT OR REPLACE INTO lex_docs (chunk_id, length) VALUES (?, ?)", lengths)
+
+    def remove(self, chunk_ids: Iterable[int]) -> None:
+        with self._lock:
+            for chunk_id in chunk_ids:
+                row = self._conn.execute("SELECT length FROM lex_docs WHERE chunk_id = ?", (chunk_id,)).fetchone()
+                if row is None:
+                    continue
+                self._conn.execute(
+                    "UPDATE lex_terms SET df = df - 1 WHERE code IN"
+                    " (SELECT term FROM lex_postings WHERE chunk_id = ?)", (chunk_id,))
+                self._conn.execute("DELETE FROM lex_postings WHERE chunk_id = ?", (chunk_id,))
+                self._conn.execute("DELETE FROM lex_docs WHERE chunk_id = ?", (chunk_id,))
+                self._lengths[chunk_id] = 0
+                self.n_docs -= 1
+                self.total_length -= row[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            for table in ("lex_postings", "lex_docs", "lex_terms"):
+                self._conn.execute("DELETE FROM %s" % table)
+            self._load()
+
+    def reload(self) -> None:
+        with self._lock:
+            self._load()
+
+    def search(self, query: str, k: int) -> List[Tuple[float, int]]:
+        """Top-k (điểm BM25, chunk_id) cho query"""
+        query_terms = set(terms_of(query))
+        codes = [self._codes[t] for t in query_terms if t in self._codes]
+        if not codes or self.n_docs == 0:
+            return []
+        avgdl = self.total_length / self.n_docs
+        ids_parts = []
+        score_parts = []
+        with self._lock:
+            for code in codes:
+                df = self._conn.execute("SELECT df FROM lex_terms WHERE code = ?", (code,)).fetchone()[0]
+                if df <= 0:
+                    continue
+                rows = self._conn.execute(
+                    "SELECT chunk_id, tf FROM lex_postings WHERE term = ?", (code,)).fetchall()
+                if not rows:
+                    continue
+                posting = np.array(rows, dtype="int64")
+                ids, tf = posting[:, 0], posting[:, 1].astype("float32")
+                idf = math.log((self.n_docs - df + 0.5) / (df + 0.5) + 1.0)
+                dl = self._lengths[ids].astype("float32")
+                denom = tf + BM25_K1 * (1.0 - BM25_B + BM25_B * dl / avgdl)
+                ids_parts.append(ids)
+                score_parts.append(idf * tf * (BM25_K1 + 1.0) / denom)
+        if not ids_parts:
+            return []
+        uniq, inverse = np.unique(np.concatenate(ids_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [(float(scores[i]), int(uniq[i])) for i in top]
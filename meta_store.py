@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""Metadata của chunks lưu trong SQLite thay cho pickle list-of-dicts.
+
+- Trường lặp lại (file, section_type, content_type, key terms) được mã hoá
+  thành số nguyên qua các bảng từ điển ``files``, ``labels``, ``terms``.
+- Text của chunk nằm ở bảng riêng ``chunk_text``, chỉ đọc khi cần.
+- Thêm chunks là INSERT (không ghi lại cả file); thay đổi chỉ được commit
+  cùng lúc với file FAISS trong ChunkIndex.save().
+- Inverted index BM25 (lexical_index) dùng chung connection/transaction.
+- Bảng ``chunk_features`` giữ hash từ/bigram của từng chunk (BLOB uint32)
+  để reranker chấm điểm bằng mảng NumPy thay vì đọc lại text.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from lexical_index import LexicalIndex, word_hashes
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    code INTEGER PRIMARY KEY,
+    file_id TEXT UNIQUE NOT NULL,
+    file_name TEXT,
+    modified_time TEXT
+);
+CREATE TABLE IF NOT EXISTS labels (
+    code INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    UNIQUE (kind, value)
+);
+CREATE TABLE IF NOT EXISTS terms (
+    code INTEGER PRIMARY KEY,
+    term TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id INTEGER PRIMARY KEY,
+    file_code INTEGER NOT NULL,
+    chunk_index INTEGER,
+    total_chunks INTEGER,
+    section_type INTEGER,
+    section_number INTEGER,
+    section_title TEXT,
+    is_complete_section INTEGER,
+    token_count INTEGER,
+    word_count INTEGER,
+    char_count INTEGER,
+    content_type INTEGER,
+    has_headers INTEGER,
+    has_lists INTEGER,
+    has_tables INTEGER,
+    key_terms TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_file ON chunks(file_code);
+CREATE TABLE IF NOT EXISTS chunk_text (
+    chunk_id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunk_features (
+    chunk_id INTEGER PRIMARY KEY,
+    words BLOB NOT NULL,
+    bigrams BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tombstones (
+    chunk_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_CHUNK_COLUMNS = (
+    "chunk_id", "file_code", "chunk_index", "total_chunks", "section_type", "section_number",
+    "section_title", "is_complete_section", "token_count", "word_count", "char_count",
+    "content_type", "has_headers", "has_lists", "has_tables", "key_terms",
+)
+_BOOL_FIELDS = ("is_complete_section", "has_headers", "has_lists", "has_tables")
+
+
+class MetaStore:
+    """Kho metadata chunks trên SQLite; mọi truy cập đi qua một lock"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self.lexical = LexicalIndex(self._conn, self._lock)
+        self._conn.commit()
+        self._load_dictionaries()
+
+    def _load_dictionaries(self) -> None:
+        self._files: Dict[str, int] = {}
+        self._file_info: Dict[int, Dict[str, Any]] = {}
+        for code, fid, name, mtime in self._conn.execute("SELECT code, file_id, file_name, modified_time FROM files"):
+            self._files[fid] = code
+            self._file_info[code] = {"file_id": fid, "file_name": name, "modified_time": mtime}
+        self._labels: Dict[tuple, int] = {}
+        self._label_values: Dict[int, str] = {}
+        for code, kind, value in self._conn.execute("SELECT code, kind, value FROM labels"):
+            self._labels[(kind, value)] = code
+            self._label_values[code] = value
+        self._terms: Dict[str, int] = {}
+        self._term_values: Dict[int, str] = {}
+        for code, term in self._conn.execute("SELECT code, term FROM terms"):
+            self._terms[term] = code
+            self._term_values[code] = term
+
+    # ---------- Dictionary encoding ----------
+    def _file_code(self, row: Dict[str, Any]) -> int:
+        fid = row.get("file_id") or ""
+        info = {"file_id": fid, "file_name": row.get("file_name"), "modified_time": row.get("modified_time")}
+        code = self._files.get(fid)
+        if code is None:
+            code = self._conn.execute(
+                "INSERT INTO files (file_id, file_name, modified_time) VALUES (?, ?, ?)",
+                (fid, info["file_name"], info["modified_time"]),
+            ).lastrowid
+            self._files[fid] = code
+        elif self._file_info[code] != info:
+            self._conn.execute(
+                "UPDATE files SET file_name = ?, modified_time = ? WHERE code = ?",
+                (info["file_name"], info["modified_time"], code),
+            )
+        self._file_info[code] = info
+        return code
+
+    def _label_code(self, kind: str, value: Optional[str]) -> Optional[int]:
+        if value is None:
+            return None
+        code = self._labels.get((kind, value))
+        if code is None:
+            code = self._conn.execute("INSERT INTO labels (kind, value) VALUES (?, ?)", (kind, value)).lastrowid
+            self._labels[(kind, value)] = code
+            self._label_values[code] = value
+        return code
+
+    def _term_codes(self, terms: Iterable[str]) -> str:
+        codes = []
+        for term in terms or []:
+            code = self._terms.get(term)
+            if code is None:
+                code = self._conn.execute("INSERT INTO terms (term) VALUES (?)", (term,)).lastrowid
+                self._terms[term] = code
+                self._term_values[code] = term
+            codes.append(str(code))
+        return ",".join(codes)
+
+    # ---------- Write ----------
+    def insert(self, rows: List[Dict[str, Any]]) -> None:
+        """Thêm chunks (mỗi row phải có chunk_id); chưa commit"""
+        with self._lock:
+            chunk_rows = []
+            text_rows = []
+            for r in rows:
+                chunk_rows.append((
+                    int(r["chunk_id"]), self._file_code(r), r.get("chunk_index"), r.get("total_chunks"),
+                    self._label_code("section_type", r.get("section_type")), r.get("section_number"),
+                    r.get("section_title", ""), int(bool(r.get("is_complete_section"))),
+                    r.get("token_count"), r.get("word_count"), r.get("char_count"),
+                    self._label_code("content_type", r.get("content_type")),
+                    int(bool(r.get("has_headers"))), int(bool(r.get("has_lists"))), int(bool(r.get("has_tables"))),
+                    self._term_codes(r.get("local_key_terms")),
+                ))
+                text_rows.append((int(r["chunk_id"]), r.get("text", "")))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (%s) VALUES (%s)" % (", ".join(_CHUNK_COLUMNS), ", ".join("?" * len(_CHUNK_COLUMNS))),
+                chunk_rows,
+            )
+            self._conn.executemany("INSERT OR REPLACE INTO chunk_text (chunk_id, text) VALUES (?, ?)", text_rows)
+            self._add_derived(text_rows)
+
+    def _add_derived(self, text_rows: List[Tuple[int, str]]) -> None:
+        """Dữ liệu suy ra từ text: postings BM25 + hash từ/bigram cho reranker"""
+        self.lexical.add(text_rows)
+        feature_rows = []
+        for cid, text in text_rows:
+            words, bigrams = word_hashes(text)
+            feature_rows.append((cid, words.tobytes(), bigrams.tobytes()))
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO chunk_features (chunk_id, words, bigrams) VALUES (?, ?, ?)", feature_rows)
+
+    def delete_files(self, file_ids: Iterable[str]) -> List[int]:
+        """Xoá chunks của các file; trả về chunk_id đã xoá; chưa commit"""
+        removed: List[int] = []
+        with self._lock:
+            for fid in file_ids:
+                code = self._files.get(fid)
+                if code is None:
+                    continue
+                ids = [r[0] for r in self._conn.execute("SELECT chunk_id FROM chunks WHERE file_code = ?", (code,))]
+                self._conn.execute("DELETE FROM chunks WHERE file_code = ?", (code,))
+                self._conn.executemany("DELETE FROM chunk_text WHERE chunk_id = ?", [(i,) for i in ids])
+                self._conn.executemany("DELETE FROM chunk_features WHERE chunk_id = ?", [(i,) for i in ids])
+                self.lexical.remove(ids)
+                removed.extend(ids)
+        return removed
+
+    def add_tombstones(self, chunk_ids: Iterable[int]) -> None:
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO tombstones (chunk_id) VALUES (?)", [(int(i),) for i in chunk_ids])
+
+    def clear_tombstones(self, chunk_ids: Iterable[int]) -> None:
+        with self._lock:
+            self._conn.executemany("DELETE FROM tombstones WHERE chunk_id = ?", [(int(i),) for i in chunk_ids])
+
+    def tombstones(self) -> List[int]:
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT chunk_id FROM tombstones")]
+
+    def set_state(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def get_state(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else default
+
+    def commit(self) -> None:
+        with self._lock:
+            self._conn.commit()
+
+    def rollback(self) -> None:
+        with self._lock:
+            self._conn.rollback()
+            self._load_dictionaries()
+            self.lexical.reload()
+
+    def reset(self) -> None:
+        """Xoá toàn bộ dữ liệu (rebuild toàn bộ)"""
+        with self._lock:
+            for table in ("chunks", "chunk_text", "chunk_features", "tombstones", "files", "labels",
+                          "terms", "state"):
+                self._conn.execute("DELETE FROM %s" % table)
+            self.lexical.clear()
+            self._conn.commit()
+            self._load_dictionaries()
+
+    def backfill_derived(self, batch_size: int = 1000) -> int:
+        """Tạo postings BM25 + features cho các chunk lưu từ phiên bản cũ; trả về số chunk"""
+        with self._lock:
+            missing = [r[0] for r in self._conn.execute(
+                "SELECT chunk_id FROM chunk_text"
+                " WHERE chunk_id NOT IN (SELECT chunk_id FROM lex_docs)"
+                " OR chunk_id NOT IN (SELECT chunk_id FROM chunk_features)")]
+            for i in range(0, len(missing), batch_size):
+                part = missing[i:i + batch_size]
+                self.lexical.remove(part)
+                self._add_derived(sorted(self.texts(part).items()))
+            if missing:
+                self._conn.commit()
+            return len(missing)
+
+    def checkpoint(self) -> None:
+        """Dồn WAL vào file chính (để chép / upload riêng file .sqlite)"""
+        with self._lock:
+            self._conn.commit()
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # ---------- Read ----------
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def max_chunk_id(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(chunk_id) FROM chunks").fetchone()
+            return row[0] if row and row[0] is not None else -1
+
+    def file_modified_times(self) -> Dict[str, Any]:
+        """file_id -> modified_time của các file còn chunk trong index"""
+        with self._lock:
+            codes = [r[0] for r in self._conn.execute("SELECT DISTINCT file_code FROM chunks")]
+            return {self._file_info[c]["file_id"]: self._file_info[c]["modified_time"] for c in codes}
+
+    def content_type_counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content_type, COUNT(*) FROM chunks GROUP BY content_type ORDER BY COUNT(*) DESC"
+            ).fetchall()
+            return {self._label_values.get(code, "general"): n for code, n in rows}
+
+    def get(self, chunk_ids: List[int], with_text: bool = False) -> Dict[int, Dict[str, Any]]:
+        """Giải mã metadata của các chunk_id (kèm text nếu with_text)"""
+        out: Dict[int, Dict[str, Any]] = {}
+        if not chunk_ids:
+            return out
+        with self._lock:
+            for i in range(0, len(chunk_ids), 500):
+                part = [int(c) for c in chunk_ids[i:i + 500]]
+                marks = ",".join("?" * len(part))
+                for rec in self._conn.execute(
+                    "SELECT %s FROM chunks WHERE chunk_id IN (%s)" % (", ".join(_CHUNK_COLUMNS), marks), part
+                ):
+                    raw = dict(zip(_CHUNK_COLUMNS, rec))
+                    row = dict(self._file_info[raw.pop("file_code")])
+                    row.update(raw)
+                    row["section_type"] = self._label_values.get(raw["section_type"])
+                    row["content_type"] = self._label_values.get(raw["content_type"], "general")
+                    for field in _BOOL_FIELDS:
+                        row[field] = bool(raw[field])
+                    terms = row.pop("key_terms")
+                    row["local_key_terms"] = [self._term_values[int(t)] for t in terms.split(",")] if terms else []
+                    out[row["chunk_id"]] = row
+            if with_text:
+                for cid, text in self.texts(list(out)).items():
+                    out[cid]["text"] = text
+        return out
+
+    def features(self, chunk_ids: List[int]) -> Dict[str, Any]:
+        """Features cho reranker dưới dạng mảng NumPy, theo thứ tự chunk_ids.
+
+        Trường nhiều giá trị (key terms, hash từ/bigram) trả về dạng phẳng:
+        ``<name>`` là mảng giá trị, ``<name>_rows`` là vị trí chunk tương ứng.
+        """
+        n = len(chunk_ids)
+        pos = {int(cid): i for i, cid in enumerate(chunk_ids)}
+        content_type = np.full(n, -1, dtype="int64")
+        flags = np.zeros((n, 3), dtype=bool)
+        term_rows: List[int] = []
+        term_strings: List[str] = []
+        blob_rows: List[int] = []
+        word_blobs: List[bytes] = []
+        bigram_blobs: List[bytes] = []
+
+        with self._lock:
+            for start in range(0, n, 500):
+                part = [int(c) for c in chunk_ids[start:start + 500]]
+                marks = ",".join("?" * len(part))
+                recs = self._conn.execute(
+                    "SELECT chunk_id, content_type, is_complete_section, has_tables, has_lists, key_terms"
+                    " FROM chunks WHERE chunk_id IN (%s)" % marks, part
+                ).fetchall()
+                if recs:
+                    idx = np.array([pos[r[0]] for r in recs], dtype="int64")
+                    content_type[idx] = [-1 if r[1] is None else r[1] for r in recs]
+                    flags[idx] = [r[2:5] for r in recs]
+                    for r in recs:
+                        if r[5]:
+                            term_rows.append(pos[r[0]])
+                            term_strings.append(r[5])
+                for cid, words, bigrams in self._conn.execute(
+                    "SELECT chunk_id, words, bigrams FROM chunk_features WHERE chunk_id IN (%s)" % marks, part
+                ):
+                    blob_rows.append(pos[cid])
+                    word_blobs.append(words)
+                    bigram_blobs.append(bigrams)
+
+            if term_strings:
+                counts = np.array([t.count(",") + 1 for t in term_strings], dtype="int64")
+                key_terms = np.array(",".join(term_strings).split(","), dtype="int64")
+                key_terms_rows = np.repeat(np.array(term_rows, dtype="int64"), counts)
+            else:
+                key_terms = key_terms_rows = np.empty(0, dtype="int64")
+            content_names = {int(c): self._label_values[int(c)] for c in np.unique(content_type) if c >= 0}
+            term_names = {int(c): self._term_values[int(c)] for c in np.unique(key_terms)}
+
+        out: Dict[str, Any] = {
+            "n": n,
+            "content_type": content_type,
+            "content_type_names": content_names,
+            # is_complete_section, has_tables, has_lists
+            "flags": flags,
+            "key_terms": key_terms,
+            "key_terms_rows": key_terms_rows,
+            "key_term_names": term_names,
+        }
+        rows = np.array(blob_rows, dtype="int64")
+        for name, blobs in (("words", word_blobs), ("bigrams", bigram_blobs)):
+            out[name] = np.frombuffer(b"".join(blobs), dtype="uint32")
+            out[name + "_rows"] = np.repeat(rows, [len(b) // 4 for b in blobs])
+        return out
+
+    def texts(self, chunk_ids: List[int]) -> Dict[int, str]:
+        """Chỉ đọc text của các chunk được yêu cầu"""
+        out: Dict[int, str] = {}
+        with self._lock:
+            for i in range(0, len(chunk_ids), 500):
+                part = [int(c) for c in chunk_ids[i:i + 500]]
+                marks = ",".join("?" * len(part))
+                for cid, text in self._conn.execute(
+                    "SELECT chunk_id, text FROM chunk_text WHERE chunk_id IN (%s)" % marks, part
+                ):
+                    out[cid] = text
+        return out
+
+
+def migrate_pickle(pickle_path: str, store: MetaStore) -> Dict[str, Any]:
+    """Chuyển embeddings_meta.pkl (list cũ hoặc dict {rows, next_id, tombstones}) vào MetaStore.
+
+    Row chưa có chunk_id (định dạng list) lấy chunk_id = vị trí dòng. Trả về
+    payload gốc đã chuẩn hoá để caller xử lý phần FAISS; pickle được đổi tên
+    thành ``*.migrated`` sau khi commit.
+    """
+    with open(pickle_path, "rb") as f:
+        payload = pickle.load(f)
+    if isinstance(payload, list):
+        rows = [dict(r, chunk_id=i) for i, r in enumerate(payload)]
+        payload = {"legacy_list": True, "rows": rows, "next_id": len(rows), "tombstones": []}
+    store.insert(payload["rows"])
+    store.add_tombstones(payload.get("tombstones", []))
+    store.set_state("next_id", payload.get("next_id", len(payload["rows"])))
+    return payload
+
+
+def finish_migration(pickle_path: str) -> None:
+    if os.path.exists(pickle_path):
+        os.replace(pickle_path, pickle_path + ".migrated")
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Nhận tiến độ + cảnh báo từ các hàm xử lý tài liệu, thay cho st.* gọi trực tiếp.
+
+process_pdf / process_pptx / chunk_text_smart / get_embeddings nhận tham số
+``events`` (tuỳ chọn). Không truyền thì sự kiện bị bỏ qua, gần như không tốn
+gì trong vòng lặp. EventSink:
+
+- progress(): chuyển tiếp tối đa một lần mỗi min_interval giây (lần cuối,
+  done >= total, luôn được chuyển).
+- warning() / info(): lưu record có cấu trúc {"level", "message", "time", ...}
+  (vd. page, slide, stage) và chuyển cho on_record nếu có.
+
+Trong worker process, tạo EventSink không có callback rồi trả ``records``
+(list dict, pickle được) về process cha cùng kết quả.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Số record tối đa giữ lại mỗi sink (record thừa chỉ được đếm)
+MAX_RECORDS = 1000
+
+
+class EventSink:
+    """Sink thu thập sự kiện; an toàn khi gọi từ nhiều thread"""
+
+    def __init__(self, on_progress: Optional[Callable[[int, int, str], None]] = None,
+                 on_record: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 min_interval: float = 0.5, max_records: int = MAX_RECORDS):
+        self.on_progress = on_progress
+        self.on_record = on_record
+        self.min_interval = min_interval
+        self.max_records = max_records
+        self.records: List[Dict[str, Any]] = []
+        self.dropped = 0
+        self._last_progress = 0.0
+        self._lock = threading.Lock()
+
+    def progress(self, done: int, total: int, text: str = "") -> None:
+        if self.on_progress is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if done < total and now - self._last_progress < self.min_interval:
+                return
+            self._last_progress = now
+        self.on_progress(done, total, text)
+
+    def _record(self, level: str, message: str, context: Dict[str, Any]) -> None:
+        record = {"level": level, "message": message, "time": time.time()}
+        record.update(context)
+        with self._lock:
+            if len(self.records) < self.max_records:
+                self.records.append(record)
+            else:
+                self.dropped += 1
+        if self.on_record is not None:
+            self.on_record(record)
+
+    def info(self, message: str, **context: Any) -> None:
+        self._record("info", message, context)
+
+    def warning(self, message: str, **context: Any) -> None:
+        self._record("warning", message, context)
+
+    def warnings(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [r for r in self.records if r["level"] == "warning"]
+
+
+class NullSink(EventSink):
+    """Bỏ qua mọi sự kiện (mặc định khi không truyền events)"""
+
+    def progress(self, done: int, total: int, text: str = "") -> None:
+        pass
+
+    def info(self, message: str, **context: Any) -> None:
+        pass
+
+    def warning(self, message: str, **context: Any) -> None:
+        pass
+
+
+NULL_SINK = NullSink()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Rerank candidates bằng phép tính trên mảng NumPy.
+
+Điểm giống công thức cũ (semantic + keyword + bonus theo loại nội dung), nhưng
+feature lấy từ MetaStore.features() (mã content type, cờ cấu trúc, hash
+từ/bigram tính sẵn lúc ingest) nên không phải đọc hay tách từ lại text của
+từng candidate. mmr_select() đa dạng hoá kết quả bằng vector của candidates.
+"""
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from lexical_index import word_hashes
+
+# Bonus theo content type và theo cấu trúc chunk
+TYPE_BONUS = {
+    "procedure": 0.1,
+    "specification": 0.1,
+    "safety_note": 0.15,
+}
+# is_complete_section, has_tables, has_lists
+STRUCTURE_BONUS = np.array([0.05, 0.05, 0.03], dtype="float64")
+
+WORD_MATCH_WEIGHT = 0.1
+KEY_TERM_MATCH_WEIGHT = 0.3
+BIGRAM_MATCH_WEIGHT = 0.2
+
+
+def _matches_per_row(values: np.ndarray, rows: np.ndarray, wanted: np.ndarray, n: int) -> np.ndarray:
+    if len(values) == 0 or len(wanted) == 0:
+        return np.zeros(n, dtype="float64")
+    return np.bincount(rows[np.isin(values, wanted)], minlength=n).astype("float64")
+
+
+def keyword_scores(query: str, features: Dict[str, Any]) -> np.ndarray:
+    """Điểm keyword (0..1) của mọi candidate: từ chung, key term có trong câu hỏi, bigram chung.
+
+    Key terms của chunk được trích từ chính text của chunk nên chỉ cần kiểm
+    tra chúng có nằm trong câu hỏi hay không.
+    """
+    n = features["n"]
+    query_lower = query.lower()
+    q_words, q_bigrams = word_hashes(query)
+    matched_terms = np.array(
+        [code for code, term in features["key_term_names"].items() if term.lower() in query_lower],
+        dtype="int64",
+    )
+    score = (
+        WORD_MATCH_WEIGHT * _matches_per_row(features["words"], features["words_rows"], q_words, n)
+        + KEY_TERM_MATCH_WEIGHT * _matches_per_row(features["key_terms"], features["key_terms_rows"], matched_terms, n)
+        + BIGRAM_MATCH_WEIGHT * _matches_per_row(features["bigrams"], features["bigrams_rows"], q_bigrams, n)
+    )
+    return np.minimum(score, 1.0)
+
+
+def type_bonus(features: Dict[str, Any]) -> np.ndarray:
+    """Bonus theo content type + cờ cấu trúc của mọi candidate"""
+    codes = features["content_type"]
+    table = np.zeros(max(features["content_type_names"], default=-1) + 2, dtype="float64")
+    for code, name in features["content_type_names"].items():
+        table[code + 1] = TYPE_BONUS.get(name, 0.0)
+    return table[codes + 1] + features["flags"].astype("float64") @ STRUCTURE_BONUS
+
+
+def score_candidates(query: str, similarity: np.ndarray, features: Dict[str, Any],
+                     weights: Tuple[float, float, float] = (0.65, 0.25, 0.10)) -> Tuple[np.ndarray, np.ndarray]:
+    """(điểm rerank, điểm keyword) cho mọi candidate; weights = (semantic, keyword, type)"""
+    w_semantic, w_keyword, w_type = weights
+    keyword = keyword_scores(query, features)
+    combined = (
+        np.asarray(similarity, dtype="float64") * w_semantic
+        + keyword * w_keyword
+        + type_bonus(features) * w_type
+    )
+    return combined, keyword
+
+
+def rank(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Vị trí top_k theo điểm giảm dần; điểm bằng nhau giữ thứ tự candidate"""
+    return np.argsort(-scores, kind="stable")[:top_k]
+
+
+def mmr_select(relevance: np.ndarray, vectors: np.ndarray, top_k: int, lam: float = 0.7) -> np.ndarray:
+    """Chọn top_k vị trí theo Maximal Marginal Relevance.
+
+    Mỗi bước chọn candidate có ``lam * relevance - (1 - lam) * max cosine với
+    các chunk đã chọn``, nên các chunk gần trùng nhau (phần overlap giữa
+    chunks, các bản sửa đổi của cùng tài liệu) không chiếm hết context.
+    ``lam = 1`` giữ nguyên thứ tự theo relevance. Vectors phải đã normalize.
+    """
+    n = len(relevance)
+    top_k = min(top_k, n)
+    if top_k == 0:
+        return np.empty(0, dtype="int64")
+    relevance = np.asarray(relevance, dtype="float64")
+    vectors = np.asarray(vectors, dtype="float32")
+    max_sim = np.full(n, -np.inf)
+    available = np.ones(n, dtype=bool)
+    picked = []
+    for step in range(top_k):
+        mmr = relevance if step == 0 else lam * relevance - (1.0 - lam) * max_sim
+        # argmax trên mảng đã che: điểm bằng nhau chọn candidate đứng trước
+        i = int(np.argmax(np.where(available, mmr, -np.inf)))
+        picked.append(i)
+        available[i] = False
+        max_sim = np.maximum(max_sim, vectors @ vectors[i])
+    return np.array(picked, dtype="int64")
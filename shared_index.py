@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""ChunkIndex dùng chung cho mọi session, khoá đọc/ghi và hot-swap.
+
+- Nhiều reader truy vấn song song (read()); chỉ một writer được chuẩn bị
+  cập nhật tại một thời điểm (writer()). Phần tốn thời gian (download, parse,
+  embed, dựng index mới) chạy khi chỉ giữ writer(), reader không bị chặn.
+- Cập nhật tại chỗ (thêm/gỡ chunks + save) chạy trong write(), ngắn, reader
+  chờ tối đa chừng đó.
+- Dựng lại toàn bộ: index mới được ghi sang một "generation" khác (thư mục
+  segment + file SQLite riêng), trỏ tới bằng file pointer ghi atomic (temp +
+  rename), rồi swap() thay index đang phục vụ. Meta và vector của một
+  generation luôn đi cùng nhau nên không bao giờ lệch nhau.
+- Process khác (ingest_cli.py) không sửa generation đã publish: chép sang
+  generation mới (copy_generation), cập nhật bản chép rồi mới publish; app
+  đang mở generation cũ vẫn đọc bình thường cho tới khi load lại.
+"""
+import glob
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+INDEX_POINTER_FILE = "index_current.json"
+
+
+class ReadWriteLock:
+    """Nhiều reader hoặc một writer; writer đang chờ được ưu tiên (không reentrant)"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class SharedIndex:
+    """Giữ index đang phục vụ; version tăng sau mỗi lần cập nhật hoặc swap"""
+
+    def __init__(self):
+        self.store = None
+        self.version = 0
+        self._rw = ReadWriteLock()
+        self._writer = threading.Lock()
+
+    @contextmanager
+    def read(self):
+        """Index hiện tại, không bị cập nhật hay swap trong khi đang đọc"""
+        with self._rw.read():
+            yield self.store
+
+    @contextmanager
+    def writer(self) -> Iterator[None]:
+        """Quyền cập nhật duy nhất (ingest, compaction); không chặn reader"""
+        with self._writer:
+            yield
+
+    @contextmanager
+    def write(self):
+        """Cập nhật tại chỗ; phải đang giữ writer()"""
+        with self._rw.write():
+            yield self.store
+            self.version += 1
+
+    def swap(self, store) -> Any:
+        """Thay index đang phục vụ; trả về index cũ (không còn reader nào dùng)"""
+        with self._rw.write():
+            old, self.store = self.store, store
+            self.version += 1
+        return old
+
+
+# ---------- Generation trên đĩa ----------
+def _generation(generation: int, index_dir: str, meta_path: str) -> Dict[str, Any]:
+    if generation == 0:
+        return {"generation": 0, "index_dir": index_dir, "meta_path": meta_path}
+    root, ext = os.path.splitext(meta_path)
+    return {
+        "generation": generation,
+        "index_dir": "%s.g%d" % (index_dir, generation),
+        "meta_path": "%s.g%d%s" % (root, generation, ext),
+    }
+
+
+def generation_paths(generation: int, index_dir: str, meta_path: str) -> Dict[str, Any]:
+    """Đường dẫn index + meta của generation số ``generation``"""
+    return _generation(generation, index_dir, meta_path)
+
+
+def current_generation(index_dir: str, meta_path: str,
+                       pointer_path: str = INDEX_POINTER_FILE) -> Dict[str, Any]:
+    """Đường dẫn index + meta đang dùng (generation 0 = đường dẫn mặc định)"""
+    try:
+        with open(pointer_path, "r", encoding="utf-8") as f:
+            pointer = json.load(f)
+        return _generation(int(pointer["generation"]), index_dir, meta_path)
+    except (OSError, ValueError, KeyError):
+        return _generation(0, index_dir, meta_path)
+
+
+def next_generation(current: Dict[str, Any], index_dir: str, meta_path: str) -> Dict[str, Any]:
+    """Đường dẫn cho lần dựng lại tiếp theo (đã dọn file sót lại nếu có)"""
+    gen = _generation(current["generation"] + 1, index_dir, meta_path)
+    remove_generation(gen)
+    return gen
+
+
+def publish_generation(generation: Dict[str, Any], pointer_path: str = INDEX_POINTER_FILE) -> None:
+    """Chuyển pointer sang generation mới (atomic: temp + rename)"""
+    with open(pointer_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"generation": generation["generation"]}, f)
+    os.replace(pointer_path + ".tmp", pointer_path)
+
+
+def copy_generation(src: Dict[str, Any], dst: Dict[str, Any]) -> None:
+    """Chép index + meta của src sang dst (dst đã được dọn, vd. từ next_generation).
+
+    File trong thư mục index không bao giờ bị ghi đè tại chỗ (segment, sidecar
+    bất biến; manifest thay bằng temp + rename) nên được hard link, chỉ chép
+    khi không link được; meta chép bằng SQLite backup API nên nhất quán kể cả
+    khi đang có WAL.
+    """
+    os.makedirs(dst["index_dir"], exist_ok=True)
+    for name in os.listdir(src["index_dir"]):
+        path = os.path.join(src["index_dir"], name)
+        target = os.path.join(dst["index_dir"], name)
+        if name.endswith(".tmp") or not os.path.isfile(path):
+            continue
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copy2(path, target)
+    source = sqlite3.connect(src["meta_path"])
+    try:
+        dest = sqlite3.connect(dst["meta_path"])
+        try:
+            source.backup(dest)
+        finally:
+            dest.close()
+    finally:
+        source.close()
+
+
+def remove_generations_before(generation: Dict[str, Any], index_dir: str, meta_path: str) -> None:
+    """Xoá mọi generation cũ hơn ``generation`` (giữ nó và các bản mới hơn)"""
+    root, ext = os.path.splitext(meta_path)
+    numbers = {0}
+    for pattern, suffix in (("%s.g*" % index_dir, ""), ("%s.g*%s" % (root, ext), ext)):
+        for path in glob.glob(pattern):
+            number = path[len(pattern) - len(suffix) - 1:len(path) - len(suffix)]
+            if number.isdigit():
+                numbers.add(int(number))
+    for number in sorted(numbers):
+        if number < generation["generation"]:
+            remove_generation(_generation(number, index_dir, meta_path))
+
+
+def remove_generation(generation: Dict[str, Any]) -> None:
+    """Xoá thư mục segment + file SQLite của một generation"""
+    shutil.rmtree(generation["index_dir"], ignore_errors=True)
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(generation["meta_path"] + suffix)
+        except OSError:
+            pass
@@ -1,8 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
-import pickle
-from io import BytesIO
-from typing import List, Dict, Any, Tuple
+import time
+from typing import List, Dict, Any, Optional, Tuple
 from collections import defaultdict
 
 import streamlit as st
@@ -10,7 +9,7 @@ import numpy as np
 import pandas as pd
 
 
-from datetime import datetime, timezone
+from datetime import datetime
 
 def _to_epoch(mt: str) -> float:
     try:
@@ -18,13 +17,6 @@ def _to_epoch(mt: str) -> float:
     except Exception:
         return 0.0
 
-# FAISS
-try:
-    import faiss
-except Exception:
-    st.error("FAISS is required. Please add 'faiss-cpu>=1.7.4' to requirements.txt")
-    st.stop()
-
 # OpenAI
 try:
     from openai import OpenAI
@@ -43,23 +35,46 @@ except Exception:
 try:
     from drive_utils import (
         authenticate_drive,
-        list_files_in_folder,
-        download_file,
+        sync_folder,
+        DownloadPool,
+        thread_local_service,
         format_file_size,
         download_embeddings_from_drive,
     )
+    from drive_cache import download_index_cache, upload_index_cache
 except Exception as e:
     st.error("Failed to import drive_utils: %s" % e)
     st.stop()
 
 try:
     from document_processors import (
-        process_pdf,
-        process_pptx,
-        chunk_text_smart,
-        get_embeddings,
+        embedding_cache_stats,
+        embed_query,
+        query_cache_stats,
         count_tokens,
     )
+    from index_store import MANIFEST_FILE, ChunkIndex
+    from indexer import (
+        EMBEDDINGS_FILE,
+        FAISS_INDEX_DIR,
+        FAISS_INDEX_FILE,
+        META_DB_FILE,
+        compact,
+        compact_in_background,
+        is_supported,
+        load_index,
+        update_index,
+    )
+    from index_worker import IndexWorker, JobProgress
+    from shared_index import (
+        INDEX_POINTER_FILE,
+        SharedIndex,
+        current_generation,
+        remove_generation,
+    )
+    from answer_cache import get_answer_cache
+    from context_packer import pack_context
+    from reranker import mmr_select, score_candidates
 except Exception as e:
     st.error("Failed to import document_processors: %s" % e)
     st.stop()
@@ -67,9 +82,60 @@ except Exception as e:
 # =========================
 # App Constants & Settings
 # =========================
-EMBEDDINGS_FILE = "embeddings_meta.pkl"
-FAISS_INDEX_FILE = "faiss_index.bin"
 TOP_K = 10  # Tăng lên để có nhiều candidates cho reranking
+RRF_K = 60
+# Số candidates đưa vào rerank (mặc định 2 x số nguồn tham chiếu)
+RERANK_CANDIDATES = int(st.secrets.get("RERANK_CANDIDATES", 0))
+# MMR: 1.0 = chỉ theo relevance, nhỏ hơn = ưu tiên nguồn khác nhau hơn
+MMR_LAMBDA = float(st.secrets.get("MMR_LAMBDA", 0.7))
+
+# Lựa chọn trong selectbox -> chế độ tìm kiếm; trọng số rerank (semantic, keyword, type)
+SEARCH_MODES = {
+    "Hybrid (khuyến nghị)": "hybrid",
+    "Semantic only": "semantic",
+    "Keyword priority": "keyword",
+}
+RERANK_WEIGHTS = {
+    "hybrid": (0.65, 0.25, 0.10),
+    "semantic": (0.90, 0.0, 0.10),
+    "keyword": (0.35, 0.55, 0.10),
+}
+
+# Mức song song cho từng stage của pipeline ingest (cấu hình qua secrets)
+INGEST_DOWNLOAD_WORKERS = int(st.secrets.get("INGEST_DOWNLOAD_WORKERS", 4))
+INGEST_PARSE_WORKERS = int(st.secrets.get("INGEST_PARSE_WORKERS", 2))
+INGEST_EMBED_WORKERS = int(st.secrets.get("INGEST_EMBED_WORKERS", 4))
+
+# Loại index FAISS: auto (theo số chunks) | flat | hnsw | ivf_flat | ivf_pq.
+# ANN_NPROBE / ANN_EF_SEARCH = 0 thì dùng giá trị đã tune theo ANN_RECALL_TARGET.
+ANN_INDEX_TYPE = st.secrets.get("ANN_INDEX_TYPE", "auto")
+ANN_NPROBE = int(st.secrets.get("ANN_NPROBE", 0))
+ANN_EF_SEARCH = int(st.secrets.get("ANN_EF_SEARCH", 0))
+ANN_RECALL_TARGET = float(st.secrets.get("ANN_RECALL_TARGET", 0.95))
+
+LLM_MODEL = "gpt-4o-mini"
+# Ngân sách token cho context theo "Độ chi tiết câu trả lời"
+CONTEXT_BUDGETS = {
+    "Ngắn gọn": int(st.secrets.get("CONTEXT_BUDGET_SHORT", 2000)),
+    "Trung bình": int(st.secrets.get("CONTEXT_BUDGET_MEDIUM", 4000)),
+    "Chi tiết": int(st.secrets.get("CONTEXT_BUDGET_DETAILED", 8000)),
+}
+# Hiển thị câu trả lời dần theo token (False = chờ đủ câu trả lời rồi mới hiển thị)
+LLM_STREAMING = bool(st.secrets.get("LLM_STREAMING", True))
+LLM_ERROR_ANSWER = "Xin lỗi, đã có lỗi khi tạo câu trả lời. Vui lòng thử lại."
+# Cache câu trả lời: cùng tập chunks + câu hỏi có cosine >= ngưỡng thì dùng lại
+ANSWER_CACHE_TTL_HOURS = float(st.secrets.get("ANSWER_CACHE_TTL_HOURS", 24))
+ANSWER_CACHE_SIMILARITY = float(st.secrets.get("ANSWER_CACHE_SIMILARITY", 0.92))
+# Thời gian cache danh sách file trên Drive (giây)
+DRIVE_LIST_TTL = int(st.secrets.get("DRIVE_LIST_TTL", 300))
+# Worker nền tự đồng bộ Drive sau mỗi INDEX_POLL_MINUTES phút rảnh (0 = tắt);
+# sidebar làm mới tiến độ mỗi INDEX_STATUS_REFRESH giây
+INDEX_POLL_MINUTES = float(st.secrets.get("INDEX_POLL_MINUTES", 10))
+INDEX_STATUS_REFRESH = float(st.secrets.get("INDEX_STATUS_REFRESH", 2))
+# "drive": app tự ingest từ Drive; "cli": chỉ load index do ingest_cli.py ghi ra
+INDEX_SOURCE = st.secrets.get("INDEX_SOURCE", "drive")
+# Upload cache index lên DRIVE_FOLDER_ID sau mỗi lần cập nhật (instance khác tải về thay vì ingest lại)
+DRIVE_CACHE_UPLOAD = bool(st.secrets.get("DRIVE_CACHE_UPLOAD", False))
 
 st.set_page_config(page_title="VNA Tech", layout="wide")
 
@@ -143,273 +209,288 @@ def logout_button():
 def _drive_service():
     return authenticate_drive()
 
-def _list_drive_files() -> List[Dict[str, Any]]:
+@st.cache_data(ttl=DRIVE_LIST_TTL, show_spinner=False)
+def _drive_listing(folder_id: str) -> Dict[str, Any]:
+    """Files PDF/PPTX của folder + changed (changes feed báo có file thêm/sửa/xoá);
+    cache DRIVE_LIST_TTL giây nên rerun trong khoảng đó không gọi Drive"""
+    # Changes feed: chỉ đọc các thay đổi kể từ lần sync trước (UI và worker nền đều gọi,
+    # mỗi thread dùng service riêng)
+    sync = sync_folder(thread_local_service(), folder_id)
+    changed = any(is_supported(f) for f in sync["added"] + sync["modified"]) or bool(sync["removed"])
+    return {
+        "files": [f for f in sync["files"] if is_supported(f)],
+        "changed": changed,
+        "synced_at": time.time(),
+    }
+
+def _list_drive_files() -> Dict[str, Any]:
     folder_id = st.secrets.get("DRIVE_FOLDER_ID")
     if not folder_id:
         st.error("DRIVE_FOLDER_ID is missing in secrets.")
         st.stop()
-    service = _drive_service()
-    files = list_files_in_folder(service, folder_id)
-    filtered = []
-    for f in files:
-        name = f.get("name", "")
-        if name.lower().endswith(".pdf") or name.lower().endswith(".pptx"):
-            filtered.append(f)
-    return filtered
+    return _drive_listing(folder_id)
 
 # =========================
 # Embeddings Store & FAISS (giữ nguyên logic cũ)
 # =========================
-def _try_load_local_index():
-    if os.path.exists(EMBEDDINGS_FILE) and os.path.exists(FAISS_INDEX_FILE):
-        try:
-            with open(EMBEDDINGS_FILE, "rb") as f:
-                meta = pickle.load(f)
-            index = faiss.read_index(FAISS_INDEX_FILE)
-            return index, meta
-        except Exception:
-            return None, None
-    return None, None
-
-def _load_or_pull_cache_from_drive() -> Tuple[Any, List[Dict[str, Any]]]:
-    idx, meta = _try_load_local_index()
-    if idx is not None and meta is not None:
-        return idx, meta
-    service = _drive_service()
+def _configure(store: ChunkIndex) -> ChunkIndex:
+    store.configure_ann(index_type=ANN_INDEX_TYPE, nprobe=ANN_NPROBE,
+                        ef_search=ANN_EF_SEARCH, recall_target=ANN_RECALL_TARGET)
+    return store
+
+def _current_generation() -> Dict[str, Any]:
+    return current_generation(FAISS_INDEX_DIR, META_DB_FILE)
+
+def _try_load_local_index() -> Optional[ChunkIndex]:
+    store = load_index(FAISS_INDEX_DIR, META_DB_FILE)
+    return _configure(store) if store is not None else None
+
+def _load_or_pull_cache_from_drive() -> Optional[ChunkIndex]:
+    store = _try_load_local_index()
+    if store is not None:
+        return store
+    service = thread_local_service()
     folder_id = st.secrets.get("DRIVE_FOLDER_ID")
+    if download_index_cache(service, folder_id, FAISS_INDEX_DIR, META_DB_FILE):
+        store = _try_load_local_index()
+        if store is not None:
+            return store
+    # Cache định dạng cũ (pickle + một file FAISS): load_index sẽ migrate
     paths = download_embeddings_from_drive(service, folder_id, EMBEDDINGS_FILE, FAISS_INDEX_FILE)
     if paths.get("embeddings_path") and paths.get("faiss_path"):
-        try:
-            with open(EMBEDDINGS_FILE, "rb") as f:
-                meta = pickle.load(f)
-            idx = faiss.read_index(FAISS_INDEX_FILE)
-            return idx, meta
-        except Exception:
-            pass
-    return None, None
-
-def _get_processed_file_ids(meta: List[Dict[str, Any]]) -> set:
-    if not meta:
-        return set()
-    return {item.get("file_id") for item in meta if item.get("file_id")}
-
-def _build_or_load_index(process_all: bool = False) -> Tuple[Any, List[Dict[str, Any]]]:
-    service = _drive_service()
-    files = _list_drive_files()
-    
-    existing_index = None
-    existing_meta = []
-    processed_ids = set()
-    
-    if not process_all:
-        existing_index, existing_meta = _load_or_pull_cache_from_drive()
-        if existing_index is not None and existing_meta is not None:
-            processed_ids = _get_processed_file_ids(existing_meta)
-            st.info(f"📦 Đã load {len(existing_meta)} chunks từ {len(processed_ids)} files có sẵn")
-
-    new_files = [f for f in files if f["id"] not in processed_ids]
-    
-    if not new_files and existing_index is not None:
-        st.success("✅ Không có file mới. Sử dụng index hiện tại.")
-        return existing_index, existing_meta
-    
-    if new_files:
-        st.info(f"📄 Phát hiện {len(new_files)} file mới cần xử lý")
-    
-    new_vectors = []
-    new_meta: List[Dict[str, Any]] = []
-
-    progress = st.progress(0.0, text="Processing new documents...")
-    n = max(len(new_files), 1)
-    
-    for i, f in enumerate(new_files, start=1):
-        file_id = f["id"]
-        file_name = f["name"]
-        file_mtime = f.get("modifiedTime")
-        progress.progress(i / n, text="Processing %s (%d/%d)" % (file_name, i, len(new_files)))
-
-        try:
-            content: BytesIO = download_file(service, file_id)
-        except Exception as e:
-            st.warning("Failed to download '%s': %s" % (file_name, e))
-            continue
+        return _try_load_local_index()
+    return None
 
-        try:
-            if file_name.lower().endswith(".pdf"):
-                text, meta = process_pdf(content)
-            elif file_name.lower().endswith(".pptx"):
-                text, meta = process_pptx(content)
-            else:
-                continue
-        except Exception as e:
-            st.warning("Failed to parse '%s': %s" % (file_name, e))
-            continue
+@st.cache_resource(show_spinner=False)
+def _index_state() -> Dict[str, Any]:
+    """Index dùng chung cho mọi session và mọi rerun trong process"""
+    return {"shared": SharedIndex(), "synced_at": None, "disk_stamp": None}
+
+def _answer_cache():
+    return get_answer_cache(ttl_seconds=ANSWER_CACHE_TTL_HOURS * 3600, similarity=ANSWER_CACHE_SIMILARITY)
+
+def _clear_local_index(shared: SharedIndex) -> None:
+    """Gỡ index đang phục vụ và xoá mọi file cache local"""
+    with shared.writer():
+        old = shared.swap(None)
+        if old is not None:
+            old.store.close()
+        remove_generation(_current_generation())
+        for path in (INDEX_POINTER_FILE, EMBEDDINGS_FILE, FAISS_INDEX_FILE):
+            if os.path.exists(path):
+                os.remove(path)
+    _answer_cache().clear()
 
-        chunks = chunk_text_smart(text, meta, chunk_size=1000, chunk_overlap=200)
-        texts = [c["text"] for c in chunks]
-        
+@st.cache_resource(show_spinner=False)
+def _download_pool() -> DownloadPool:
+    """Thread download dùng chung giữa các job; mỗi thread giữ client + kết nối Drive riêng"""
+    return DownloadPool(INGEST_DOWNLOAD_WORKERS)
+
+def _build_or_load_index(shared: SharedIndex, files: List[Dict[str, Any]], progress: JobProgress,
+                         process_all: bool = False) -> None:
+    """Load index (nếu chưa có) và đưa các thay đổi trên Drive vào index dùng chung.
+
+    Chạy trên worker nền (một job tại một thời điểm); xem indexer.update_index.
+    """
+    answer_cache = _answer_cache()
+    update_index(
+        shared, files,
+        # Stream ra file tạm (kiểm tra md5Checksum), xoá sau khi parse
+        download_fn=_download_pool().download,
+        release_fn=os.remove,
+        progress=progress,
+        index_dir=FAISS_INDEX_DIR,
+        meta_path=META_DB_FILE,
+        process_all=process_all,
+        load_fn=_load_or_pull_cache_from_drive,
+        configure=_configure,
+        on_removed=answer_cache.invalidate_files,
+        on_rebuilt=answer_cache.clear,
+        download_workers=INGEST_DOWNLOAD_WORKERS,
+        parse_workers=INGEST_PARSE_WORKERS,
+        embed_workers=INGEST_EMBED_WORKERS,
+    )
+    if not DRIVE_CACHE_UPLOAD:
+        compact_in_background(shared)
+        return
+    # Compact trước để bản upload là bản cuối cùng; file không đổi md5 không upload lại
+    compact(shared)
+    result = upload_index_cache(shared, thread_local_service(), st.secrets.get("DRIVE_FOLDER_ID"),
+                                FAISS_INDEX_DIR, META_DB_FILE)
+    progress.info("☁️ Cache index trên Drive: %d file upload, %d không đổi, %d file cũ đã xoá" % (
+        result["uploaded"], result["skipped"], result["deleted"]))
+
+def _disk_stamp() -> Tuple[int, float, float]:
+    """(generation, mtime manifest, mtime meta) của index trên đĩa; đổi sau mỗi lần CLI lưu"""
+    gen = _current_generation()
+    stamp = [gen["generation"]]
+    for path in (os.path.join(gen["index_dir"], MANIFEST_FILE), gen["meta_path"]):
         try:
-            vecs = get_embeddings(texts, batch_size=100)
-        except Exception as e:
-            st.error("Embedding failed for %s: %s" % (file_name, e))
-            continue
+            stamp.append(os.path.getmtime(path))
+        except OSError:
+            stamp.append(0.0)
+    return tuple(stamp)
+
+def _reload_from_disk(shared: SharedIndex, progress: JobProgress) -> None:
+    """INDEX_SOURCE = "cli": chỉ load lại index do ingest_cli.py ghi ra khi trên đĩa đã đổi"""
+    state = _index_state()
+    with shared.writer():
+        stamp = _disk_stamp()
+        if shared.store is not None and stamp == state["disk_stamp"]:
+            progress.success("✅ Index trên đĩa không đổi.")
+            return
+        store = _try_load_local_index()
+        if store is None:
+            # Không thử lại cho tới khi trên đĩa có thay đổi
+            state["disk_stamp"] = stamp
+            raise RuntimeError("Chưa có index trên đĩa. Chạy `python ingest_cli.py` để tạo index.")
+        old = shared.swap(store)
+        state["disk_stamp"] = stamp
+        # Không biết file nào đổi: bỏ toàn bộ câu trả lời đã cache
+        _answer_cache().clear()
+        if old is not None:
+            old.store.close()
+    progress.success(f"📦 Đã load {len(store)} chunks từ {len(store.file_ids())} files (ingest_cli.py)")
+
+_JOB_LABELS = {"update": "Cập nhật index", "rebuild": "Rebuild toàn bộ", "clear": "Xoá cache local"}
+
+def _run_index_job(job: Dict[str, Any], progress: JobProgress) -> None:
+    """Chạy trên worker nền: không dùng st.* để hiển thị, chỉ ghi vào progress"""
+    shared = _index_state()["shared"]
+    if job["kind"] == "clear":
+        _clear_local_index(shared)
+        progress.success("Đã xoá cache local.")
+        return
+    if INDEX_SOURCE == "cli":
+        _reload_from_disk(shared, progress)
+        return
+    folder_id = st.secrets.get("DRIVE_FOLDER_ID")
+    if not folder_id:
+        raise RuntimeError("DRIVE_FOLDER_ID is missing in secrets.")
+    # Luôn lấy danh sách mới nhất từ changes feed (và làm mới cache của UI)
+    _drive_listing.clear()
+    files = _drive_listing(folder_id)["files"]
+    _build_or_load_index(shared, files, progress, process_all=job["kind"] == "rebuild")
 
-        for j, c in enumerate(chunks):
-            new_vectors.append(vecs[j])
-            row = {"file_id": file_id, "file_name": file_name, "modified_time": file_mtime}
-            row.update(c)
-            new_meta.append(row)
-    
-    progress.progress(1.0, text="Hoàn thành xử lý file mới")
-    
-    if not new_vectors and not existing_meta:
-        st.error("No embeddings were created. Please check your Drive folder and parsers.")
-        st.stop()
-    
-    if new_vectors:
-        new_mat = np.array(new_vectors, dtype="float32")
-        faiss.normalize_L2(new_mat)
-        
-        if existing_index is not None and existing_meta:
-            existing_index.add(new_mat)
-            combined_meta = existing_meta + new_meta
-            st.success(f"✅ Đã thêm {len(new_vectors)} chunks mới vào index (tổng: {len(combined_meta)} chunks)")
-            index = existing_index
-            all_meta = combined_meta
+@st.cache_resource(show_spinner=False)
+def _index_worker() -> IndexWorker:
+    """Worker nền dùng chung trong process; vẫn chạy khi không còn session nào mở.
+
+    Streamlit chỉ chạy script khi có session kết nối, nên worker khởi động từ
+    session đầu tiên sau khi server start (xem README; chạy ingest_cli.py theo
+    lịch nếu cần cập nhật không phụ thuộc người dùng).
+    """
+    return IndexWorker(_run_index_job, poll_interval=INDEX_POLL_MINUTES * 60)
+
+def _format_seconds(seconds: float) -> str:
+    seconds = int(seconds)
+    return "%dm%02ds" % (seconds // 60, seconds % 60) if seconds >= 60 else "%ds" % seconds
+
+@st.fragment(run_every=INDEX_STATUS_REFRESH)
+def _indexing_status(worker: IndexWorker) -> None:
+    """Tiến độ + ETA của job đang chạy, tự làm mới; vẽ lại trang khi index đã đổi"""
+    status = worker.status()
+    running = status["running"]
+    if running is not None:
+        st.caption("⏳ **%s**%s" % (_JOB_LABELS.get(running["kind"], running["kind"]),
+                                    " (tự động)" if running["scheduled"] else ""))
+        fraction = running["done"] / running["total"] if running["total"] else 0.0
+        st.progress(min(fraction, 1.0), text=running["text"] or "Đang chuẩn bị...")
+        eta = running["eta"]
+        st.caption("Đã chạy %s%s" % (_format_seconds(running["elapsed"]),
+                                     "" if eta is None else ", còn khoảng %s" % _format_seconds(eta)))
+    if status["pending"]:
+        st.caption("Đang chờ: %s" % ", ".join(_JOB_LABELS.get(k, k) for k in status["pending"]))
+    last = status["last"]
+    if last is not None and running is None:
+        label = _JOB_LABELS.get(last["kind"], last["kind"])
+        if last["error"]:
+            st.caption("❌ %s lỗi: %s" % (label, last["error"]))
         else:
-            index = faiss.IndexFlatIP(new_mat.shape[1])
-            index.add(new_mat)
-            all_meta = new_meta
-            st.success(f"✅ Đã tạo index mới với {len(new_meta)} chunks")
-    else:
-        index = existing_index
-        all_meta = existing_meta
-
-    with open(EMBEDDINGS_FILE, "wb") as f:
-        pickle.dump(all_meta, f)
-    faiss.write_index(index, FAISS_INDEX_FILE)
-
-    return index, all_meta
+            st.caption("✅ %s xong sau %s" % (label, _format_seconds(last["elapsed"])))
+    messages = (running or last or {}).get("messages", [])
+    if messages:
+        with st.expander("Nhật ký cập nhật index", expanded=False):
+            for m in messages[-20:]:
+                st.caption(m["message"])
+
+    # INDEX_SOURCE = "cli": ingest_cli.py vừa publish generation mới thì load lại ngay,
+    # không chờ tới lượt poll của worker
+    if (INDEX_SOURCE == "cli" and running is None and "update" not in status["pending"]
+            and _disk_stamp() != _index_state()["disk_stamp"]):
+        worker.submit("update")
+
+    # Index vừa được cập nhật / swap: vẽ lại cả trang với index mới
+    if _index_state()["shared"].version != st.session_state.get("index_version"):
+        st.rerun()
 
 # =========================
 # Enhanced Retrieval & Reranking
 # =========================
 def _embed_query(client: OpenAI, query: str) -> np.ndarray:
-    resp = client.embeddings.create(model="text-embedding-3-small", input=[query])
-    v = np.array(resp.data[0].embedding, dtype="float32")
+    v = np.array(embed_query(query, client), dtype="float32")
     v = v / np.linalg.norm(v)
     return v
 
-def _keyword_score(query: str, text: str, key_terms: List[str]) -> float:
-    """Tính keyword matching score"""
-    query_lower = query.lower()
-    text_lower = text.lower()
-    
-    score = 0.0
-    query_words = set(query_lower.split())
-    text_words = set(text_lower.split())
-    
-    # Exact word matches
-    common_words = query_words & text_words
-    score += len(common_words) * 0.1
-    
-    # Key terms matching
-    for term in key_terms:
-        if term.lower() in query_lower:
-            if term.lower() in text_lower:
-                score += 0.3
-    
-    # Phrase matching (bigrams)
-    query_bigrams = set(zip(query_lower.split()[:-1], query_lower.split()[1:]))
-    text_tokens = text_lower.split()
-    text_bigrams = set(zip(text_tokens[:-1], text_tokens[1:]))
-    common_bigrams = query_bigrams & text_bigrams
-    score += len(common_bigrams) * 0.2
-    
-    return min(score, 1.0)
-
-def _rerank_results(query: str, results: List[Dict[str, Any]], top_k: int = 10) -> List[Dict[str, Any]]:
-    """Rerank kết quả dựa trên nhiều yếu tố"""
-    
-    for r in results:
-        # Semantic similarity (từ FAISS)
-        semantic_score = r["similarity"]
-        
-        # Keyword matching
-        all_terms = r.get("local_key_terms", [])
-        keyword_score = _keyword_score(query, r["text"], all_terms)
-        
-        # Content type bonus
-        content_type = r.get("content_type", "general")
-        type_bonus = 0.0
-        if content_type in ["procedure", "specification"]:
-            type_bonus = 0.1
-        elif content_type == "safety_note":
-            type_bonus = 0.15
-        
-        # Section completeness bonus
-        if r.get("is_complete_section", False):
-            type_bonus += 0.05
-        
-        # Has structure bonus (tables, lists)
-        if r.get("has_tables", False):
-            type_bonus += 0.05
-        if r.get("has_lists", False):
-            type_bonus += 0.03
-        
-        # Combined score với trọng số
-        combined_score = (
-            semantic_score * 0.65 +
-            keyword_score * 0.25 +
-            type_bonus * 0.10
-        )
-        
-        r["rerank_score"] = combined_score
-        r["keyword_score"] = keyword_score
-    
-    # Sắp xếp theo rerank_score
-    reranked = sorted(results, key=lambda x: x["rerank_score"], reverse=True)
-    
-    # Diversify: đảm bảo có chunks từ nhiều files khác nhau
-    diverse_results = []
-    file_counts = defaultdict(int)
-    max_per_file = max(2, top_k // 3)
-    
-    for r in reranked:
-        file_name = r["file_name"]
-        if file_counts[file_name] < max_per_file or len(diverse_results) < top_k:
-            diverse_results.append(r)
-            file_counts[file_name] += 1
-            if len(diverse_results) >= top_k:
-                break
-    
-    # Nếu không đủ, lấy thêm
-    if len(diverse_results) < top_k:
-        for r in reranked:
-            if r not in diverse_results:
-                diverse_results.append(r)
-                if len(diverse_results) >= top_k:
-                    break
-    
-    return diverse_results[:top_k]
-
-def _search(index, meta: List[Dict[str, Any]], qvec: np.ndarray, query: str, topk: int = TOP_K):
-    """Enhanced search với reranking"""
-    # FAISS search - lấy nhiều candidates hơn
-    D, I = index.search(qvec.reshape(1, -1), topk * 2)
-    
-    candidates = []
-    for score, idx in zip(D[0].tolist(), I[0].tolist()):
-        if idx < 0 or idx >= len(meta):
+def _rrf_fuse(ranked_lists: List[List[int]], weights: List[float], k: int = RRF_K) -> List[int]:
+    """Reciprocal Rank Fusion: gộp nhiều danh sách chunk_id đã xếp hạng"""
+    scores: Dict[int, float] = defaultdict(float)
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, cid in enumerate(ranked):
+            scores[cid] += weight / (k + rank + 1)
+    return sorted(scores, key=lambda cid: scores[cid], reverse=True)
+
+def _search(store: ChunkIndex, qvec: np.ndarray, query: str, topk: int = TOP_K, mode: str = "hybrid",
+            mmr_lambda: float = MMR_LAMBDA):
+    """Tìm candidates theo chế độ (semantic / keyword / hybrid), rerank rồi đa dạng hoá bằng MMR"""
+    n_candidates = max(topk * 2, RERANK_CANDIDATES)
+    similarity: Dict[int, float] = {}
+    bm25: Dict[int, float] = {}
+
+    if mode == "semantic":
+        hits = store.search_ids(qvec, n_candidates)
+        similarity = {cid: score for score, cid in hits}
+        ids = [cid for _, cid in hits]
+    elif mode == "keyword":
+        hits = store.lexical_search(query, n_candidates)
+        bm25 = {cid: score for score, cid in hits}
+        ids = [cid for _, cid in hits]
+    else:
+        # Hybrid: lấy nhiều hơn từ mỗi nguồn rồi gộp bằng RRF
+        vector_hits = store.search_ids(qvec, n_candidates * 2)
+        lexical_hits = store.lexical_search(query, n_candidates * 2)
+        similarity = {cid: score for score, cid in vector_hits}
+        bm25 = {cid: score for score, cid in lexical_hits}
+        ids = _rrf_fuse([[cid for _, cid in vector_hits], [cid for _, cid in lexical_hits]],
+                        weights=[1.0, 1.0])[:n_candidates]
+
+    if not ids:
+        return []
+
+    # Chunk chỉ đến từ BM25 chưa có similarity: tính từ vector lưu trong index
+    missing = [cid for cid in ids if cid not in similarity]
+    if missing:
+        for cid, score in zip(missing, (store.vectors(missing) @ qvec).tolist()):
+            similarity[cid] = float(score)
+
+    # Rerank toàn bộ candidates bằng mảng features, chọn top-k bằng MMR trên
+    # vector của candidates, chỉ đọc meta + text của top-k
+    sims = np.array([similarity[cid] for cid in ids], dtype="float64")
+    scores, keyword = score_candidates(query, sims, store.features(ids), weights=RERANK_WEIGHTS[mode])
+    top = mmr_select(scores, store.vectors(ids), topk, lam=mmr_lambda)
+    rows = store.rows([ids[i] for i in top], with_text=True)
+    results = []
+    for i in top.tolist():
+        cid = ids[i]
+        if cid not in rows:
             continue
-        item = meta[idx].copy()
-        item["similarity"] = float(score)
-        candidates.append(item)
-    
-    # Rerank
-    final_results = _rerank_results(query, candidates, top_k=topk)
-    
-    return final_results
+        item = rows[cid]
+        item["similarity"] = similarity[cid]
+        item["bm25_score"] = bm25.get(cid, 0.0)
+        item["rerank_score"] = float(scores[i])
+        item["keyword_score"] = float(keyword[i])
+        results.append(item)
+    return results
 
 def _format_context(chunks: List[Dict[str, Any]]) -> str:
     """Format context với metadata phong phú"""
@@ -429,6 +510,8 @@ def _format_context(chunks: List[Dict[str, Any]]) -> str:
         content_type = c.get("content_type", "general")
         
         header = f"[{i}] {file_name} | {section}{title_str}\n"
+        if len(c.get("chunk_ids", [])) > 1:
+            header += f"(gộp {len(c['chunk_ids'])} đoạn liên tiếp)\n"
         header += f"Type: {content_type} | Relevance: {c.get('rerank_score', 0):.3f}\n"
         
         # Đánh dấu nếu có tables/lists
@@ -442,7 +525,7 @@ def _format_context(chunks: List[Dict[str, Any]]) -> str:
     
     return "\n\n═══════════════════\n\n".join(blocks)
 
-def _ask_llm(client: OpenAI, question: str, chunks: List[Dict[str, Any]]) -> str:
+def _llm_messages(question: str, chunks: List[Dict[str, Any]]) -> List[Dict[str, str]]:
     """Enhanced LLM prompting với CoT và structured output"""
     context = _format_context(chunks)
     
@@ -473,79 +556,150 @@ NGUỒN THAM CHIẾU:
 
 Hãy trả lời câu hỏi dựa trên các nguồn trên. Nhớ trích dẫn nguồn bằng [số]."""
 
-    messages = [
+    return [
         {"role": "system", "content": system},
         {"role": "user", "content": user_msg},
     ]
-    
+
+def _ask_llm(client: OpenAI, question: str, chunks: List[Dict[str, Any]]) -> str:
     try:
         resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
+            model=LLM_MODEL,
+            messages=_llm_messages(question, chunks),
             temperature=0.1,
             max_tokens=2000,
         )
         return resp.choices[0].message.content
     except Exception as e:
         st.error(f"LLM API error: {e}")
-        return "Xin lỗi, đã có lỗi khi tạo câu trả lời. Vui lòng thử lại."
+        return LLM_ERROR_ANSWER
+
+def _stream_llm(client: OpenAI, question: str, chunks: List[Dict[str, Any]], state: Dict[str, Any]):
+    """Generator trả về từng đoạn câu trả lời (dùng với st.write_stream).
+
+    state ghi lại text đã nhận, completed và thời gian tới token đầu tiên.
+    Khi generator bị đóng giữa chừng (người dùng bấm Dừng / rerun), request
+    tới API bị huỷ và phần đã nhận được giữ trong session_state["partial_answer"].
+    """
+    state.update(text="", completed=False, first_token=None)
+    start = time.perf_counter()
+    try:
+        stream = client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=_llm_messages(question, chunks),
+            temperature=0.1,
+            max_tokens=2000,
+            stream=True,
+        )
+    except Exception as e:
+        st.error(f"LLM API error: {e}")
+        yield LLM_ERROR_ANSWER
+        return
+    try:
+        for event in stream:
+            if not event.choices:
+                continue
+            delta = event.choices[0].delta.content
+            if delta:
+                if state["first_token"] is None:
+                    state["first_token"] = time.perf_counter() - start
+                state["text"] += delta
+                yield delta
+        state["completed"] = True
+    except Exception as e:
+        st.error(f"LLM API error: {e}")
+        yield "\n\n" + LLM_ERROR_ANSWER
+    finally:
+        stream.close()
+        if not state["completed"] and state["text"]:
+            st.session_state["partial_answer"] = {"question": question, "text": state["text"]}
 
 # =========================
 # UI
 # =========================
-def sidebar_panel(index, meta):
+def sidebar_panel(store: ChunkIndex, files: List[Dict[str, Any]], worker: IndexWorker):
     st.sidebar.header("VNA Techinsight")
+    with st.sidebar:
+        _indexing_status(worker)
     
-    processed_ids = _get_processed_file_ids(meta)
+    processed_ids = store.file_ids()
     with st.sidebar.expander("📊 Thống kê", expanded=True):
         st.metric("Số files đã xử lý", len(processed_ids))
-        st.metric("Tổng số chunks", len(meta) if meta else 0)
+        st.metric("Tổng số chunks", len(store))
         
         # Thống kê content types
-        if meta:
-            content_types = [m.get("content_type", "general") for m in meta]
-            type_counts = pd.Series(content_types).value_counts()
+        type_counts = store.content_type_counts()
+        if type_counts:
             st.caption("**Content Types:**")
             for ctype, count in type_counts.items():
                 st.caption(f"  • {ctype}: {count}")
         
+        cache_stats = embedding_cache_stats()
+        if cache_stats:
+            st.caption(
+                "**Embedding cache:** %d hit / %d miss, %d vectors (%s)" % (
+                    cache_stats["hits"], cache_stats["misses"], cache_stats["entries"],
+                    format_file_size(cache_stats["size_bytes"]),
+                )
+            )
+        answer_stats = _answer_cache().stats()
+        if answer_stats["hits"] + answer_stats["misses"]:
+            st.caption("**Answer cache:** hit rate %.0f%% (%d hit / %d miss), %d câu trả lời" % (
+                100 * answer_stats["hit_rate"], answer_stats["hits"], answer_stats["misses"],
+                answer_stats["entries"]))
+        query_stats = query_cache_stats()
+        if query_stats["memory_hits"] + query_stats["disk_hits"] + query_stats["misses"]:
+            st.caption(
+                "**Query cache:** hit rate %.0f%% (%d RAM / %d đĩa / %d API), tiết kiệm ~%.1fs" % (
+                    100 * query_stats["hit_rate"], query_stats["memory_hits"], query_stats["disk_hits"],
+                    query_stats["misses"], query_stats["saved_seconds"],
+                )
+            )
+        
         st.caption("Cache được lưu **local-only** trong phiên chạy.")
     
     st.sidebar.divider()
     
     with st.sidebar.expander("🔧 Quản lý Index", expanded=False):
-        st.write("**Embeddings**: `%s`" % EMBEDDINGS_FILE)
-        st.write("**FAISS index**: `%s`" % FAISS_INDEX_FILE)
+        st.write("**Metadata**: `%s`" % store.store.path)
+        st.write("**FAISS index**: `%s/` (%d segment)" % (store.index_dir, len(store.segments)))
+        for seg in store.segments:
+            recall = seg.params.get("recall")
+            st.caption("  • %s: %d vectors%s" % (
+                seg.spec, seg.index.ntotal, "" if recall is None else ", recall@10 %.3f" % recall))
+        if st.button("🎯 Kiểm tra recall@10", use_container_width=True):
+            # Đo sau khi nhả khoá đọc index (xem main) để không chặn cập nhật index
+            st.session_state["check_recall"] = True
+        if "recall_at_10" in st.session_state:
+            st.caption("recall@10 hiện tại: %.3f" % st.session_state["recall_at_10"])
         st.divider()
         
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("🔄 Cập nhật (chỉ file mới)", use_container_width=True):
-                st.session_state["force_rebuild"] = False
+        if INDEX_SOURCE == "cli":
+            # Index do ingest_cli.py quản lý: app chỉ load lại, không ingest hay xoá
+            st.caption("Index được tạo bởi `ingest_cli.py`.")
+            if st.button("🔄 Load lại index từ đĩa", use_container_width=True):
+                st.session_state["refresh_index"] = True
                 st.rerun()
-        with col2:
-            if st.button("🔨 Rebuild toàn bộ", type="secondary", use_container_width=True):
-                st.session_state["force_rebuild"] = True
+        else:
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("🔄 Cập nhật (chỉ file mới)", use_container_width=True):
+                    st.session_state["force_rebuild"] = False
+                    st.session_state["refresh_index"] = True
+                    _drive_listing.clear()
+                    st.rerun()
+            with col2:
+                if st.button("🔨 Rebuild toàn bộ", type="secondary", use_container_width=True):
+                    st.session_state["force_rebuild"] = True
+                    _drive_listing.clear()
+                    st.rerun()
+
+            if st.button("🗑️ Xoá cache (local)", type="secondary", use_container_width=True):
+                # Xoá ở đầu lần chạy sau, khi session không còn giữ khoá đọc index
+                st.session_state["clear_index"] = True
                 st.rerun()
-        
-        if st.button("🗑️ Xoá cache (local)", type="secondary", use_container_width=True):
-            try:
-                if os.path.exists(EMBEDDINGS_FILE):
-                    os.remove(EMBEDDINGS_FILE)
-                if os.path.exists(FAISS_INDEX_FILE):
-                    os.remove(FAISS_INDEX_FILE)
-            except Exception:
-                pass
-            st.success("Đã xoá cache local.")
-            st.rerun()
 
     st.sidebar.divider()
-    
-    try:
-        files = _list_drive_files()
-    except Exception as e:
-        st.sidebar.error("Lỗi liệt kê Drive: %s" % e)
-        files = []
 
     if files:
         st.sidebar.subheader("📁 Tài liệu trong Drive")
@@ -575,10 +729,56 @@ def main():
     client = OpenAI(api_key=api_key)
 
     force = st.session_state.get("force_rebuild", False)
-    index, meta = _build_or_load_index(process_all=force)
+    refresh = st.session_state.pop("refresh_index", False)
+    if INDEX_SOURCE == "cli":
+        # Không liệt kê Drive: worker chỉ load lại index khi ingest_cli.py đã ghi bản mới
+        listing = {"files": [], "changed": False, "synced_at": None}
+    else:
+        try:
+            listing = _list_drive_files()
+        except Exception as e:
+            st.error("Lỗi liệt kê Drive: %s" % e)
+            st.stop()
+    files = listing["files"]
+    # Chỉ ingest khi chưa có index, khi bấm cập nhật/rebuild, hoặc khi changes feed
+    # báo thay đổi mới; rerun thông thường dùng lại index đã load, không có I/O
+    # Cập nhật index chạy trên worker nền; trang tiếp tục phục vụ index hiện tại
+    state = _index_state()
+    shared = state["shared"]
+    worker = _index_worker()
+    new_changes = listing["changed"] and listing["synced_at"] != state["synced_at"]
+    if st.session_state.pop("clear_index", False):
+        worker.submit("clear")
+    elif force:
+        worker.submit("rebuild")
+    elif shared.store is None or refresh or new_changes:
+        worker.submit("update")
+    state["synced_at"] = listing["synced_at"]
     st.session_state["force_rebuild"] = False
 
-    sidebar_panel(index, meta)
+    # Lần đầu: chờ một chút để worker load index có sẵn trên đĩa (job vừa
+    # submit thường còn trong hàng đợi, chưa chạy)
+    deadline = time.time() + 5
+    while shared.store is None and time.time() < deadline:
+        status = worker.status()
+        if status["running"] is None and not status["pending"]:
+            break
+        time.sleep(0.1)
+    st.session_state["index_version"] = shared.version
+
+    with shared.read() as index:
+        if index is None:
+            st.info("⏳ Đang chuẩn bị index, trang sẽ tự cập nhật khi xong.")
+            with st.sidebar:
+                _indexing_status(worker)
+            st.stop()
+        sidebar_panel(index, files, worker)
+
+    if st.session_state.pop("check_recall", False):
+        # Quét exact toàn corpus: chạy ngoài shared.read(), index cũ vẫn dùng được nếu vừa bị swap
+        with st.spinner("Đang so sánh với tìm kiếm exact..."):
+            st.session_state["recall_at_10"] = index.recall_check()
+        st.rerun()
 
     st.subheader("💬 Đặt câu hỏi")
     
@@ -593,7 +793,7 @@ def main():
     with col2:
         search_mode = st.selectbox(
             "Chế độ tìm kiếm",
-            ["Hybrid (khuyến nghị)", "Semantic only", "Keyword priority"],
+            list(SEARCH_MODES),
             index=0
         )
     
@@ -602,6 +802,10 @@ def main():
         col_a, col_b = st.columns(2)
         with col_a:
             num_results = st.slider("Số nguồn tham chiếu", 5, 20, 10)
+            mmr_lambda = st.slider(
+                "Liên quan ↔ Đa dạng nguồn (λ)", 0.0, 1.0, MMR_LAMBDA, 0.05,
+                help="1.0 = chỉ theo độ liên quan; giảm λ để bớt các đoạn trích gần trùng nhau"
+            )
         with col_b:
             answer_detail = st.select_slider(
                 "Độ chi tiết câu trả lời",
@@ -611,6 +815,13 @@ def main():
     
     run = st.button("🔍 Tìm kiếm & Trả lời", type="primary", use_container_width=True)
 
+    # Lần chạy trước bị dừng giữa chừng: giữ lại phần câu trả lời đã nhận
+    partial = st.session_state.pop("partial_answer", None)
+    if partial and not run:
+        st.markdown("### ✅ Kết quả (đã dừng)")
+        st.caption("Câu hỏi: %s" % partial["question"])
+        st.markdown(partial["text"])
+
     if run:
         if not question.strip():
             st.warning("Vui lòng nhập câu hỏi.")
@@ -618,21 +829,38 @@ def main():
 
         with st.spinner("Đang phân tích câu hỏi và tìm kiếm tài liệu..."):
             qvec = _embed_query(client, question)
-            results = _search(index, meta, qvec, question, topk=num_results)
+            # Khoá đọc chỉ trong lúc tìm kiếm; kết quả là bản sao, không phụ thuộc index sau đó
+            with shared.read() as index:
+                results = _search(index, qvec, question, topk=num_results, mode=SEARCH_MODES[search_mode],
+                                  mmr_lambda=mmr_lambda)
 
         if not results:
             st.info("❌ Không tìm thấy đoạn trích phù hợp. Vui lòng thử câu hỏi khác hoặc kiểm tra tài liệu.")
             return
 
-        with st.spinner("Đang tổng hợp và phân tích thông tin..."):
-            answer = _ask_llm(client, question, results)
+        # Cùng bằng chứng + câu hỏi gần giống: dùng lại câu trả lời và bảng nguồn đã lưu
+        answer_cache = _answer_cache()
+        chunk_ids = [r["chunk_id"] for r in results]
+        variant = "%s|%s" % (LLM_MODEL, answer_detail)
+        cached = answer_cache.get(qvec, chunk_ids, variant=variant)
+        if cached is not None:
+            results = cached["sources"]
+        else:
+            # Gộp chunk liên tiếp, bỏ overlap, cắt theo ngân sách; số [n] theo thứ tự nguồn sau khi gộp
+            results = pack_context(results, CONTEXT_BUDGETS[answer_detail], count_tokens)
 
-        # Display answer
+        # Chỗ cho câu trả lời nằm trên bảng nguồn, nhưng bảng nguồn được vẽ trước khi gọi LLM
         st.markdown("### ✅ Kết quả")
-        st.markdown(answer)
+        answer_box = st.container()
+        if cached is not None:
+            with answer_box:
+                st.caption("⚡ Câu trả lời từ cache (câu hỏi tương tự %.2f, %d phút trước)" % (
+                    cached["similarity"], cached["age"] // 60))
+                st.markdown(cached["answer"])
 
         st.markdown("---")
         st.markdown("### 📚 Nguồn tham chiếu")
+        st.caption("Context: %d nguồn, ~%d tokens" % (len(results), sum(r.get("token_count", 0) for r in results)))
         
         df = pd.DataFrame([
             {
@@ -674,6 +902,29 @@ def main():
                 st.code(txt, language="markdown")
                 st.markdown('---')
 
+        if cached is None:
+            with answer_box:
+                if LLM_STREAMING:
+                    # Bấm Dừng (hay bất kỳ rerun nào) ngắt script, stream.close() huỷ request
+                    stop_slot = st.empty()
+                    stop_slot.button("⏹️ Dừng tạo câu trả lời")
+                    state: Dict[str, Any] = {}
+                    stream = _stream_llm(client, question, results, state)
+                    try:
+                        st.write_stream(stream)
+                    finally:
+                        stream.close()
+                    stop_slot.empty()
+                    answer = state["text"] if state.get("completed") else LLM_ERROR_ANSWER
+                    if state.get("first_token") is not None:
+                        st.caption("Token đầu tiên sau %.1fs" % state["first_token"])
+                else:
+                    with st.spinner("Đang tổng hợp và phân tích thông tin..."):
+                        answer = _ask_llm(client, question, results)
+                    st.markdown(answer)
+            if answer and answer != LLM_ERROR_ANSWER:
+                answer_cache.put(qvec, chunk_ids, answer, results, variant=variant)
+
     st.caption("Sản phẩm thử nghiệm của Ban Kỹ thuật – VNA. Mọi ý kiến đóng góp vui lòng liên hệ Phòng Kỹ thuật Máy bay.")
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Drive v3 giả lập trong bộ nhớ, đủ cho drive_utils.sync_folder.
+
+Hỗ trợ files.list (lọc theo "'<folder>' in parents", phân trang),
+changes.getStartPageToken và changes.list (phân trang bằng nextPageToken,
+trang cuối trả newStartPageToken). Mỗi thay đổi (thêm, sửa, đổi tên, trash,
+xoá hẳn, chuyển folder) ghi một entry vào changes log như Drive thật; entry
+trả về trạng thái hiện tại của file, file đã xoá hẳn trả ``removed: True``.
+"""
+import hashlib
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class _Request:
+    def __init__(self, fn: Callable[[], Any]):
+        self._fn = fn
+
+    def execute(self) -> Any:
+        return self._fn()
+
+
+class FakeDrive:
+    def __init__(self, page_size: int = 2):
+        self.page_size = page_size
+        self.files_: Dict[str, Dict[str, Any]] = {}
+        self.log: List[str] = []
+        self.calls: List[str] = []
+        self._next_id = 0
+        self._clock = 0
+
+    # ---------- Thao tác trên "Drive" ----------
+    def _tick(self) -> str:
+        self._clock += 1
+        return "2024-01-01T00:00:%02d.000Z" % self._clock
+
+    def add(self, name: str, folder: str, content: bytes = b"") -> str:
+        self._next_id += 1
+        fid = "file%d" % self._next_id
+        self.files_[fid] = {"id": fid, "name": name, "parents": [folder], "trashed": False,
+                            "mimeType": "application/pdf", "content": content,
+                            "modifiedTime": self._tick()}
+        self.log.append(fid)
+        return fid
+
+    def modify(self, fid: str, content: bytes) -> None:
+        self.files_[fid].update(content=content, modifiedTime=self._tick())
+        self.log.append(fid)
+
+    def rename(self, fid: str, name: str) -> None:
+        # Chỉ đổi metadata: Drive không đổi md5Checksum
+        self.files_[fid]["name"] = name
+        self.log.append(fid)
+
+    def trash(self, fid: str) -> None:
+        self.files_[fid]["trashed"] = True
+        self.log.append(fid)
+
+    def delete(self, fid: str) -> None:
+        del self.files_[fid]
+        self.log.append(fid)
+
+    def move(self, fid: str, folder: str) -> None:
+        self.files_[fid]["parents"] = [folder]
+        self.log.append(fid)
+
+    def meta(self, fid: str) -> Dict[str, Any]:
+        f = self.files_[fid]
+        return {"id": fid, "name": f["name"], "parents": list(f["parents"]), "trashed": f["trashed"],
+                "mimeType": f["mimeType"], "modifiedTime": f["modifiedTime"],
+                "size": str(len(f["content"])), "md5Checksum": hashlib.md5(f["content"]).hexdigest()}
+
+    # ---------- Giao diện service (googleapiclient) ----------
+    def files(self) -> "_Files":
+        return _Files(self)
+
+    def changes(self) -> "_Changes":
+        return _Changes(self)
+
+    def _page(self, items: List[Any], token: Optional[str]) -> Tuple[List[Any], Optional[str]]:
+        start = int(token or 0)
+        end = start + self.page_size
+        return items[start:end], (str(end) if end < len(items) else None)
+
+
+class _Files:
+    def __init__(self, drive: FakeDrive):
+        self.drive = drive
+
+    def list(self, q: str, pageToken: Optional[str] = None, fields: str = "", orderBy: str = "",
+             pageSize: int = 100) -> _Request:
+        folder = re.search(r"'([^']*)' in parents", q).group(1)
+
+        def _fn():
+            self.drive.calls.append("files.list")
+            items = sorted((self.drive.meta(fid) for fid, f in self.drive.files_.items()
+                            if folder in f["parents"] and not f["trashed"]),
+                           key=lambda f: f["name"])
+            page, next_token = self.drive._page(items, pageToken)
+            resp = {"files": page}
+            if next_token:
+                resp["nextPageToken"] = next_token
+            return resp
+        return _Request(_fn)
+
+
+class _Changes:
+    def __init__(self, drive: FakeDrive):
+        self.drive = drive
+
+    def getStartPageToken(self) -> _Request:
+        def _fn():
+            self.drive.calls.append("changes.getStartPageToken")
+            return {"startPageToken": "c%d" % len(self.drive.log)}
+        return _Request(_fn)
+
+    def list(self, pageToken: str, fields: str = "", spaces: str = "drive", includeRemoved: bool = True,
+             pageSize: int = 1000) -> _Request:
+        def _fn():
+            self.drive.calls.append("changes.list")
+            start = int(pageToken[1:])
+            end = min(start + self.drive.page_size, len(self.drive.log))
+            changes = []
+            for fid in self.drive.log[start:end]:
+                if fid in self.drive.files_:
+                    changes.append({"fileId": fid, "removed": False, "file": self.drive.meta(fid)})
+                else:
+                    changes.append({"fileId": fid, "removed": True})
+            if end < len(self.drive.log):
+                return {"changes": changes, "nextPageToken": "c%d" % end}
+            return {"changes": changes, "newStartPageToken": "c%d" % end}
+        return _Request(_fn)
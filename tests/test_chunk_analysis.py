@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""_analyze_chunk: structure, content type và key terms trong một lượt quét"""
+from document_processors import _analyze_chunk
+
+
+def test_structure_and_terms_from_one_pass():
+    text = ("1.2 APU START\n"
+            "1. Open CB 21-HC-1 on panel.\n"
+            "- Check the ECAM BLEED page, 28V DC.\n"
+            "- Pressure 45 psi, then 45 psi again.\n")
+    a = _analyze_chunk(text)
+    s = a["structure"]
+    assert (s["has_headers"], s["header_count"]) == (True, 1)
+    assert (s["has_numbered_lists"], s["has_bullet_lists"], s["list_count"]) == (True, True, 3)
+    # "-" (cả trong tech code) là ký tự kẻ bảng
+    assert s["has_tables"] and a["content_type"] == "table_data"
+    assert a["key_terms"][0] == "45 psi"
+    # Acronym và number with unit nằm trong tech code vẫn được đếm
+    assert {"APU", "START", "CB", "HC", "ECAM", "BLEED", "DC", "21-HC-1", "28V"} <= set(a["key_terms"])
+
+
+def test_keywords_match_inside_words_and_acronyms():
+    assert _analyze_chunk("See the footnote below")["content_type"] == "safety_note"
+    assert _analyze_chunk("NOTE: APU LIMITS")["content_type"] == "specification"
+    assert _analyze_chunk("Refer to TECHNICAL DATA")["content_type"] == "specification"
+    assert _analyze_chunk("SSM-TECHNICAL DATA")["content_type"] == "specification"
+    assert _analyze_chunk("Removal steps")["content_type"] == "procedure"
+    assert _analyze_chunk("plain text")["content_type"] == "general"
+
+
+def test_tokens_do_not_cross_lines():
+    a = _analyze_chunk("value 5\nmm later\nLINE TWO:")
+    assert "5\nmm" not in a["key_terms"]
+    assert a["structure"]["header_count"] == 1
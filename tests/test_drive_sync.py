@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""drive_utils.sync_folder trên Drive giả lập (tests/fake_drive.py)"""
+import pytest
+
+from drive_utils import sync_folder
+from fake_drive import FakeDrive
+
+FOLDER = "folder-a"
+OTHER = "folder-b"
+
+
+@pytest.fixture
+def drive():
+    return FakeDrive(page_size=2)
+
+
+@pytest.fixture
+def sync(drive, tmp_path):
+    state_path = str(tmp_path / "sync_state.json")
+    return lambda folder=FOLDER: sync_folder(drive, folder, state_path=state_path)
+
+
+def _ids(files):
+    return sorted(f["id"] for f in files)
+
+
+def test_first_sync_lists_folder_and_reports_everything_added(drive, sync):
+    a = drive.add("a.pdf", FOLDER)
+    b = drive.add("b.pdf", FOLDER)
+    c = drive.add("c.pdf", FOLDER)
+    drive.add("elsewhere.pdf", OTHER)
+
+    result = sync()
+
+    assert [f["name"] for f in result["files"]] == ["a.pdf", "b.pdf", "c.pdf"]
+    assert _ids(result["added"]) == sorted([a, b, c])
+    assert result["modified"] == [] and result["removed"] == []
+    # Danh sách ban đầu qua nhiều trang (page_size = 2)
+    assert drive.calls == ["changes.getStartPageToken", "files.list", "files.list"]
+
+
+def test_no_changes_reads_only_the_changes_feed(drive, sync):
+    drive.add("a.pdf", FOLDER)
+    sync()
+    drive.calls.clear()
+
+    result = sync()
+
+    assert (result["added"], result["modified"], result["removed"]) == ([], [], [])
+    assert [f["name"] for f in result["files"]] == ["a.pdf"]
+    assert drive.calls == ["changes.list"]
+
+
+def test_added_file(drive, sync):
+    drive.add("a.pdf", FOLDER)
+    sync()
+    new = drive.add("new.pdf", FOLDER)
+    drive.add("ignored.pdf", OTHER)
+
+    result = sync()
+
+    assert _ids(result["added"]) == [new]
+    assert result["modified"] == [] and result["removed"] == []
+    assert [f["name"] for f in result["files"]] == ["a.pdf", "new.pdf"]
+
+
+def test_modified_in_place_keeps_id(drive, sync):
+    a = drive.add("a.pdf", FOLDER, b"v1")
+    sync()
+    drive.modify(a, b"v2")
+
+    result = sync()
+
+    assert result["added"] == [] and result["removed"] == []
+    assert _ids(result["modified"]) == [a]
+    assert result["files"][0]["md5Checksum"] == drive.meta(a)["md5Checksum"]
+
+
+def test_metadata_only_change_is_not_a_modification(drive, sync):
+    a = drive.add("a.pdf", FOLDER, b"v1")
+    sync()
+    drive.rename(a, "renamed.pdf")
+
+    result = sync()
+
+    assert (result["added"], result["modified"], result["removed"]) == ([], [], [])
+    assert [f["name"] for f in result["files"]] == ["renamed.pdf"]
+
+
+def test_trashed_file_is_removed(drive, sync):
+    a = drive.add("a.pdf", FOLDER)
+    b = drive.add("b.pdf", FOLDER)
+    sync()
+    drive.trash(a)
+
+    result = sync()
+
+    assert result["removed"] == [a]
+    assert _ids(result["files"]) == [b]
+
+
+def test_deleted_file_is_removed(drive, sync):
+    a = drive.add("a.pdf", FOLDER)
+    sync()
+    drive.delete(a)
+
+    result = sync()
+
+    assert result["removed"] == [a]
+    assert result["files"] == []
+
+
+def test_moved_out_is_removed_and_moved_in_is_added(drive, sync):
+    a = drive.add("a.pdf", FOLDER)
+    b = drive.add("b.pdf", OTHER)
+    sync()
+    drive.move(a, OTHER)
+    drive.move(b, FOLDER)
+
+    result = sync()
+
+    assert result["removed"] == [a]
+    assert _ids(result["added"]) == [b]
+    assert _ids(result["files"]) == [b]
+
+
+def test_changes_are_paged_and_reported_once(drive, sync):
+    sync()
+    added = [drive.add("f%d.pdf" % i, FOLDER) for i in range(5)]
+    drive.calls.clear()
+
+    result = sync()
+
+    assert _ids(result["added"]) == sorted(added)
+    assert drive.calls == ["changes.list"] * 3
+    assert sync()["added"] == []
+
+
+def test_add_then_delete_between_syncs_is_invisible(drive, sync):
+    sync()
+    a = drive.add("a.pdf", FOLDER)
+    drive.delete(a)
+
+    result = sync()
+
+    assert (result["files"], result["added"], result["removed"]) == ([], [], [])
+
+
+def test_switching_folder_relists(drive, sync):
+    drive.add("a.pdf", FOLDER)
+    b = drive.add("b.pdf", OTHER)
+    sync()
+    drive.calls.clear()
+
+    result = sync(OTHER)
+
+    assert _ids(result["files"]) == [b]
+    assert _ids(result["added"]) == [b]
+    assert drive.calls[0] == "changes.getStartPageToken"
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""QueryEmbeddingCache: key chuẩn hoá, API nhận text gốc, bộ đếm tách riêng."""
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache
+
+
+def test_query_cache_embeds_original_text_and_keeps_doc_counters(tmp_path):
+    disk = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    sent = []
+
+    def embed(text):
+        sent.append(text)
+        return [1.0, 0.0]
+
+    cache = QueryEmbeddingCache(disk)
+    assert cache.get_or_embed("  Chế độ  APU  ", "m", 2, embed) == [1.0, 0.0]
+    assert sent == ["Chế độ  APU"]
+    # Khác hoa/thường, khoảng trắng: cùng entry
+    cache.get_or_embed("chế độ apu", "m", 2, embed)
+    assert len(sent) == 1
+
+    # Process khác (LRU rỗng) tìm thấy trên đĩa
+    other = QueryEmbeddingCache(disk)
+    other.get_or_embed("CHẾ ĐỘ APU", "m", 2, embed)
+    assert len(sent) == 1
+    assert other.stats()["disk_hits"] == 1
+    stats = disk.stats()
+    assert (stats["hits"], stats["misses"]) == (0, 0)
+    disk.close()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""EmbeddingScheduler với client giả lập"""
+import threading
+
+import pytest
+
+from embedding_scheduler import EmbeddingScheduler, RateLimiter
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class _Item:
+    def __init__(self, embedding):
+        self.embedding = embedding
+
+
+class _Response:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeClient:
+    """embeddings.create: text nằm trong ``bad`` làm hỏng cả request; rate_limited = luôn 429"""
+
+    def __init__(self, bad=(), rate_limited=False):
+        self.bad = set(bad)
+        self.rate_limited = rate_limited
+        self.requests = []
+        self._lock = threading.Lock()
+        self.embeddings = self
+
+    def create(self, model, input):
+        with self._lock:
+            self.requests.append(list(input))
+        if self.rate_limited:
+            raise RateLimitError("rate limited")
+        if self.bad.intersection(input):
+            raise ValueError("invalid input")
+        return _Response([_Item([float(len(t))]) for t in input])
+
+
+def _scheduler(client, max_retries=2):
+    limiter = RateLimiter(requests_per_minute=1e9, tokens_per_minute=1e12)
+    limiter.pause = lambda seconds: None  # không chờ thật trong test
+    return EmbeddingScheduler(client, "test-model", limiter, concurrency=2, max_retries=max_retries)
+
+
+def test_failed_item_is_isolated_by_splitting_and_reported_by_position():
+    texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+    client = FakeClient(bad={"ccc"})
+
+    vectors, errors = _scheduler(client).embed(texts, [1] * len(texts), max_items=8)
+
+    assert vectors == [[1.0], [2.0], None, [4.0], [5.0]]
+    assert [pos for pos, _ in errors] == [2]
+
+
+def test_exhausted_rate_limit_is_raised_without_splitting():
+    texts = ["t%d" % i for i in range(64)]
+    client = FakeClient(rate_limited=True)
+
+    with pytest.raises(RateLimitError):
+        _scheduler(client, max_retries=2).embed(texts, [1] * len(texts), max_items=64)
+
+    # Một batch, 1 lần gửi + 2 lần thử lại; không chia nhỏ
+    assert len(client.requests) == 3
+    assert all(len(r) == 64 for r in client.requests)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""IndexWorker: job vừa submit luôn thấy được (đang chờ hoặc đang chạy)"""
+import threading
+import time
+
+import index_worker
+from index_worker import IndexWorker
+
+
+class _SlowProgress(index_worker.JobProgress):
+    # Nới rộng khoảng giữa lúc lấy job khỏi hàng đợi và lúc job được đánh dấu đang chạy
+    def __init__(self, job):
+        time.sleep(0.01)
+        super().__init__(job)
+
+
+def test_submitted_job_is_always_pending_or_running(monkeypatch):
+    monkeypatch.setattr(index_worker, "JobProgress", _SlowProgress)
+    release = threading.Event()
+    ran = []
+
+    def run_job(job, progress):
+        ran.append(job["kind"])
+        release.wait(5)
+
+    worker = IndexWorker(run_job)
+    for _ in range(20):
+        release.clear()
+        n = len(ran)
+        assert worker.submit("update")
+        deadline = time.time() + 5
+        while len(ran) == n and time.time() < deadline:
+            status = worker.status()
+            assert status["running"] is not None or status["pending"] == ["update"]
+        status = worker.status()
+        assert status["running"] is not None and status["pending"] == []
+        release.set()
+        while worker.status()["running"] is not None and time.time() < deadline:
+            time.sleep(0.001)
+    assert len(ran) == 20
+    assert worker.status()["last"]["error"] is None
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""indexer.update_index với pipeline ingest giả lập (không download / parse / gọi API)"""
+import numpy as np
+import pytest
+
+import indexer
+from shared_index import SharedIndex
+
+DIM = 8
+
+
+class _Progress:
+    def __init__(self):
+        self.warnings = []
+
+    def set_total(self, total, text=""):
+        pass
+
+    def update(self, done, text=""):
+        pass
+
+    def info(self, message):
+        pass
+
+    def success(self, message):
+        pass
+
+    def warning(self, message):
+        self.warnings.append(message)
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """Kết quả pipeline theo nội dung file["content"]; "FAIL" = lỗi parse"""
+    def _run(files, **kwargs):
+        results = []
+        for f in files:
+            res = {"file": f, "chunks": None, "vectors": None, "error": None, "stage": None, "warnings": []}
+            if f["content"] == "FAIL":
+                res.update(stage="parse", error="broken file")
+            else:
+                res["chunks"] = [{"text": "%s %d" % (f["content"], i), "chunk_index": i} for i in range(2)]
+                rng = np.random.default_rng(abs(hash(f["content"])) % (2 ** 32))
+                res["vectors"] = rng.standard_normal((2, DIM)).tolist()
+            results.append(res)
+        return results
+
+    monkeypatch.setattr(indexer, "run_ingest_pipeline", _run)
+
+
+def _update(shared, files, tmp_path, **kwargs):
+    return indexer.update_index(shared, files, download_fn=None, progress=_Progress(),
+                                index_dir=str(tmp_path / "faiss_index"),
+                                meta_path=str(tmp_path / "meta.sqlite"), **kwargs)
+
+
+def _file(fid, mtime, content):
+    return {"id": fid, "name": fid + ".pdf", "modifiedTime": mtime, "content": content}
+
+
+def _texts(store):
+    return sorted(r["text"] for r in store.rows(list(range(store.next_id))).values())
+
+
+@pytest.fixture
+def shared(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    out = SharedIndex()
+    yield out
+    if out.store is not None:
+        out.store.store.close()
+
+
+@pytest.mark.parametrize("copy_on_write", [False, True])
+def test_failed_reingest_keeps_previous_chunks(pipeline, shared, tmp_path, copy_on_write):
+    _update(shared, [_file("a", "t1", "a-v1"), _file("b", "t1", "b-v1")], tmp_path)
+
+    stats = _update(shared, [_file("a", "t2", "FAIL"), _file("b", "t1", "b-v1")], tmp_path,
+                    copy_on_write=copy_on_write)
+
+    assert stats["failed"] == 1 and stats["removed"] == 0
+    assert _texts(shared.store) == ["a-v1 0", "a-v1 1", "b-v1 0", "b-v1 1"]
+    # modifiedTime cũ vẫn trong index: lần sau file được xử lý lại
+    assert shared.store.file_modified_times()["a"] == "t1"
+
+    stats = _update(shared, [_file("a", "t2", "a-v2"), _file("b", "t1", "b-v1")], tmp_path,
+                    copy_on_write=copy_on_write)
+
+    assert stats["files"] == 1 and stats["removed"] == 2
+    assert _texts(shared.store) == ["a-v2 0", "a-v2 1", "b-v1 0", "b-v1 1"]
+
+
+def test_removed_source_file_is_dropped_even_when_other_files_fail(pipeline, shared, tmp_path):
+    _update(shared, [_file("a", "t1", "a-v1"), _file("b", "t1", "b-v1")], tmp_path)
+
+    stats = _update(shared, [_file("a", "t2", "FAIL")], tmp_path)
+
+    assert stats["removed"] == 2
+    assert _texts(shared.store) == ["a-v1 0", "a-v1 1"]